@@ -0,0 +1,6 @@
+# This file is part of relatorio.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmarks of relatorio hot paths.
+
+Run them from the top of the repository with ``python -m benchmarks.<name>``.
+"""
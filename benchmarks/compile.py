@@ -0,0 +1,42 @@
+# This file is part of relatorio.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"Benchmark of the compilation of opendocument templates"
+import timeit
+from argparse import ArgumentParser
+from io import BytesIO
+
+from relatorio.templates.opendocument import Template
+
+from . import synthetic
+
+
+def run(blocks=1000, repeat=5):
+    "Returns the best times of insert_directives and of the full compilation"
+    content = synthetic.content(blocks)
+    odt = synthetic.template(blocks)
+    template = Template(BytesIO(odt))
+    directives = min(timeit.repeat(
+            lambda: template.insert_directives(content),
+            number=1, repeat=repeat))
+    compilation = min(timeit.repeat(
+            lambda: Template(BytesIO(odt)), number=1, repeat=repeat))
+    return {
+        'content_size': len(content),
+        'insert_directives': directives,
+        'compile': compilation,
+        }
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--blocks', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    result = run(args.blocks, args.repeat)
+    print("content.xml: %(content_size)d bytes\n"
+        "insert_directives: %(insert_directives).3fs\n"
+        "compile: %(compile).3fs" % result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# This file is part of relatorio.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"Benchmark of the rendering with each compression profile"
+import os
+import timeit
+from argparse import ArgumentParser
+from io import BytesIO
+
+from relatorio.templates.opendocument import COMPRESSION_PROFILES, Template
+
+from . import synthetic
+
+
+def data(image_size=500000):
+    "Returns the data to render the synthetic template"
+    return {
+        'name': 'Bonham',
+        'items': ['item %s' % i for i in range(10)],
+        'lines': [('line %s' % i, i) for i in range(20)],
+        # random bytes do not compress like photos
+        'logo': (os.urandom(image_size), 'image/jpeg'),
+        }
+
+
+def run(blocks=200, repeat=3, image_size=500000):
+    "Returns the best rendering time and the size for each profile"
+    template = Template(BytesIO(synthetic.template(blocks)))
+    values = data(image_size)
+    results = {}
+    for name in sorted(COMPRESSION_PROFILES):
+        def render():
+            return template.generate(
+                _relatorio_compression=name, **values).render()
+        duration = min(timeit.repeat(render, number=1, repeat=repeat))
+        results[name] = {
+            'render': duration,
+            'size': len(render().getvalue()),
+            }
+    return results
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--image-size', type=int, default=500000)
+    args = parser.parse_args()
+    results = run(args.blocks, args.repeat, args.image_size)
+    for name, result in results.items():
+        print("%s: %.3fs %d bytes" % (name, result['render'], result['size']))
+
+
+if __name__ == '__main__':
+    main()
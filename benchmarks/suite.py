@@ -0,0 +1,226 @@
+# This file is part of relatorio.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Benchmark suite of the compilation and the rendering of scaled templates
+
+Each scenario scales the synthetic template along one dimension and measures
+the median and the best compilation and rendering times, the rendering
+throughput, the peak memory and the output size. The results can be saved as a
+baseline and compared to it to flag the regressions."""
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from io import BytesIO
+
+from relatorio.stats import RenderStats
+from relatorio.templates.opendocument import Template
+
+from . import synthetic
+
+# the dimensions of each scenario at scale 1
+SCENARIOS = {
+    'rows': {'rows': 20000},
+    'columns': {'rows': 500, 'columns': 40},
+    'images': {'images': 200},
+    'objects': {'rows': 200, 'objects': 40},
+    'placeholders': {'placeholders': 5000},
+    'flat': {'rows': 20000, 'placeholders': 500, 'flat': True},
+    }
+# the metrics which are better when higher, the others are better lower
+HIGHER_IS_BETTER = {'throughput', 'throughput_best'}
+# the best values confirming the regressions of the median timings
+TIMINGS = {
+    'compile': 'compile_best',
+    'render': 'render_best',
+    'throughput': 'throughput_best',
+    }
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_REPEAT = 5
+# the minimum number of measures of the timings to compare
+MIN_REPEAT = 5
+# the minimum duration in seconds of the measures of each timing
+MIN_TIME = 0.5
+
+
+def _scale(dimensions, scale):
+    return {k: v if isinstance(v, bool) else max(1, int(v * scale))
+        for k, v in dimensions.items()}
+
+
+def _peak(function):
+    "Returns the result of function and the peak of memory allocated by it"
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1] - start
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+
+
+def _timings(function, repeat=DEFAULT_REPEAT, min_time=MIN_TIME):
+    "Returns the durations of at least repeat calls lasting min_time in total"
+    durations = []
+    while len(durations) < repeat or sum(durations) < min_time:
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def run_scenario(rows=0, columns=0, images=0, objects=0, placeholders=0,
+        flat=False, repeat=DEFAULT_REPEAT, min_time=MIN_TIME):
+    "Returns the metrics of the scaled template"
+    dimensions = {'rows': rows, 'columns': columns, 'images': images,
+        'objects': objects, 'placeholders': placeholders}
+    if flat:
+        source = synthetic.scaled_flat(**dimensions)
+    else:
+        source = synthetic.scaled(**dimensions)
+    data = synthetic.scaled_data(rows, columns, images)
+
+    def compile_():
+        return Template(BytesIO(source))
+
+    def render():
+        return template.generate(**data).render()
+
+    compilations = _timings(compile_, repeat, min_time)
+    template, compile_peak = _peak(compile_)
+    renderings = _timings(render, repeat, min_time)
+    output, render_peak = _peak(render)
+    stats = RenderStats()
+    template.generate(_relatorio_stats=stats, **data).render()
+    rendering = statistics.median(renderings)
+    return {
+        'source_size': len(source),
+        'compile': statistics.median(compilations),
+        'compile_best': min(compilations),
+        'compile_peak': compile_peak,
+        'render': rendering,
+        'render_best': min(renderings),
+        'render_peak': render_peak,
+        # the uncompressed bytes rendered per second
+        'throughput': stats.counters['bytes_in'] / rendering,
+        'throughput_best': stats.counters['bytes_in'] / min(renderings),
+        'events': stats.counters['events'],
+        'size': len(output.getvalue()),
+        'repeat': min(len(compilations), len(renderings)),
+        }
+
+
+def run(scenarios=None, scale=1., repeat=DEFAULT_REPEAT, min_time=MIN_TIME):
+    "Returns the metrics by name of scenario"
+    results = {}
+    for name in scenarios or sorted(SCENARIOS):
+        dimensions = _scale(SCENARIOS[name], scale)
+        results[name] = dict(
+            run_scenario(repeat=repeat, min_time=min_time, **dimensions),
+            dimensions=dimensions)
+    return results
+
+
+def environment():
+    "Returns the description of the environment of the results"
+    import genshi
+    import lxml.etree
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'genshi': genshi.__version__,
+        'lxml': lxml.etree.__version__,
+        }
+
+
+def _change(metric, reference, value):
+    "Returns the relative change of value which is worse when positive"
+    if not reference or not isinstance(value, (int, float)):
+        return 0
+    change = (value - reference) / reference
+    if metric in HIGHER_IS_BETTER:
+        change = -change
+    return change
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Returns the list of (scenario, metric, baseline, value, change) for
+    the metrics worse than the baseline by more than tolerance.
+
+    The timings are compared only when both have at least MIN_REPEAT
+    measures and their median is a regression only if their best value is
+    also worse by more than tolerance."""
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        base = baseline.get(name)
+        if not base or base.get('dimensions') != metrics['dimensions']:
+            continue
+        measured = min(metrics.get('repeat', 0), base.get('repeat', 0))
+        for metric, value in sorted(metrics.items()):
+            if (metric in {'dimensions', 'repeat'}
+                    or metric in TIMINGS.values()):
+                continue
+            if metric in TIMINGS:
+                best = TIMINGS[metric]
+                if (measured < MIN_REPEAT or _change(
+                            best, base.get(best), metrics.get(best))
+                        <= tolerance):
+                    continue
+            reference = base.get(metric)
+            change = _change(metric, reference, value)
+            if change > tolerance:
+                regressions.append((name, metric, reference, value, change))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--scenario', action='append',
+        choices=sorted(SCENARIOS),
+        help="the scenario to run (repeatable, all by default)")
+    parser.add_argument('--scale', type=float, default=1.,
+        help="the factor of the dimensions of the scenarios")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+        help="the minimum number of measures of each timing")
+    parser.add_argument('--min-time', type=float, default=MIN_TIME,
+        help="the minimum duration in seconds of the measures of each timing")
+    parser.add_argument('--save', metavar='FILE',
+        help="save the results as baseline into FILE")
+    parser.add_argument('--compare', metavar='FILE',
+        help="compare the results to the baseline of FILE")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help="the relative change flagged as regression")
+    args = parser.parse_args()
+    results = run(args.scenario, args.scale, args.repeat, args.min_time)
+    for name, result in results.items():
+        print("%s: compile %.3fs (best %.3fs, %.1f MB) "
+            "render %.3fs (best %.3fs, %.1f MB) %.1f MB/s %d bytes" % (
+                name, result['compile'], result['compile_best'],
+                result['compile_peak'] / 1e6,
+                result['render'], result['render_best'],
+                result['render_peak'] / 1e6,
+                result['throughput'] / 1e6, result['size']))
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump({'environment': environment(), 'results': results},
+                fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for name, metric, reference, value, change in regressions:
+            print("REGRESSION %s %s: %.6g -> %.6g (%.0f%% worse)" % (
+                    name, metric, reference, value, change * 100))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+# This file is part of relatorio.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"Generation of synthetic opendocument templates"
+import random
+import zipfile
+from io import BytesIO
+
+NAMESPACES = {
+    'office': 'urn:oasis:names:tc:opendocument:xmlns:office:1.0',
+    'style': 'urn:oasis:names:tc:opendocument:xmlns:style:1.0',
+    'text': 'urn:oasis:names:tc:opendocument:xmlns:text:1.0',
+    'table': 'urn:oasis:names:tc:opendocument:xmlns:table:1.0',
+    'draw': 'urn:oasis:names:tc:opendocument:xmlns:drawing:1.0',
+    'xlink': 'http://www.w3.org/1999/xlink',
+    'dc': 'http://purl.org/dc/elements/1.1/',
+    'meta': 'urn:oasis:names:tc:opendocument:xmlns:meta:1.0',
+    'svg': 'urn:oasis:names:tc:opendocument:xmlns:svg-compatible:1.0',
+    'manifest': 'urn:oasis:names:tc:opendocument:xmlns:manifest:1.0',
+    'chart': 'urn:oasis:names:tc:opendocument:xmlns:chart:1.0',
+    }
+MIMETYPE = 'application/vnd.oasis.opendocument.text'
+CHART_MIMETYPE = 'application/vnd.oasis.opendocument.chart'
+CONTENT_PREFIXES = ('style', 'text', 'table', 'draw', 'xlink', 'svg')
+
+
+def _xmlns(*prefixes):
+    return ' '.join('xmlns:%s="%s"' % (p, NAMESPACES[p]) for p in prefixes)
+
+
+def _document(name, body, *prefixes):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<office:document-%s %s office:version="1.2">%s'
+        '</office:document-%s>' % (
+            name, _xmlns('office', *prefixes), body, name)).encode('utf-8')
+
+
+def relatorio_link(expression):
+    return ('<text:a xlink:type="simple" xlink:href="relatorio://%s">%s'
+        '</text:a>' % (expression.replace('"', '%22'),
+            expression.replace('"', '&quot;')))
+
+
+def placeholder(expression):
+    return ('<text:placeholder text:placeholder-type="text">&lt;%s&gt;'
+        '</text:placeholder>' % expression)
+
+
+def block(index):
+    "A block of text, placeholders, a row loop and an image"
+    return (
+        '<text:p>Static paragraph %(i)s with some text to process.</text:p>'
+        '<text:p>Dear %(name)s,<text:soft-page-break/></text:p>'
+        '<text:p>%(for)s</text:p>'
+        '<text:p>%(item)s</text:p>'
+        '<text:p>%(endfor)s</text:p>'
+        '<table:table table:name="Table%(i)s">'
+        '<table:table-column table:number-columns-repeated="2"/>'
+        '<table:table-row><table:table-cell><text:p>%(rfor)s</text:p>'
+        '</table:table-cell><table:table-cell/></table:table-row>'
+        '<table:table-row><table:table-cell><text:p>%(line)s</text:p>'
+        '</table:table-cell><table:table-cell><text:p>%(amount)s</text:p>'
+        '</table:table-cell></table:table-row>'
+        '<table:table-row><table:table-cell><text:p>%(endfor)s</text:p>'
+        '</table:table-cell><table:table-cell/></table:table-row>'
+        '</table:table>'
+        '<text:p><draw:frame draw:name="image: logo" svg:width="2cm" '
+        'svg:height="1cm"><draw:image xlink:href="" xlink:type="simple"/>'
+        '</draw:frame></text:p>') % {
+            'i': index,
+            'name': placeholder('name'),
+            'for': relatorio_link('for each="item in items"'),
+            'item': placeholder('item'),
+            'endfor': relatorio_link('/for'),
+            'rfor': relatorio_link('for each="line in lines"'),
+            'line': placeholder('line[0]'),
+            'amount': placeholder('line[1]'),
+            }
+
+
+def content(blocks):
+    body = '<office:body><office:text text:use-soft-page-breaks="true">'
+    body += ''.join(block(i) for i in range(blocks))
+    body += '</office:text></office:body>'
+    return _document('content', body, *CONTENT_PREFIXES)
+
+
+def _manifest(entries, mimetype=MIMETYPE):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<manifest:manifest %s>%s</manifest:manifest>' % (
+            _xmlns('manifest'), ''.join(
+                '<manifest:file-entry manifest:full-path="%s" '
+                'manifest:media-type="%s"/>' % entry
+                for entry in [('/', mimetype)] + entries)))
+
+
+def _archive(content, objects=()):
+    "Returns the ODT of content and of the objects as bytes"
+    entries = [
+        ('content.xml', 'text/xml'),
+        ('styles.xml', 'text/xml'),
+        ('meta.xml', 'text/xml'),
+        ]
+    data = BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as odt:
+        odt.writestr('mimetype', MIMETYPE, zipfile.ZIP_STORED)
+        odt.writestr('content.xml', content)
+        odt.writestr('styles.xml', _document(
+                'styles', '<office:styles/>', 'style', 'text'))
+        odt.writestr('meta.xml', _document(
+                'meta', '<office:meta/>', 'meta', 'dc'))
+        for name, object_content in objects:
+            odt.writestr(name + '/content.xml', object_content)
+            odt.writestr(name + '/styles.xml', _document(
+                    'styles', '<office:styles/>', 'style'))
+            odt.writestr(name + '/meta.xml', _document(
+                    'meta', '<office:meta/>', 'meta'))
+            entries.append((name + '/', CHART_MIMETYPE))
+            entries.extend((name + '/' + part, 'text/xml')
+                for part in ['content.xml', 'styles.xml', 'meta.xml'])
+        odt.writestr('META-INF/manifest.xml', _manifest(entries))
+    return data.getvalue()
+
+
+def template(blocks):
+    "Returns an ODT template of blocks as bytes"
+    return _archive(content(blocks))
+
+
+def row_table(name, *cells):
+    "A table with a loop over the rows of lines"
+    columns = len(cells)
+    return (
+        '<table:table table:name="%(name)s">'
+        '<table:table-column table:number-columns-repeated="%(columns)s"/>'
+        '<table:table-row><table:table-cell><text:p>%(for)s</text:p>'
+        '</table:table-cell>%(covered)s</table:table-row>'
+        '<table:table-row>%(cells)s</table:table-row>'
+        '<table:table-row><table:table-cell><text:p>%(endfor)s</text:p>'
+        '</table:table-cell>%(covered)s</table:table-row>'
+        '</table:table>') % {
+            'name': name,
+            'columns': columns,
+            'for': relatorio_link('for each="line in lines"'),
+            'endfor': relatorio_link('/for'),
+            'covered': '<table:table-cell/>' * (columns - 1),
+            'cells': ''.join(
+                '<table:table-cell><text:p>%s</text:p></table:table-cell>'
+                % placeholder(c) for c in cells),
+            }
+
+
+def column_table():
+    "A table with a loop over the columns of each row of matrix"
+    return (
+        '<table:table table:name="Columns">'
+        '<table:table-column/><table:table-column/><table:table-column/>'
+        '<table:table-row><table:table-cell table:number-columns-spanned="3">'
+        '<text:p>%(for)s</text:p></table:table-cell>'
+        '<table:covered-table-cell/><table:covered-table-cell/>'
+        '</table:table-row>'
+        '<table:table-row><table:table-cell><text:p>%(cfor)s</text:p>'
+        '</table:table-cell><table:table-cell><text:p>%(value)s</text:p>'
+        '</table:table-cell><table:table-cell><text:p>%(endfor)s</text:p>'
+        '</table:table-cell></table:table-row>'
+        '<table:table-row><table:table-cell table:number-columns-spanned="3">'
+        '<text:p>%(endfor)s</text:p></table:table-cell>'
+        '<table:covered-table-cell/><table:covered-table-cell/>'
+        '</table:table-row>'
+        '</table:table>') % {
+            'for': relatorio_link('for each="row in matrix"'),
+            'cfor': relatorio_link('for each="value in row"'),
+            'value': placeholder('value'),
+            'endfor': relatorio_link('/for'),
+            }
+
+
+def image_loop():
+    "A frame repeated for each image of images"
+    return (
+        '<text:p>%(for)s</text:p>'
+        '<text:p><draw:frame draw:name="image: image" svg:width="2cm" '
+        'svg:height="1cm"><draw:image xlink:href="" xlink:type="simple"/>'
+        '</draw:frame></text:p>'
+        '<text:p>%(endfor)s</text:p>') % {
+            'for': relatorio_link('for each="image in images"'),
+            'endfor': relatorio_link('/for'),
+            }
+
+
+def chart_content():
+    "The content of a chart object with a loop over the rows of its table"
+    body = ('<office:body><office:chart><chart:chart>'
+        '<table:table table:name="local-table">%s</table:table>'
+        '</chart:chart></office:chart></office:body>') % (
+        row_table('Data', 'line[0]', 'line[1]').split('>', 1)[1].rsplit(
+            '<', 1)[0])
+    return _document('content', body, 'chart', *CONTENT_PREFIXES)
+
+
+def scaled_body(rows=0, columns=0, images=0, objects=0, placeholders=0):
+    "Returns the body of the text scaled along each dimension"
+    body = ''.join('<text:p>Field %s: %s</text:p>' % (i, placeholder('name'))
+        for i in range(placeholders))
+    if rows:
+        body += row_table('Rows', 'line[0]', 'line[1]')
+    if columns:
+        body += column_table()
+    if images:
+        body += image_loop()
+    body += ''.join(
+        '<text:p><draw:frame draw:name="Chart%(i)s" svg:width="8cm" '
+        'svg:height="5cm"><draw:object xlink:href="./Object %(i)s" '
+        'xlink:type="simple" xlink:show="embed" xlink:actuate="onLoad"/>'
+        '</draw:frame></text:p>' % {'i': i}
+        for i in range(objects))
+    return ('<office:body><office:text>%s</office:text></office:body>'
+        % body)
+
+
+def scaled(rows=0, columns=0, images=0, objects=0, placeholders=0):
+    """Returns an ODT template as bytes with placeholders, a table of rows, a
+    table of rows of columns, a loop of images and chart objects"""
+    body = scaled_body(rows, columns, images, objects, placeholders)
+    return _archive(
+        _document('content', body, *CONTENT_PREFIXES),
+        [('Object %s' % i, chart_content()) for i in range(objects)])
+
+
+def scaled_flat(rows=0, columns=0, images=0, objects=0, placeholders=0):
+    """Returns the same template as scaled as a flat ODT
+
+    The objects are inlined as office:document."""
+    body = scaled_body(rows, columns, images, objects, placeholders)
+    chart = chart_content().decode('utf-8')
+    chart_body = chart[chart.index('<office:body>'):chart.rindex('</office')]
+    for i in range(objects):
+        body = body.replace(
+            '<draw:object xlink:href="./Object %s" xlink:type="simple" '
+            'xlink:show="embed" xlink:actuate="onLoad"/>' % i,
+            '<draw:object><office:document office:mimetype="%s">%s'
+            '</office:document></draw:object>' % (CHART_MIMETYPE, chart_body))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<office:document %s office:version="1.2" office:mimetype="%s">'
+        '<office:meta/><office:styles/>%s</office:document>' % (
+            _xmlns('office', 'meta', 'dc', 'chart', *CONTENT_PREFIXES),
+            MIMETYPE, body)).encode('utf-8')
+
+
+def scaled_data(rows=0, columns=0, images=0, seed=0, image_size=20000):
+    "Returns the data to render the scaled templates"
+    generator = random.Random(seed)
+    return {
+        'name': 'Bonham',
+        'lines': [('line %s' % i, i * 1.5) for i in range(rows)],
+        'matrix': [list(range(columns)) for _ in range(max(rows, 1))]
+        if columns else [],
+        # random bytes do not compress like photos
+        'images': [
+            (b'\x89PNG\r\n\x1a\n' + generator.randbytes(image_size),
+                'image/png')
+            for _ in range(images)],
+        }
@@ -2,34 +2,176 @@
 import json
 import mimetypes
 import os
+import string
+import sys
 from argparse import ArgumentParser, FileType
 
 from relatorio import Report
+from relatorio.reporting import render_file
+from relatorio.stats import MemoryBudgetExceeded, MemoryStats
+from relatorio.templates.base import RelatorioStream
+from relatorio.templates.opendocument import Template
 
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
 
-def main(input_, data, output=None):
+
+def get_report(input_):
     input_ = os.path.abspath(input_)
     mimetype, _ = mimetypes.guess_type(input_)
-    report = Report(input_, mimetype)
-    content = report(**data).render().getvalue()
-    if output:
-        with open(output, 'wb') as fp:
-            fp.write(content)
+    return Report(input_, mimetype)
+
+
+def parse_size(value):
+    "Return the number of bytes of a size with an optional K, M or G suffix"
+    value = value.strip().upper()
+    unit = value[-1:] if value[-1:] in SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def main(input_, data, output=None, stats=None):
+    """Render the template with data into output.
+
+    stats is a RenderStats collecting the timings, the counters and, for
+    MemoryStats, the memory of the compilation and of the rendering."""
+    report = get_report(input_)
+    if stats is not None:
+        stats.call('compile',
+            report.tmpl_loader.load, report.fpath, report.mimetype)
+    stream = report(**data)
+
+    def render(**kwargs):
+        if stats is None:
+            return stream.render(**kwargs)
+        elif isinstance(stream, RelatorioStream):
+            return stream.render(stats=stats, **kwargs)
+        else:
+            return stats.call('render', lambda: stream.render(**kwargs))
+    if output == '-':
+        render(encoding='utf-8', out=sys.stdout.buffer)
+    elif output:
+        render_file(render, output)
+    else:
+        render()
+
+
+def memory_report(input_, data, output=None, budget=None):
+    "Render like main and print the memory report to the standard error"
+    with MemoryStats(budget) as stats:
+        try:
+            main(input_, data, output, stats=stats)
+        finally:
+            json.dump(stats.memory_report(), sys.stderr, indent=2)
+            print(file=sys.stderr)
+
+
+def read_records(lines):
+    """Yield the JSON record of each non empty line or the ValueError of the
+    lines which are not valid JSON"""
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except ValueError as exception:
+                yield ValueError("Invalid JSON on line %s: %s"
+                    % (number, exception))
+
+
+def batch(input_, records, output, jobs=None):
+    """Render each record into the output path formatted with its index and
+    fields and return the list of RenderResult.
+
+    The renderings are distributed over jobs processes.
+    The output must contain a replacement field so that each record is
+    rendered into its own file."""
+    if not any(field is not None
+            for _, field, _, _ in string.Formatter().parse(output)):
+        raise ValueError("The output must contain {index} or a field "
+            "of the records")
+
+    def out_factory(index, record):
+        return output.format_map(dict(record, index=index))
+    return get_report(input_).render_many(
+        records, out_factory=out_factory, workers=jobs)
+
+
+def precompile(inputs):
+    "Compile the opendocument templates into the cache directory"
+    if not Template.cache_dir:
+        raise ValueError("A cache directory is required to precompile")
+    for input_ in inputs:
+        with open(input_, 'rb') as fp:
+            Template(fp)
 
 
 def run():
     parser = ArgumentParser()
-    parser.add_argument('-i', '--input', dest='input', required=True)
+    parser.add_argument('-i', '--input', dest='input')
     parser.add_argument('-o', '--output', dest='output')
     parser.add_argument('-d', '--data', dest='data', type=FileType('r'),
         help="JSON file with data to render")
+    parser.add_argument('--batch', dest='batch', type=FileType('r'),
+        help="JSON lines file with one data to render per line, "
+        "the output is formatted with the index and the fields of each line")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+        help="number of processes rendering the batch "
+        "(default: number of CPUs)")
+    parser.add_argument('--cache-dir', dest='cache_dir',
+        help="directory of the compiled opendocument templates")
+    parser.add_argument('--precompile', dest='precompile', nargs='+',
+        metavar='TEMPLATE',
+        help="compile the opendocument templates into the cache directory")
+    parser.add_argument('--memory-report', dest='memory_report',
+        action='store_true',
+        help="trace the memory of each phase of the rendering and print the "
+        "report as JSON to the standard error")
+    parser.add_argument('--memory-budget', dest='memory_budget',
+        type=parse_size, metavar='SIZE',
+        help="abort the rendering when it allocates more than SIZE bytes "
+        "(with an optional K, M or G suffix), implies --memory-report")
 
     args = parser.parse_args()
+    if args.cache_dir:
+        Template.cache_dir = args.cache_dir
+    if args.precompile:
+        if not Template.cache_dir:
+            parser.error("--precompile requires --cache-dir "
+                "or RELATORIO_CACHE_DIR")
+        precompile(args.precompile)
+        if not args.input:
+            return
+    elif not args.input:
+        parser.error("the following arguments are required: -i/--input")
+    if args.batch:
+        if not args.output:
+            parser.error("--batch requires -o/--output")
+        if not any(field is not None
+                for _, field, _, _ in string.Formatter().parse(args.output)):
+            parser.error("--batch requires -o/--output to contain {index} "
+                "or a field of the records")
+        if args.memory_report or args.memory_budget:
+            parser.error("--memory-report and --memory-budget are not "
+                "supported with --batch")
+        results = batch(
+            args.input, read_records(args.batch), args.output, args.jobs)
+        errors = [r for r in results if r.error is not None]
+        for result in errors:
+            print("record %s: %s" % (result.index + 1, result.error),
+                file=sys.stderr)
+        if errors:
+            sys.exit(1)
+        return
     if args.data:
         data = json.load(args.data)
     else:
         data = {}
-    main(args.input, data, args.output)
+    if args.memory_report or args.memory_budget:
+        try:
+            memory_report(args.input, data, args.output, args.memory_budget)
+        except MemoryBudgetExceeded as exception:
+            print(exception, file=sys.stderr)
+            sys.exit(1)
+    else:
+        main(args.input, data, args.output)
 
 
 if __name__ == '__main__':
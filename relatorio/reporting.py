@@ -1,9 +1,25 @@
 # This file is part of relatorio.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import asyncio
+import collections
+import copy
+import ctypes
+import ctypes.util
+import inspect
 import os
+import select
+import struct
 import sys
+import tempfile
+import threading
+import time
+import warnings
+from concurrent.futures import (
+    CancelledError, Future, ProcessPoolExecutor, ThreadPoolExecutor)
 
-from genshi.template import TemplateLoader
+from genshi.template import TemplateLoader, TemplateNotFound
+from genshi.template.base import SUB
+from genshi.template.loader import directory
 
 __metaclass__ = type
 
@@ -36,15 +52,354 @@ def _guess_type(mime):
             return 'text'
 
 
+# estimated memory size of an event of a compiled template
+EVENT_SIZE = 500
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'evictions', 'currsize', 'bytes',
+        'maxbytes', 'rejected'])
+
+
+def stream_size(stream):
+    """returns the estimated memory size of the template stream.
+
+    It is approximate as each event counts for EVENT_SIZE and the directives
+    may add their own data with a memory_size method taking their stream."""
+    size = 0
+    for kind, data, _ in stream:
+        size += EVENT_SIZE
+        if kind is SUB:
+            directives, substream = data
+            size += stream_size(substream)
+            for directive in directives:
+                if hasattr(directive, 'memory_size'):
+                    size += directive.memory_size(substream)
+    return size
+
+
+def template_size(template):
+    """returns the approximate memory size of the template.
+
+    The templates may define it with a memory_size method."""
+    if hasattr(template, 'memory_size'):
+        return template.memory_size()
+    return stream_size(template.stream)
+
+
+class TemplateCache:
+    """A LRU cache of templates bounded by their number and by their
+    estimated memory size.
+
+    The templates larger than max_bytes are rejected without evicting the
+    others and on_evict is called with the key of each evicted template."""
+
+    def __init__(self, capacity, max_bytes=None, on_evict=None):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.rejected = 0
+        self._items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        template, _ = self._items[key]
+        self._items.move_to_end(key)
+        self.hits += 1
+        return template
+
+    def __setitem__(self, key, template):
+        if key in self._items:
+            # the stale template was counted as a hit
+            self.hits -= 1
+            self.bytes -= self._items.pop(key)[1]
+        self.misses += 1
+        size = template_size(template)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.rejected += 1
+            return
+        self._items[key] = template, size
+        self.bytes += size
+        while self._items and (len(self._items) > self.capacity
+                or (self.max_bytes is not None
+                    and self.bytes > self.max_bytes)):
+            evicted, (_, size) = self._items.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+
+# inotify events of the changes of a file or its directory
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+
+
+class InotifyWatcher:
+    """Watches the directories of files with inotify.
+
+    A daemon thread sets the events of a file when it changes until the
+    watcher is closed. It is only available on Linux."""
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+        | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(os.O_CLOEXEC)
+        except AttributeError:
+            raise OSError("inotify is not available")
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self.fd = fd
+        # the pipe waking up the thread to close the watcher
+        self._wakeup = os.pipe()
+        self.pid = os.getpid()
+        self.closed = False
+        # the number of loaders sharing the watcher
+        self.users = 0
+        self._lock = threading.Lock()
+        self._directories = {}
+        self._events = {}
+        self._thread = threading.Thread(
+            target=self._run, name='relatorio-inotify', daemon=True)
+        self._thread.start()
+
+    @property
+    def active(self):
+        "tells if the events are set, the thread does not survive a fork"
+        return not self.closed and self.pid == os.getpid()
+
+    def watch(self, path):
+        "returns a new event set when the file at path changes"
+        directory = os.path.dirname(path)
+        with self._lock:
+            if not self.active:
+                raise OSError("The watcher is closed")
+            if directory not in self._directories.values():
+                wd = self._add_watch(
+                    self.fd, os.fsencode(directory), self.mask)
+                if wd < 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, os.strerror(error), directory)
+                self._directories[wd] = directory
+            event = threading.Event()
+            self._events.setdefault(path, set()).add(event)
+            return event
+
+    def unwatch(self, path, event):
+        "forgets the event of the file at path"
+        with self._lock:
+            events = self._events.get(path, set())
+            events.discard(event)
+            if not events:
+                self._events.pop(path, None)
+
+    def _run(self):
+        header = struct.Struct('iIII')
+        poll = select.poll()
+        poll.register(self.fd, select.POLLIN)
+        poll.register(self._wakeup[0], select.POLLIN)
+        while True:
+            try:
+                ready = {fd for fd, _ in poll.poll()}
+                if self._wakeup[0] in ready:
+                    return
+                data = os.read(self.fd, 64 * 1024)
+            except OSError:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = header.unpack_from(data, offset)
+                offset += header.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                with self._lock:
+                    directory = self._directories.get(wd)
+                    if (mask & IN_Q_OVERFLOW or directory is None
+                            or mask & (IN_DELETE_SELF | IN_MOVE_SELF
+                                | IN_IGNORED)):
+                        # the changes are unknown
+                        if mask & IN_IGNORED:
+                            self._directories.pop(wd, None)
+                        paths = list(self._events)
+                    else:
+                        paths = [os.path.join(directory, os.fsdecode(name))]
+                    for path in paths:
+                        for event in self._events.get(path, ()):
+                            event.set()
+
+    def close(self):
+        "stops the thread and closes the file descriptors"
+        if self.closed:
+            return
+        self.closed = True
+        if self.pid == os.getpid():
+            os.write(self._wakeup[1], b'\0')
+            self._thread.join()
+        for fd in (self.fd,) + self._wakeup:
+            os.close(fd)
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def acquire_watcher():
+    "returns the InotifyWatcher shared by the loaders of the process"
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None or not _watcher.active:
+            if _watcher is not None:
+                # inherited from the parent process
+                _watcher.close()
+            _watcher = InotifyWatcher()
+        _watcher.users += 1
+        return _watcher
+
+
+def release_watcher(watcher):
+    "closes the shared watcher once it is released by all its loaders"
+    global _watcher
+    with _watcher_lock:
+        watcher.users -= 1
+        if watcher.users <= 0:
+            watcher.close()
+            if _watcher is watcher:
+                _watcher = None
+
+
+class Uptodate:
+    """Checks if a loaded template is up to date at most once per ttl seconds
+    or, with the event of an active watcher, only after a change."""
+
+    def __init__(self, uptodate, ttl=0, changed=None, watcher=None):
+        self.uptodate = uptodate
+        self.ttl = ttl
+        self.changed = changed
+        self.watcher = watcher
+        self.checked = time.monotonic()
+
+    def __call__(self):
+        if self.changed is not None and self.watcher.active:
+            if not self.changed.is_set():
+                return True
+            self.changed.clear()
+            result = self.uptodate()
+            if not result:
+                self.changed.set()
+            return result
+        now = time.monotonic()
+        if now - self.checked < self.ttl:
+            return True
+        result = self.uptodate()
+        if result:
+            self.checked = now
+        return result
+
+
+class Revalidations(dict):
+    "The uptodate functions of the loaded templates by cache key"
+
+    def __init__(self, ttl=0, watcher=None):
+        super(Revalidations, self).__init__()
+        self.ttl = ttl
+        self.watcher = watcher
+
+    def __setitem__(self, key, uptodate):
+        self.discard(key)
+        if uptodate is not None:
+            changed = None
+            if self.watcher is not None and os.path.isabs(key):
+                try:
+                    changed = self.watcher.watch(key)
+                except OSError:
+                    pass
+            if changed is not None or self.ttl:
+                uptodate = Uptodate(uptodate, self.ttl, changed, self.watcher)
+        super(Revalidations, self).__setitem__(key, uptodate)
+
+    def discard(self, key):
+        "forgets the uptodate function of key and its watch"
+        uptodate = self.pop(key, None)
+        if getattr(uptodate, 'changed', None) is not None:
+            self.watcher.unwatch(key, uptodate.changed)
+
+    def close(self):
+        "forgets all the uptodate functions and releases the watcher"
+        for key in list(self):
+            self.discard(key)
+        if self.watcher is not None:
+            release_watcher(self.watcher)
+            self.watcher = None
+
+
 class MIMETemplateLoader(TemplateLoader):
     """This subclass of TemplateLoader use mimetypes to search and find
     templates to load.
+
+    The cache keeps max_cache_size templates and, if max_cache_bytes is set,
+    at most their estimated memory size.
+    With auto_reload, the templates are checked at most once per
+    revalidate_ttl seconds or, with inotify on Linux, only after a change of
+    their file. The loaders share the inotify watcher of the process until
+    they are closed.
     """
 
     factories = {}
 
     mime_func = [_guess_type]
 
+    def __init__(self, *args, max_cache_bytes=None, revalidate_ttl=0,
+            inotify=False, **kwargs):
+        super(MIMETemplateLoader, self).__init__(*args, **kwargs)
+        self.max_cache_size = self._cache.capacity
+        self.max_cache_bytes = max_cache_bytes
+        self.revalidate_ttl = revalidate_ttl
+        self.inotify = inotify
+        self._setup_cache()
+
+    def _setup_cache(self):
+        watcher = None
+        if self.inotify:
+            try:
+                watcher = acquire_watcher()
+            except OSError as exception:
+                warnings.warn("Could not watch the templates: %s" % exception)
+        self._uptodate = Revalidations(self.revalidate_ttl, watcher)
+        self._cache = TemplateCache(
+            self.max_cache_size, self.max_cache_bytes,
+            on_evict=self._uptodate.discard)
+
+    def close(self):
+        "clears the cache and releases the inotify watcher"
+        with self._lock:
+            self._cache = TemplateCache(
+                self.max_cache_size, self.max_cache_bytes)
+            self._uptodate.close()
+
+    def cache_info(self):
+        "returns the statistics of the cache"
+        with self._lock:
+            cache = self._cache
+            return CacheInfo(cache.hits, cache.misses, cache.evictions,
+                len(cache), cache.bytes, cache.max_bytes, cache.rejected)
+
     def get_type(self, mime):
         "finds the codename used by relatorio to work on a mimetype"
         for func in reversed(self.mime_func):
@@ -62,6 +417,60 @@ class MIMETemplateLoader(TemplateLoader):
         return super(MIMETemplateLoader, self).load(
             path, cls=cls, relative_to=relative_to)
 
+    def preload(self, path, mime=None, cls=None):
+        """loads the template at path into the cache and returns its compile
+        time in seconds, 0 if it is already loaded.
+
+        The template at an absolute path is compiled without holding the lock
+        of the loader so many templates can be compiled concurrently, the
+        others are loaded with load."""
+        assert mime is not None or cls is not None
+
+        if mime is not None:
+            cls = self.factories[self.get_type(mime)]
+        path = os.path.normpath(path)
+        if not os.path.isabs(path):
+            start = time.perf_counter()
+            self.load(path, cls=cls)
+            return time.perf_counter() - start
+
+        with self._lock:
+            if path in self._cache:
+                uptodate = self._uptodate.get(path)
+                if (not self.auto_reload
+                        or uptodate is not None and uptodate()):
+                    return 0.
+        try:
+            filepath, _, fileobj, uptodate = directory(
+                os.path.dirname(path))(path)
+        except IOError:
+            raise TemplateNotFound(path, [os.path.dirname(path)])
+        try:
+            start = time.perf_counter()
+            template = self._instantiate(cls, fileobj, filepath, filepath)
+            seconds = time.perf_counter() - start
+        finally:
+            fileobj.close()
+        if self.callback:
+            self.callback(template)
+        with self._lock:
+            self._cache[path] = template
+            self._uptodate[path] = uptodate
+        return seconds
+
+    def __getstate__(self):
+        # the loaded templates are not sent to other processes
+        state = self.__dict__.copy()
+        del state['_lock']
+        del state['_cache']
+        del state['_uptodate']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self._lock = threading.RLock()
+        self._setup_cache()
+
     @classmethod
     def add_factory(cls, abbr_mimetype, template_factory, id_function=None):
         """adds a template factory to the already known factories"""
@@ -88,6 +497,273 @@ class DefaultFactory:
 
 default_factory = DefaultFactory()
 
+RenderResult = collections.namedtuple(
+    'RenderResult', ['index', 'result', 'error'])
+WarmResult = collections.namedtuple('WarmResult', ['path', 'seconds', 'error'])
+
+
+def _is_path(out):
+    return isinstance(out, (str, os.PathLike))
+
+
+def render_file(render, output):
+    """Render into a temporary file of the output directory which replaces
+    output only once the rendering succeeded"""
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(output)), suffix='.tmp')
+    try:
+        # like open, the permissions are those allowed by the umask
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        with os.fdopen(fd, 'wb') as fp:
+            render(encoding='utf-8', out=fp)
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _render(report, data, out=None):
+    """renders report with data into out.
+
+    out may be None to get the rendered result, a path or a file."""
+    stream = report(**data)
+    if out is None:
+        return stream.render()
+    if _is_path(out):
+        render_file(stream.render, out)
+    else:
+        stream.render(encoding='utf-8', out=out)
+    return out
+
+
+_worker_report = None
+
+
+def _init_render_worker(report, cache_dir=None):
+    global _worker_report
+    _worker_report = report
+    if cache_dir is not None:
+        # the class attribute is not inherited by the spawned processes
+        loader = report.tmpl_loader
+        loader.factories[loader.get_type(report.mimetype)].cache_dir = (
+            cache_dir)
+
+
+def _render_in_worker(data, out, encode=False):
+    if encode:
+        # files can not be sent to the worker so the encoded result is
+        # written by the caller
+        return _worker_report(**data).render(encoding='utf-8')
+    return _render(_worker_report, data, out)
+
+
+class AsyncSinkWriter:
+    """A file object writing from another thread into an asynchronous sink.
+
+    The sink has either a coroutine write method or a write method and a
+    drain coroutine like asyncio.StreamWriter. The writes are buffered up to
+    chunk_size bytes and each chunk waits for the sink to accept it, flush
+    writes the buffer. Once closed from the event loop, the writes raise
+    RuntimeError."""
+
+    def __init__(self, sink, loop, chunk_size=64 * 1024):
+        self.sink = sink
+        self.loop = loop
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._closed = False
+        self._writing = None
+
+    async def _write(self, data):
+        if self._closed:
+            raise RuntimeError("The asynchronous sink is closed")
+        self._writing = asyncio.current_task()
+        try:
+            result = self.sink.write(data)
+            if inspect.isawaitable(result):
+                await result
+            drain = getattr(self.sink, 'drain', None)
+            if drain is not None:
+                await drain()
+        finally:
+            self._writing = None
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            try:
+                asyncio.run_coroutine_threadsafe(
+                    self._write(data), self.loop).result()
+            except CancelledError:
+                raise RuntimeError("The asynchronous sink is closed")
+
+    def close(self):
+        "stops the writes, it must be called from the event loop"
+        self._closed = True
+        if self._writing is not None:
+            self._writing.cancel()
+
+
+class AsyncIterableBridge:
+    """An iterable over an asynchronous iterable of the running event loop.
+
+    It is iterated once from another thread while at most prefetch items
+    are fetched in advance by a task of the event loop. Once closed from the
+    event loop, the iteration raises RuntimeError."""
+
+    _end = object()
+
+    def __init__(self, aiterable, prefetch=64):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(prefetch)
+        self.task = self.loop.create_task(self._produce(aiterable))
+        self._started = False
+        self._done = False
+        self._closed = False
+        self._getting = None
+
+    async def _produce(self, aiterable):
+        try:
+            async for item in aiterable:
+                await self.queue.put((item, None))
+        except Exception as exception:
+            await self.queue.put((self._end, exception))
+        else:
+            await self.queue.put((self._end, None))
+
+    async def _get(self):
+        if self._closed:
+            raise RuntimeError("The asynchronous iterable is closed")
+        self._getting = asyncio.current_task()
+        try:
+            items = [await self.queue.get()]
+        finally:
+            self._getting = None
+        while not self.queue.empty():
+            items.append(self.queue.get_nowait())
+        return items
+
+    def __iter__(self):
+        if _running_loop() is not None:
+            raise RuntimeError(
+                "Can not iterate in the thread of an event loop")
+        if self._started:
+            raise RuntimeError(
+                "An asynchronous iterable can only be iterated once")
+        self._started = True
+        while not self._done:
+            try:
+                items = asyncio.run_coroutine_threadsafe(
+                    self._get(), self.loop).result()
+            except CancelledError:
+                raise RuntimeError("The asynchronous iterable is closed")
+            for item, exception in items:
+                if item is self._end:
+                    self._done = True
+                    if exception is not None:
+                        raise exception
+                    return
+                yield item
+
+    def close(self):
+        """stops fetching the items and the iteration, it must be called from
+        the event loop"""
+        self._closed = True
+        self.task.cancel()
+        if self._getting is not None:
+            self._getting.cancel()
+
+
+async def render_to_sink(render, sink, bridges=()):
+    """calls render with a file object from the default executor of the
+    running event loop to write into the asynchronous sink.
+
+    The writer and the bridges are closed at the end, also when the
+    coroutine is cancelled so the executor thread is released."""
+    loop = asyncio.get_running_loop()
+    writer = AsyncSinkWriter(sink, loop)
+
+    def run():
+        render(writer)
+        writer.flush()
+    try:
+        await loop.run_in_executor(None, run)
+    finally:
+        writer.close()
+        for bridge in bridges:
+            bridge.close()
+
+
+def _running_loop():
+    "returns the event loop running in the current thread or None"
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def bridge_async_iterables(value, bridges, depth=3, memo=None):
+    """returns value with the asynchronous iterables nested in its dicts,
+    lists, tuples and object attributes up to depth levels replaced by
+    AsyncIterableBridge appended to bridges.
+
+    The containers and objects which contain one are copied."""
+    if hasattr(value, '__aiter__'):
+        bridge = AsyncIterableBridge(value)
+        bridges.append(bridge)
+        return bridge
+    if memo is None:
+        memo = {}
+    if depth <= 0 or isinstance(value, (str, bytes, type)):
+        return value
+    if id(value) in memo:
+        return memo[id(value)]
+    memo[id(value)] = value
+
+    def bridged(item):
+        return bridge_async_iterables(item, bridges, depth - 1, memo)
+    if isinstance(value, dict):
+        items = {k: bridged(v) for k, v in value.items()}
+        if any(items[k] is not value[k] for k in value):
+            result = copy.copy(value)
+            result.update(items)
+            memo[id(value)] = result
+            return result
+    elif isinstance(value, (list, tuple)):
+        items = [bridged(v) for v in value]
+        if any(i is not v for i, v in zip(items, value)):
+            if isinstance(value, list):
+                result = copy.copy(value)
+                result[:] = items
+            elif hasattr(value, '_make'):
+                result = value._make(items)
+            else:
+                result = type(value)(items)
+            memo[id(value)] = result
+            return result
+    elif isinstance(getattr(value, '__dict__', None), dict):
+        attributes = vars(value)
+        changes = {}
+        for name, attribute in attributes.items():
+            item = bridged(attribute)
+            if item is not attribute:
+                changes[name] = item
+        if changes:
+            result = copy.copy(value)
+            vars(result).update(changes)
+            memo[id(value)] = result
+            return result
+    return value
+
 
 class Report:
     """Report is a simple interface on top of a rendering template.
@@ -106,6 +782,101 @@ class Report:
         data = self.data_factory(**kwargs)
         return template.generate(**data).filter(*self.filters)
 
+    async def render_async(self, sink, **kwargs):
+        """renders the report into the asynchronous sink.
+
+        The rendering runs in the default executor of the event loop and the
+        asynchronous iterables of kwargs are iterated with an
+        AsyncIterableBridge.
+        """
+        bridges = []
+        kwargs = bridge_async_iterables(kwargs, bridges)
+
+        def render(out):
+            self(**kwargs).render(encoding='utf-8', out=out)
+        await render_to_sink(render, sink, bridges)
+
+    def render_many(self, datas, out_factory=None, workers=None,
+            mp_context=None):
+        """renders the report for each data of datas.
+
+        out_factory is called with the index and the data of each rendering
+        and returns the path or the file to write into. Without it the
+        rendered results are returned.
+        The renderings are distributed over a pool of worker processes
+        (by default as many as CPUs) started with mp_context, workers=1
+        renders in this process.
+        The template is compiled before the workers are started so they
+        share it when the processes are forked. The compiled templates can
+        not be pickled so the workers started by spawn or forkserver compile
+        it again unless it is stored in the cache_dir of its template class
+        from which they load it.
+
+        The paths are replaced only once their rendering succeeded and an
+        exception in datas, like a record which could not be read, is
+        reported as the error of its rendering.
+
+        Returns a list of RenderResult in the order of datas with either the
+        result or the error raised.
+        """
+        # compile the template once and report template errors early
+        self.tmpl_loader.load(self.fpath, self.mimetype)
+        results = []
+        if workers == 1:
+            for index, data in enumerate(datas):
+                try:
+                    if isinstance(data, Exception):
+                        raise data
+                    out = out_factory(index, data) if out_factory else None
+                    results.append(
+                        RenderResult(index, _render(self, data, out), None))
+                except Exception as error:
+                    results.append(RenderResult(index, None, error))
+            return results
+
+        def collect(index, out, future):
+            try:
+                result = future.result()
+                if out is not None and not _is_path(out):
+                    if hasattr(result, 'getvalue'):
+                        result = result.getvalue()
+                    out.write(result)
+                    result = out
+            except Exception as error:
+                return RenderResult(index, None, error)
+            return RenderResult(index, result, None)
+
+        # limit the pending renderings to bound the memory used
+        max_pending = 4 * (workers or os.cpu_count() or 1)
+        pending = collections.deque()
+        cls = self.tmpl_loader.factories[
+            self.tmpl_loader.get_type(self.mimetype)]
+        with ProcessPoolExecutor(workers, mp_context=mp_context,
+                initializer=_init_render_worker,
+                initargs=(self, getattr(cls, 'cache_dir', None))) as executor:
+            for index, data in enumerate(datas):
+                out = None
+                try:
+                    if isinstance(data, Exception):
+                        raise data
+                    if out_factory:
+                        out = out_factory(index, data)
+                except Exception as error:
+                    future = Future()
+                    future.set_exception(error)
+                else:
+                    if out is None or _is_path(out):
+                        future = executor.submit(_render_in_worker, data, out)
+                    else:
+                        future = executor.submit(
+                            _render_in_worker, data, None, encode=True)
+                pending.append((index, out, future))
+                if len(pending) >= max_pending:
+                    results.append(collect(*pending.popleft()))
+            while pending:
+                results.append(collect(*pending.popleft()))
+        return results
+
     def __repr__(self):
         return '<relatorio report on %s>' % self.fpath
 
@@ -149,6 +920,48 @@ class ReportRepository:
         reports.mimetypes.setdefault(mimetype, []) \
                          .append((report, report_name))
 
+    def warm(self, workers=None):
+        """compiles the templates of all the reports into the cache of their
+        loader.
+
+        The templates are compiled concurrently by a pool of threads (by
+        default the ThreadPoolExecutor default) with the preload method of
+        the loaders which have one.
+        A MIMETemplateLoader keeps only max_cache_size templates (25 by
+        default) so a warning is issued for the loaders with more templates.
+
+        Returns a list of WarmResult with the path and either the compile time
+        in seconds, 0 if already loaded, or the error of each template.
+        """
+        templates = {}
+        for reports in self.classes.values():
+            for report, mimetype, _ in reports.ids.values():
+                templates.setdefault(
+                    (report.tmpl_loader, report.fpath), mimetype)
+        counts = collections.Counter(loader for loader, _ in templates)
+        for loader, count in counts.items():
+            capacity = getattr(loader, 'max_cache_size', None)
+            if capacity is not None and count > capacity:
+                warnings.warn("Only %s of the %s templates are kept in the "
+                    "cache of the loader" % (capacity, count))
+
+        def load(loader, path, mimetype):
+            try:
+                if hasattr(loader, 'preload'):
+                    seconds = loader.preload(path, mimetype)
+                else:
+                    start = time.perf_counter()
+                    loader.load(path, mimetype)
+                    seconds = time.perf_counter() - start
+            except Exception as error:
+                return WarmResult(path, None, error)
+            return WarmResult(path, seconds, None)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(load, loader, path, mimetype)
+                for (loader, path), mimetype in templates.items()]
+            return [f.result() for f in futures]
+
     def by_mime(self, klass, mimetype):
         """gets a list of report related to a class by specifying the mimetype
         """
@@ -0,0 +1,378 @@
+# This file is part of relatorio.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"Timings and counters of the renderings"
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+__all__ = ['RenderStats', 'MemoryStats', 'MemoryBudgetExceeded']
+
+
+def clocks():
+    "returns the current wall and CPU clocks in seconds"
+    return time.perf_counter(), time.thread_time()
+
+
+class RenderStats(object):
+    """Collects the wall and CPU times of the phases of a rendering, of the
+    members of its archive and its counters.
+
+    The phases are:
+
+        - compile: the compilation (or the loading from the cache) of the
+          template, reported by its first rendering only
+        - evaluate: the generation of the events by the template (the
+          expressions and the directives)
+        - images: the images added to the document (nested in evaluate)
+        - serialize: the serialization of the events into XML
+        - deflate: the compression and the writing of the members
+        - copy: the copy of the members unchanged from the template or of
+          the spooled parts into the flat document
+        - deferred: the writing of the files added while the XML parts were
+          written (nested deflate)
+        - render: the whole rendering
+
+    The CPU times are the times of the rendering thread so the deflate of
+    the compression threads is not included.
+
+    The phases and the members are also recorded as events of the Chrome
+    trace event format which can be viewed by Perfetto or about:tracing.
+    It can be subclassed to hook into the phases.
+    """
+
+    def __init__(self):
+        # wall, CPU time and calls by name of phase
+        self.phases = collections.OrderedDict()
+        # wall, CPU time, size and compressed size by path of member
+        self.members = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self.trace_events = []
+
+    def add(self, name, wall, cpu, calls=1):
+        "adds the times to the phase"
+        phase = self.phases.setdefault(
+            name, {'wall': 0., 'cpu': 0., 'calls': 0})
+        phase['wall'] += wall
+        phase['cpu'] += cpu
+        phase['calls'] += calls
+
+    def count(self, name, value=1):
+        "increments the counter"
+        self.counters[name] += value
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        "times the block as the phase and as a trace event"
+        start = clocks()
+        try:
+            yield
+        finally:
+            self.add_span(name, start, **args)
+
+    def add_span(self, name, start, end=None, category='phase', **args):
+        "adds the time between the clocks to the phase and traces it"
+        wall, cpu = (e - s for e, s in zip(end or clocks(), start))
+        if category == 'phase':
+            self.add(name, wall, cpu)
+        self.trace(name, start[0], wall, category=category, **args)
+
+    def add_member(self, path, start, phase=None, **info):
+        """adds the time since the start clocks to the member at path and to
+        the phase"""
+        wall, cpu = (e - s for e, s in zip(clocks(), start))
+        member = self.members.setdefault(path, {
+                'wall': 0., 'cpu': 0., 'size': 0, 'compress_size': 0})
+        member['wall'] += wall
+        member['cpu'] += cpu
+        if phase:
+            self.add(phase, wall, cpu)
+            info['phase'] = phase
+        self.trace(path, start[0], wall, category='member', **info)
+
+    def call(self, name, function, *args):
+        "calls the function adding the time spent to the phase"
+        start_wall, start_cpu = clocks()
+        try:
+            return function(*args)
+        finally:
+            end_wall, end_cpu = clocks()
+            self.add(name, end_wall - start_wall, end_cpu - start_cpu)
+
+    def totals(self, *names):
+        "returns the sums of the wall and CPU times of the phases"
+        phases = [self.phases.get(n, {'wall': 0., 'cpu': 0.}) for n in names]
+        return (sum(p['wall'] for p in phases), sum(p['cpu'] for p in phases))
+
+    def set_sizes(self, path, size, compress_size):
+        "sets the size and the compressed size of the member at path"
+        member = self.members.setdefault(path, {
+                'wall': 0., 'cpu': 0., 'size': 0, 'compress_size': 0})
+        member['size'] = size
+        member['compress_size'] = compress_size
+        self.count('bytes_in', size)
+        self.count('bytes_out', compress_size)
+
+    def trace(self, name, start, duration, category='phase', **args):
+        "adds a complete event to the trace"
+        self.trace_events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': duration * 1e6,
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': args,
+                })
+
+    def timed(self, name, iterable, counter=None):
+        """yields the items of iterable adding the time spent to get them to
+        the phase and their number to the counter"""
+        iterator = iter(iterable)
+        wall = cpu = 0.
+        count = 0
+        try:
+            while True:
+                start_wall, start_cpu = clocks()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    end_wall, end_cpu = clocks()
+                    wall += end_wall - start_wall
+                    cpu += end_cpu - start_cpu
+                count += 1
+                yield item
+        finally:
+            self.add(name, wall, cpu)
+            if counter:
+                self.count(counter, count)
+
+    def counted(self, name, iterable):
+        "yields the items of iterable counting them"
+        counters = self.counters
+        for item in iterable:
+            counters[name] += 1
+            yield item
+
+    @property
+    def compression_ratio(self):
+        "the ratio of the size of the members to their compressed size"
+        if not self.counters['bytes_out']:
+            return None
+        return self.counters['bytes_in'] / self.counters['bytes_out']
+
+    def as_dict(self):
+        "returns the phases, the members and the counters"
+        return {
+            'phases': {k: dict(v) for k, v in self.phases.items()},
+            'members': {k: dict(v) for k, v in self.members.items()},
+            'counters': dict(self.counters),
+            'compression_ratio': self.compression_ratio,
+            }
+
+    def chrome_trace(self):
+        "returns the trace in the Chrome trace event format"
+        return {
+            'traceEvents': list(self.trace_events),
+            'displayTimeUnit': 'ms',
+            'otherData': {'counters': dict(self.counters)},
+            }
+
+    def write_chrome_trace(self, fp):
+        "writes the trace as JSON into the text file fp"
+        json.dump(self.chrome_trace(), fp)
+
+
+class MemoryBudgetExceeded(MemoryError):
+    """Error raised when the memory allocated by a rendering exceeds the
+    budget of its MemoryStats"""
+
+    def __init__(self, phase, size, budget, top=()):
+        self.phase = phase
+        self.size = size
+        self.budget = budget
+        # the tracemalloc statistics of the largest allocations
+        self.top = list(top)
+        message = ("The rendering allocated %s bytes in phase %s which "
+            "exceeds the memory budget of %s bytes" % (size, phase, budget))
+        if self.top:
+            message += '\nLargest allocations:\n' + '\n'.join(
+                str(s) for s in self.top)
+        super(MemoryBudgetExceeded, self).__init__(message)
+
+
+class MemoryStats(RenderStats):
+    """RenderStats which also traces with tracemalloc the memory allocated
+    in each phase and aborts the rendering with MemoryBudgetExceeded as soon
+    as it exceeds budget bytes.
+
+    The memory is sampled when entering and leaving the phases and after each
+    member so the allocations between them are reported to the enclosing
+    phase or to serialize outside of any phase. The budget is not checked
+    when leaving a phase or a rendering which raised an error so the error is
+    not masked. The memory is counted from the start of the tracing which
+    starts with the context manager which also stops it or else at the first
+    phase until the end of the rendering.
+    The tracing slows down the rendering several times."""
+    # the number of frames stored by tracemalloc
+    frames = 1
+    # the number of the largest allocations reported
+    top = 10
+
+    def __init__(self, budget=None):
+        super(MemoryStats, self).__init__()
+        self.budget = budget
+        # peak and retained memory by name of phase
+        self.memory = collections.OrderedDict()
+        self.peak = 0
+        self.snapshot = None
+        self._stack = ['serialize']
+        self._base = self._last = None
+        self._tracing = False
+        # the tracing was started by the first sample of the rendering
+        self._lazy = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        "starts to trace the memory"
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self._tracing = True
+        tracemalloc.reset_peak()
+        self._base = self._last = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        "stops to trace the memory if it was started by start"
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _sample(self, check=True):
+        """reports the memory allocated since the last sample to the phase
+        and checks the budget if check is set"""
+        if self._base is None:
+            self.start()
+            self._lazy = True
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        name = self._stack[-1]
+        memory = self.memory.get(name)
+        if memory is None:
+            memory = self.memory[name] = {'peak': 0, 'retained': 0}
+        peak -= self._base
+        if peak > memory['peak']:
+            memory['peak'] = peak
+            if peak > self.peak:
+                self.peak = peak
+        memory['retained'] += current - self._last
+        self._last = current
+        if check and self.budget is not None and peak > self.budget:
+            raise MemoryBudgetExceeded(name, peak, self.budget,
+                tracemalloc.take_snapshot().statistics('lineno')[:self.top])
+
+    def _stop_lazy(self):
+        "stops the tracing started by the first sample at the end of it"
+        if self._lazy and len(self._stack) == 1:
+            self._lazy = False
+            self._base = self._last = None
+            self.stop()
+
+    def _enter(self, name):
+        self._sample()
+        self._stack.append(name)
+
+    def _leave(self, check=True):
+        try:
+            self._sample(check)
+        finally:
+            if self._stack.pop() == 'render':
+                self._stop_lazy()
+
+    def call(self, name, function, *args):
+        self._enter(name)
+        try:
+            result = super(MemoryStats, self).call(name, function, *args)
+        except BaseException:
+            self._leave(check=False)
+            raise
+        self._leave()
+        return result
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        self._enter(name)
+        try:
+            with super(MemoryStats, self).phase(name, **args):
+                yield
+        except BaseException:
+            self._leave(check=False)
+            raise
+        self._leave()
+
+    def timed(self, name, iterable, counter=None):
+        return super(MemoryStats, self).timed(
+            name, self._traced(name, iterable), counter)
+
+    def _traced(self, name, iterable):
+        "yields the items of iterable reporting their memory to the phase"
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self._leave()
+                return
+            except BaseException:
+                self._leave(check=False)
+                raise
+            self._leave()
+            yield item
+
+    def add_member(self, path, start, phase=None, **info):
+        super(MemoryStats, self).add_member(path, start, phase=phase, **info)
+        self._sample()
+
+    def add_span(self, name, start, end=None, category='phase', **args):
+        super(MemoryStats, self).add_span(
+            name, start, end=end, category=category, **args)
+        if name == 'render':
+            try:
+                # the aborted renderings keep their error
+                self._sample(check=not args.get('aborted'))
+                self.snapshot = tracemalloc.take_snapshot()
+            finally:
+                self._stop_lazy()
+
+    def memory_report(self):
+        """returns the peak and retained memory by phase, the peak of the
+        rendering, the budget and the largest allocations retained at the end
+        of the rendering"""
+        top = []
+        if self.snapshot is not None:
+            top = [str(s)
+                for s in self.snapshot.statistics('lineno')[:self.top]]
+        return {
+            'phases': {k: dict(v) for k, v in self.memory.items()},
+            'peak': self.peak,
+            'budget': self.budget,
+            'deferred_bytes': self.counters['deferred_bytes'],
+            'top': top,
+            }
+
+    def as_dict(self):
+        result = super(MemoryStats, self).as_dict()
+        result['memory'] = self.memory_report()
+        return result
@@ -3,26 +3,48 @@
 import genshi.core
 from genshi.template import MarkupTemplate, NewTextTemplate
 
-from relatorio.reporting import MIMETemplateLoader
+from relatorio.reporting import MIMETemplateLoader, render_to_sink
 
 __metaclass__ = type
 
 
 class RelatorioStream(genshi.core.Stream):
     "Base class for the relatorio streams."
+    # the AsyncIterableBridge of the data closed by render_async
+    bridges = ()
 
-    def render(self, method=None, encoding='utf-8', out=None, **kwargs):
-        "calls the serializer to render the template"
+    def render(self, method=None, encoding='utf-8', out=None, stats=None,
+            **kwargs):
+        """calls the serializer to render the template
+
+        stats is a RenderStats collecting the timings and the counters of the
+        rendering."""
+        if stats is not None:
+            self.serializer.stats = stats
         return self.serializer(
             self.events, method=method, encoding=encoding, out=out)
 
+    async def render_async(self, sink, method=None, encoding='utf-8',
+            **kwargs):
+        """renders the template into the asynchronous sink from the default
+        executor of the event loop"""
+        def render(out):
+            self.render(method, encoding=encoding, out=out, **kwargs)
+        await render_to_sink(render, sink, self.bridges)
+
+    def iter_bytes(self, encoding='utf-8'):
+        "yields the chunks of the rendered template as soon as available"
+        return self.serializer.iter_bytes(self.events, encoding=encoding)
+
     def serialize(self, method='xml', **kwargs):
         "generates the bitstream corresponding to the template"
         return self.render(method, **kwargs)
 
     def __or__(self, function):
         "Support for the bitwise operator"
-        return RelatorioStream(self.events | function, self.serializer)
+        stream = RelatorioStream(self.events | function, self.serializer)
+        stream.bridges = self.bridges
+        return stream
 
 
 MIMETemplateLoader.add_factory('text', NewTextTemplate)
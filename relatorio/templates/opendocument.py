@@ -1,5 +1,7 @@
 # This file is part of relatorio.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import ast
+import copy
 import re
 
 try:
@@ -9,28 +11,47 @@ except ImportError:
     from md5 import md5
 
 import base64
+import collections
 import datetime
+import fnmatch
+import hashlib
 import mimetypes
+import numbers
+import os
+import pickle
+import shutil
+import struct
 import sys
+import tempfile
+import threading
 import time
 import urllib.parse
 import warnings
 import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 from decimal import Decimal
 from io import BytesIO
 
 import genshi
 import genshi.output
+import genshi.template.eval
+import genshi.util
 import lxml.etree
 from genshi.core import Stream
-from genshi.filters import Transformer
-from genshi.filters.transform import ENTER, EXIT
 from genshi.template import MarkupTemplate
+from genshi.template.astutil import ASTCodeGenerator, ASTTransformer
+from genshi.template.base import EXPR, SUB, _apply_directives, _eval_expr
+from genshi.template.directives import AttrsDirective, ForDirective
+from genshi.template.eval import BUILTINS, UNDEFINED, ExpressionASTTransformer
 from genshi.template.interpolation import PREFIX
 
 import relatorio
-from relatorio.reporting import MIMETemplateLoader, Report
+from relatorio.reporting import (
+    MIMETemplateLoader, Report, _running_loop, bridge_async_iterables,
+    stream_size)
+from relatorio.stats import clocks
 from relatorio.templates.base import RelatorioStream
 
 __metaclass__ = type
@@ -63,6 +84,21 @@ EtreeElement = lxml.etree.Element
 XML_INVALID_CHAR_EXPR = re.compile(
     # from https://www.w3.org/TR/REC-xml/#charsets
     '[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
+# Increase when the compiled form of the templates changes
+CACHE_FORMAT = 6
+PRECEDING_SIBLINGS_XPATH = lxml.etree.XPath('count(preceding-sibling::*)')
+LENGTH_EXPR = re.compile(
+    r'^\s*([0-9]*\.?[0-9]+)\s*(cm|mm|in|inch|pt|pc|px)\s*$')
+# number of inches per unit of length
+LENGTH_UNITS = {
+    'cm': 1 / 2.54,
+    'mm': 1 / 25.4,
+    'in': 1,
+    'inch': 1,
+    'pt': 1 / 72,
+    'pc': 1 / 6,
+    'px': 1 / 96,
+    }
 
 # A note regarding OpenDocument namespaces:
 #
@@ -91,12 +127,48 @@ class OOTemplateError(genshi.template.base.TemplateSyntaxError):
 class ImageHref:
     "A class used to add images in the odf zipfile"
 
-    def __init__(self, serializer, context):
+    def __init__(self, serializer, context, dpi=None):
         self.serializer = serializer
         self.context = context.copy()
+        self.dpi = dpi
+        # the bitstream is kept to prevent the reuse of its id
+        self._paths = {}
 
-    def __call__(self, expr):
+    def __call__(self, expr, width=None, height=None):
         bitstream, mimetype = expr[:2]
+        size = None
+        if self.dpi:
+            # expr could override the dimension like for ImageDimension
+            if len(expr) >= 4:
+                width, height = (
+                    i or j for i, j in zip(expr[2:4], [width, height]))
+            size = (length_to_pixels(width, self.dpi),
+                length_to_pixels(height, self.dpi))
+        # bytes can not change and reports are always rendered with the same
+        # context so their path is computed once
+        if isinstance(bitstream, (bytes, Report)):
+            key = (id(bitstream), mimetype, size)
+            if key not in self._paths:
+                self._paths[key] = (
+                    bitstream, self.add(bitstream, mimetype, size))
+            path = self._paths[key][1]
+        else:
+            path = self.add(bitstream, mimetype, size)
+        return {'{http://www.w3.org/1999/xlink}href': path}
+
+    def add(self, bitstream, mimetype, size=None):
+        """adds the bitstream to the serializer and returns its path.
+
+        The image is downsampled to size in pixels if it is larger."""
+        stats = self.serializer.stats
+        if stats is None:
+            return self._add(bitstream, mimetype, size)
+        with stats.phase('images', mimetype=mimetype):
+            path = self._add(bitstream, mimetype, size)
+        stats.count('images')
+        return path
+
+    def _add(self, bitstream, mimetype, size=None):
         if isinstance(bitstream, Report):
             bitstream = bitstream(**self.context).render()
         elif not hasattr(bitstream, 'seek') or not hasattr(bitstream, 'read'):
@@ -106,11 +178,115 @@ class ImageHref:
             file_content = bitstream.read()
         else:
             file_content = b''
+        if size and any(size):
+            file_content = downsample_image(file_content, *size)
         name = md5(file_content).hexdigest()
         path = 'Pictures/%s%s' % (
             name, mimetypes.guess_extension(mimetype or '') or '')
         self.serializer.add_file(path, file_content, mimetype)
-        return {'{http://www.w3.org/1999/xlink}href': path}
+        return path
+
+
+def length_to_pixels(length, dpi):
+    "returns the number of pixels of the ODF length at dpi or None"
+    match = LENGTH_EXPR.match(length or '')
+    if not match:
+        return None
+    value, unit = match.groups()
+    return max(1, int(round(float(value) * LENGTH_UNITS[unit] * dpi)))
+
+
+class _LRUCache(object):
+    "A thread safe mapping keeping the maxsize last used items"
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+
+# downsampled images by content digest and size
+_downsampled_images = _LRUCache(128)
+
+
+def downsample_image(content, width=None, height=None):
+    """returns the image content resized to fit into width x height pixels.
+
+    The content is returned unchanged if it is not larger, if Pillow is
+    missing, can not read or write it or if the result would not be
+    smaller."""
+    key = (hashlib.sha1(content).digest(), width, height)
+    downsampled = _downsampled_images.get(key)
+    if downsampled is None:
+        downsampled = _downsample_image(content, width, height)
+        _downsampled_images.set(key, downsampled)
+    return downsampled
+
+
+_pil_missing_warned = False
+
+
+def _downsample_image(content, width, height):
+    global _pil_missing_warned
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        if not _pil_missing_warned:
+            _pil_missing_warned = True
+            warnings.warn("Pillow is required to downsample the images")
+        return content
+    try:
+        image = Image.open(BytesIO(content))
+        format_ = image.format
+        if getattr(image, 'n_frames', 1) > 1:
+            # animations are kept
+            return content
+        # the image is displayed with its EXIF orientation
+        rotated = image.getexif().get(0x0112, 1) in {5, 6, 7, 8}
+        image_width, image_height = image.size
+        if rotated:
+            image_width, image_height = image_height, image_width
+        ratio = min(r for r in [
+                width / image_width if width else None,
+                height / image_height if height else None] if r)
+        if ratio >= 1:
+            return content
+        size = (max(1, round(image_width * ratio)),
+            max(1, round(image_height * ratio)))
+        # decode JPEG only at the needed resolution
+        image.draft(image.mode, size[::-1] if rotated else size)
+        image = ImageOps.exif_transpose(image).resize(size, Image.LANCZOS)
+        options = {}
+        if format_ == 'JPEG':
+            options = {'quality': 85, 'optimize': True}
+        elif format_ == 'PNG':
+            options = {'optimize': True}
+        output = BytesIO()
+        image.save(output, format_, **options)
+    except Image.UnidentifiedImageError:
+        return content
+    except (OSError, ValueError, KeyError) as exception:
+        # KeyError is raised to save a format Pillow can only read
+        warnings.warn("Could not downsample image: %s" % exception)
+        return content
+    downsampled = output.getvalue()
+    if len(downsampled) >= len(content):
+        return content
+    return downsampled
 
 
 class ImageDimension:
@@ -165,6 +341,225 @@ class ExpressionCache:
         return self.cache[expression_id]
 
 
+def encode_boolean(value):
+    return 'boolean', str(value).lower()
+
+
+def encode_date(value):
+    return 'date', value.isoformat()
+
+
+def encode_number(value):
+    return 'float', value
+
+
+def encode_integral(value):
+    return 'float', int(value)
+
+
+def encode_real(value):
+    return 'float', float(value)
+
+
+def encode_string(value):
+    return 'string', escape_xml_invalid_chars(value)
+
+
+def encode_timedelta(value):
+    return 'time', 'P%sD%sS' % (value.days, value.seconds)
+
+
+def encode_time(value):
+    seconds = '%02d' % value.second
+    if value.microsecond:
+        seconds += ('.%06d' % value.microsecond).rstrip('0')
+    return 'time', 'PT%02dH%02dM%sS' % (value.hour, value.minute, seconds)
+
+
+class CellValue(str):
+    "The text of a cell value formatted with its office value type"
+    __slots__ = ()
+    value_type = 'string'
+
+
+# the classes of the cell values by office value type
+CELL_VALUES = {
+    t: type('CellValue', (CellValue,), {'__slots__': (), 'value_type': t})
+    for t in ['boolean', 'date', 'float', 'string', 'time']}
+
+
+def encode_cell_value(value):
+    if value.value_type == 'boolean':
+        return 'boolean', value.lower()
+    return value.value_type, value
+
+
+class ColumnarRows:
+    """Rows of a table given by columns.
+
+    The NumPy columns are formatted at once into CellValue with the text of
+    their scalars and their missing values are None, the other columns are
+    kept as is. The expressions of the cells are still evaluated for each
+    row, only the formatting and the lookup of the encoders are saved.
+    The rows are named tuples of the values when names are given."""
+
+    def __init__(self, columns, names=None):
+        columns = [format_column(c) for c in columns]
+        if len({len(c) for c in columns}) > 1:
+            raise ValueError("The columns must have the same length")
+        self.columns = columns
+        self.names = names
+        if names is not None:
+            self.row = collections.namedtuple('Row', names, rename=True)._make
+        else:
+            self.row = tuple
+
+    @classmethod
+    def from_dataframe(cls, dataframe):
+        "returns the rows of the pandas dataframe"
+        return cls(
+            [dataframe[n].to_numpy() for n in dataframe.columns],
+            [str(n) for n in dataframe.columns])
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __iter__(self):
+        return map(self.row, zip(*self.columns))
+
+
+def format_column(column):
+    """returns the column formatted as CellValue if it is a NumPy array of
+    booleans, numbers, dates or strings"""
+    kind = getattr(getattr(column, 'dtype', None), 'kind', None)
+    if kind not in {'b', 'i', 'u', 'f', 'M', 'U'}:
+        return column
+    import numpy
+    if kind == 'b':
+        texts = numpy.where(column, 'True', 'False')
+        missing = None
+    elif kind == 'M':
+        texts = numpy.datetime_as_string(column, unit='auto')
+        missing = numpy.isnat(column)
+    elif kind == 'U':
+        texts = column
+        missing = None
+    else:
+        texts = column.astype(str)
+        missing = numpy.isnan(column) if kind == 'f' else None
+    cell_value = CELL_VALUES[{
+                'b': 'boolean', 'M': 'date', 'U': 'string',
+                }.get(kind, 'float')]
+    texts = texts.tolist()
+    if kind == 'U':
+        texts = [escape_xml_invalid_chars(t) for t in texts]
+    values = list(map(cell_value, texts))
+    if missing is not None and missing.any():
+        for index in numpy.flatnonzero(missing).tolist():
+            values[index] = None
+    return values
+
+
+class CellEncoders:
+    """A registry of the encoders of the cell values by type.
+
+    An encoder takes the value and returns its office value type and its
+    attribute value, the encoders of currencies may return the currency code
+    as third item. The value attributes of the other types are cleared but
+    the currency of the cell is kept unless the encoder returns one.
+    The encoder of a type is the one registered for the first class of its
+    MRO or else for the last registered abstract base class, the values
+    without encoder are void.
+    The NumPy numbers are registered as numbers.Number but not numpy.bool_
+    so it is encoded as boolean when NumPy is imported."""
+
+    defaults = {
+        CellValue: encode_cell_value,
+        bool: encode_boolean,
+        datetime.date: encode_date,
+        int: encode_number,
+        float: encode_number,
+        Decimal: encode_number,
+        str: encode_string,
+        datetime.timedelta: encode_timedelta,
+        datetime.time: encode_time,
+        numbers.Integral: encode_integral,
+        numbers.Real: encode_real,
+        }
+    value_attributes = {
+        'boolean': 'boolean-value',
+        'currency': 'value',
+        'date': 'date-value',
+        'float': 'value',
+        'percentage': 'value',
+        'string': 'string-value',
+        'time': 'time-value',
+        'void': 'value',
+        }
+
+    def __init__(self, namespaces, encoders=None):
+        office = namespaces['office']
+        self.currency = '{%s}currency' % office
+        value_types = ['{%s}value-type' % office]
+        if 'calcext' in namespaces:
+            value_types.append('{%s}value-type' % namespaces['calcext'])
+        self.attributes = {}
+        empty = dict.fromkeys(
+            '{%s}%s' % (office, a) for a in self.value_attributes.values())
+        for type_, attribute in self.value_attributes.items():
+            attrs = empty.copy()
+            attrs.update(dict.fromkeys(value_types, type_))
+            self.attributes[type_] = attrs, '{%s}%s' % (office, attribute)
+        self.encoders = dict(self.defaults)
+        if encoders:
+            self.encoders.update(encoders)
+        self._cache = {}
+
+    def register(self, type_, encoder):
+        "registers the encoder of the values of type_"
+        self.encoders.pop(type_, None)
+        self.encoders[type_] = encoder
+        self._cache.clear()
+
+    def lookup(self, cls):
+        "returns the encoder of the values of class cls or None"
+        try:
+            return self._cache[cls]
+        except KeyError:
+            pass
+        for base in cls.__mro__:
+            if base in self.encoders:
+                encoder = self.encoders[base]
+                break
+        else:
+            encoder = None
+            for type_, type_encoder in reversed(self.encoders.items()):
+                if issubclass(cls, type_):
+                    encoder = type_encoder
+                    break
+            else:
+                numpy = sys.modules.get('numpy')
+                if numpy is not None and issubclass(cls, numpy.bool_):
+                    encoder = encode_boolean
+        self._cache[cls] = encoder
+        return encoder
+
+    def __call__(self, value):
+        "returns the attributes of the cell of value"
+        encoder = self.lookup(value.__class__)
+        if encoder is None:
+            type_, value, currency = 'void', None, None
+        else:
+            type_, value, *currency = encoder(value)
+            currency = currency[0] if currency else None
+        attrs, attribute = self.attributes[type_]
+        attrs = attrs.copy()
+        attrs[attribute] = value
+        if currency is not None:
+            attrs[self.currency] = currency
+        return attrs
+
+
 def wrap_nodes_between(first, last, new_parent):
     """An helper function to move all nodes between two nodes to a new node
     and add that new node to their former parent. The boundary nodes are
@@ -209,6 +604,13 @@ def remove_node_keeping_tail(node):
     parent.remove(node)
 
 
+def is_attached(node, root):
+    "Test if node is still a descendant of root"
+    for ancestor in node.iterancestors():
+        node = ancestor
+    return node is root
+
+
 def update_py_attrs(node, value):
     """An helper function to update py_attrs of a node.
     """
@@ -231,7 +633,527 @@ def escape_xml_invalid_chars(value, repl=' '):
         return value
 
 
+# Row skeleton operations
+LITERAL, SLOT_EXPR, SLOT_START = range(3)
+# Event kind which ends the text of a pre-serialized row so the serializer
+# filters do not accumulate all the rows
+ROW_END = genshi.core.StreamEventKind('RELATORIO_ROW_END')
+
+
+class RowSkeleton:
+    """A pre-serialized table row with slots for the values of its
+    expressions and of its py:attrs.
+
+    The operations are tuples of:
+        - LITERAL, markup, markup after an open start tag, ends open
+        - SLOT_EXPR, expression
+        - SLOT_START, start tag, static attributes, attribute expressions
+    """
+
+    def __init__(self, operations, prefixes):
+        self.operations = operations
+        self.prefixes = prefixes
+        self.names = {}
+        self.head = self.tail = ''
+
+    @classmethod
+    def compile(cls, stream, directives, prefixes, row_tag, table_tag):
+        "returns the skeleton of the rows or None if they are not simple"
+        events = []
+        if not _row_events(stream, directives, events):
+            return None
+        depth = 0
+        for kind, data, _ in events:
+            if kind == 'start':
+                if data[0] == table_tag or (not depth and data[0] != row_tag):
+                    return None
+                depth += 1
+            elif kind == 'end':
+                depth -= 1
+        skeleton = cls([], prefixes)
+        # the texts around the rows are emitted as text events to be joined
+        # with the texts of the previous and next rows by the serializer
+        while events and events[0][0] == 'text':
+            skeleton.head += events.pop(0)[1]
+        while events and events[-1][0] == 'text':
+            skeleton.tail = events.pop()[1] + skeleton.tail
+        static = []
+        for event in events + [(None, None, None)]:
+            kind, data, _ = event
+            if kind in {'start', 'end', 'text'} and not (
+                    kind == 'start' and data[2]):
+                static.append(event)
+                continue
+            if static:
+                operation = skeleton._literal(static)
+                if operation is None:
+                    return None
+                skeleton.operations.append(operation)
+                static = []
+            if kind == 'expr':
+                skeleton.operations.append((SLOT_EXPR, data, None, None))
+            elif kind == 'start':
+                tag, attrs, exprs = data
+                tag = skeleton.name(tag)
+                if tag is None:
+                    return None
+                skeleton.operations.append(
+                    (SLOT_START, '<' + tag, attrs, exprs))
+        return skeleton
+
+    def memory_size(self):
+        "returns the estimated memory size of the skeleton"
+        size = sys.getsizeof(self.head) + sys.getsizeof(self.tail)
+        for operation in self.operations:
+            size += sys.getsizeof(operation) + sum(
+                sys.getsizeof(o) for o in operation if isinstance(o, str))
+        return size
+
+    def name(self, qname):
+        "returns the prefixed name of the qname or None if it is unknown"
+        try:
+            return self.names[qname]
+        except KeyError:
+            pass
+        qname = genshi.core.QName(qname)
+        if not qname.namespace:
+            name = qname.localname
+        elif qname.namespace in self.prefixes:
+            name = '%s:%s' % (
+                self.prefixes[qname.namespace], qname.localname)
+        else:
+            return None
+        self.names[qname] = name
+        return name
+
+    def _attributes(self, attrs):
+        markup = []
+        for name, value in attrs:
+            name = self.name(name)
+            if name is None:
+                return None
+            if not isinstance(value, genshi.core.Markup):
+                value = value.replace('&', '&amp;').replace('<', '&lt;')\
+                    .replace('>', '&gt;').replace('"', '&#34;')
+            markup.append(' %s="%s"' % (name, value))
+        return ''.join(markup)
+
+    def _literal(self, events):
+        "returns the literal operation serializing the static events"
+        variants = []
+        for opened in [False, True]:
+            markup = []
+            for kind, data, _ in events:
+                if kind == 'end':
+                    if opened:
+                        markup.append('/>')
+                    else:
+                        markup.append('</%s>' % self.name(data))
+                    opened = False
+                    continue
+                if opened:
+                    markup.append('>')
+                if kind == 'start':
+                    tag, attrs = self.name(data[0]), self._attributes(data[1])
+                    if tag is None or attrs is None:
+                        return None
+                    markup.append('<%s%s' % (tag, attrs))
+                    opened = True
+                else:
+                    markup.append(genshi.core.escape(data, quotes=False))
+                    opened = False
+            variants.append(''.join(markup))
+        return (LITERAL, variants[0], variants[1], events[-1][0] == 'start')
+
+    def render(self, ctxt, vars):
+        "returns the markup of the row or None if a value is not supported"
+        markup = []
+        append = markup.append
+        opened = False
+        for operation, first, second, third in self.operations:
+            if operation is LITERAL:
+                append(second if opened else first)
+                opened = third
+            elif operation is SLOT_EXPR:
+                value = _eval_expr(first, ctxt, vars)
+                if value is None:
+                    continue
+                value = row_text(value)
+                if value is None:
+                    return None
+                if opened:
+                    append('>')
+                append(value)
+                opened = False
+            else:
+                attrs = dict(second)
+                for expr in third:
+                    values = _eval_expr(expr, ctxt, vars)
+                    if values and not merge_attributes(attrs, values):
+                        return None
+                attrs = self._attributes(attrs.items())
+                if attrs is None:
+                    return None
+                if opened:
+                    append('>')
+                append(first)
+                append(attrs)
+                opened = True
+        return genshi.core.Markup(''.join(markup))
+
+    def function(self, target, lookup):
+        """returns the Python function rendering the row and the names of its
+        arguments or None if the expressions are not supported.
+
+        The function takes the item of the loop, assigned to the target node,
+        followed
+        by the values of the names, it returns the markup or None like render.
+        """
+        transformer = _RowExpressionTransformer()
+        lines = []
+        try:
+            lines.extend(_assignment_lines(target, '_row_item'))
+        except ValueError:
+            return None
+        lines.append('_row_markup = []')
+        lines.append('_row_append = _row_markup.append')
+        opened = False
+        for operation, first, second, third in self.operations:
+            if operation is LITERAL:
+                if opened is None:
+                    lines.append('_row_append(%r if _row_open else %r)'
+                        % (second, first))
+                else:
+                    lines.append('_row_append(%r)'
+                        % (second if opened else first))
+                opened = third
+            elif operation is SLOT_EXPR:
+                if opened is not None:
+                    lines.append('_row_open = %r' % opened)
+                lines.append('_row_value = %s' % transformer.code(first))
+                lines.extend([
+                    'if _row_value is not None:',
+                    '    if _row_value.__class__ in _row_strings:',
+                    "        _row_value = _row_value.replace('&', '&amp;')"
+                    ".replace('<', '&lt;').replace('>', '&gt;')",
+                    '    else:',
+                    '        _row_value = _row_text(_row_value)',
+                    '        if _row_value is None:',
+                    '            return None',
+                    '    if _row_open:',
+                    "        _row_append('>')",
+                    '    _row_append(_row_value)',
+                    '    _row_open = False',
+                    ])
+                opened = None
+            else:
+                lines.append('_row_attrs = %r'
+                    % {str(n): v for n, v in second})
+                for expr in third:
+                    lines.append('_row_value = %s' % transformer.code(expr))
+                    lines.append('if _row_value and not '
+                        '_row_merge(_row_attrs, _row_value):')
+                    lines.append('    return None')
+                lines.append(
+                    '_row_value = _row_attributes(_row_attrs.items())')
+                lines.append('if _row_value is None:')
+                lines.append('    return None')
+                if opened is None:
+                    lines.append("_row_append(('>' if _row_open else '') "
+                        "+ %r + _row_value)" % first)
+                else:
+                    lines.append('_row_append(%r + _row_value)'
+                        % (('>' if opened else '') + first))
+                opened = True
+        lines.append("return ''.join(_row_markup)")
+
+        targets = _assignment_names(target)
+        names = sorted(transformer.names - targets)
+        if any(n.startswith('_row_') or n in {'_lookup_attr', '_lookup_item'}
+                for n in targets | transformer.names):
+            return None
+        source = 'def _row(%s):\n%s\n' % (
+            ', '.join(['_row_item'] + names),
+            '\n'.join('    ' + line for line in lines))
+        namespace = {
+            '_lookup_attr': lookup.lookup_attr,
+            '_lookup_item': lookup.lookup_item,
+            '_row_strings': {str, *CELL_VALUES.values()},
+            '_row_text': row_text,
+            '_row_merge': merge_attributes,
+            '_row_attributes': self._attributes,
+            }
+        exec(compile(source, '<relatorio row>', 'exec'), namespace)
+        return namespace['_row'], names
+
+
+def row_text(value):
+    """returns the escaped text of the value like the genshi serializer or
+    None if the value is a stream"""
+    if isinstance(value, genshi.core.Markup):
+        return value
+    elif isinstance(value, str):
+        pass
+    elif isinstance(value, (int, float)):
+        value = str(value)
+    elif hasattr(value, '__iter__'):
+        return None
+    else:
+        value = str(value)
+    return value.replace('&', '&amp;').replace('<', '&lt;')\
+        .replace('>', '&gt;')
+
+
+def merge_attributes(attrs, values):
+    """updates attrs with the values like the genshi py:attrs directive.
+
+    Returns False if values is a stream."""
+    if isinstance(values, Stream):
+        return False
+    elif not isinstance(values, list):
+        values = values.items()
+    for name, value in values:
+        value = value is not None and str(value).strip()
+        if value:
+            attrs[name] = value
+        else:
+            attrs.pop(name, None)
+    return True
+
+
+class _RowExpressionTransformer(ExpressionASTTransformer):
+    """Transforms the expressions into Python code which reads the names from
+    the local variables.
+
+    The subscripts by constants which are not strings are kept because genshi
+    looks them up only as items."""
+
+    def __init__(self):
+        super(_RowExpressionTransformer, self).__init__()
+        self.names = set()
+
+    def code(self, expr):
+        tree = self.visit(genshi.template.eval._parse(expr.source, 'eval'))
+        return '(%s)' % ASTCodeGenerator(tree).code
+
+    def visit_Name(self, node):
+        if (isinstance(node.ctx, ast.Load)
+                and node.id not in genshi.util.flatten(self.locals)):
+            self.names.add(node.id)
+            return node
+        return super(_RowExpressionTransformer, self).visit_Name(node)
+
+    def visit_Subscript(self, node):
+        if (isinstance(node.ctx, ast.Load)
+                and isinstance(node.slice, ast.Constant)
+                and not isinstance(node.slice.value, str)):
+            return ASTTransformer.visit_Subscript(self, node)
+        return super(_RowExpressionTransformer, self).visit_Subscript(node)
+
+
+def _assignment_names(node):
+    "returns the names assigned by the target node of a for loop"
+    if isinstance(node, ast.Tuple):
+        return set().union(*(_assignment_names(e) for e in node.elts))
+    return {node.id}
+
+
+def _assignment_lines(node, value):
+    """returns the lines assigning value to the target node of a for loop
+    like genshi does"""
+    if isinstance(node, ast.Tuple):
+        lines = []
+        for index, element in enumerate(node.elts):
+            lines.extend(
+                _assignment_lines(element, '%s[%d]' % (value, index)))
+        return lines
+    elif isinstance(node, ast.Name):
+        return ['%s = %s' % (node.id, value)]
+    raise ValueError('Unsupported target')
+
+
+def _row_events(stream, directives, events):
+    """appends the events of the stream to events as simple events.
+
+    The attribute expressions of the directives are applied to the first
+    start tag. Returns False if the stream is not simple."""
+    exprs = []
+    for directive in directives:
+        if type(directive) is not AttrsDirective:
+            return False
+        exprs.append(directive.expr)
+    for kind, data, pos in stream:
+        if exprs and kind is not genshi.core.START:
+            return False
+        if kind is SUB:
+            if not _row_events(data[1], data[0], events):
+                return False
+        elif kind is genshi.core.START:
+            tag, attrs = data
+            if any(not isinstance(v, str) for _, v in attrs):
+                # interpolated attribute
+                return False
+            events.append(('start', (tag, attrs, exprs), pos))
+            exprs = []
+        elif kind is genshi.core.END:
+            events.append(('end', data, pos))
+        elif kind is genshi.core.TEXT:
+            events.append(('text', data, pos))
+        elif kind is EXPR:
+            events.append(('expr', data, pos))
+        else:
+            return False
+    return not exprs
+
+
+class RowForDirective(ForDirective):
+    """A py:for directive which renders the iterations over simple table rows
+    from a pre-serialized skeleton when __relatorio_fast_rows is set.
+
+    The rows are simple if they contain only text, expressions and py:attrs.
+    An iteration falls back to the genshi rendering when an expression returns
+    a stream.
+    When __relatorio_codegen is set, the skeleton is compiled into a Python
+    function which evaluates the expressions with the names as local
+    variables."""
+    __slots__ = ['prefixes', 'row_tag', 'table_tag', 'target', 'skeleton',
+        'function']
+
+    def __init__(self, value, template, namespaces=None, lineno=-1,
+            offset=-1):
+        super(RowForDirective, self).__init__(
+            value, template, namespaces, lineno, offset)
+        template_namespaces = getattr(template, 'namespaces', {})
+        uris = collections.Counter(template_namespaces.values())
+        # prefixes used by the serializer for the unambiguous namespaces
+        self.prefixes = {
+            u: p for p, u in template_namespaces.items()
+            if p and uris[u] == 1}
+        self.prefixes[genshi.core.XML_NAMESPACE.uri] = 'xml'
+        self.row_tag = '{%s}table-row' % template_namespaces.get('table')
+        self.table_tag = '{%s}table' % template_namespaces.get('table')
+        self.target = genshi.template.eval._parse(
+            value.split(' in ', 1)[0], 'exec').body[0].value
+        self.skeleton = None
+        self.function = None
+
+    def memory_size(self, stream):
+        """returns the estimated memory size of the skeleton, before its
+        compilation it is a fifth of the size of the events of the rows"""
+        if self.skeleton is None:
+            return stream_size(stream) // 5
+        return self.skeleton.memory_size() if self.skeleton else 0
+
+    def __call__(self, stream, directives, ctxt, **vars):
+        codegen = ctxt.get('__relatorio_codegen')
+        if not codegen and not ctxt.get('__relatorio_fast_rows'):
+            return self._rows(stream, directives, ctxt, vars)
+        stream = list(stream)
+        if self.skeleton is None:
+            self.skeleton = RowSkeleton.compile(
+                stream, directives, self.prefixes,
+                self.row_tag, self.table_tag) or False
+        if not self.skeleton:
+            return self._rows(stream, directives, ctxt, vars)
+        if codegen and not vars:
+            if self.function is None:
+                self.function = self.skeleton.function(
+                    self.target, self.expr._globals.__self__) or False
+            if self.function:
+                function, names = self.function
+                args = []
+                for name in names:
+                    value = ctxt.get(name, UNDEFINED)
+                    if value is UNDEFINED:
+                        value = BUILTINS.get(name, UNDEFINED)
+                    if value is UNDEFINED:
+                        break
+                    args.append(value)
+                else:
+                    return self._function_rows(
+                        function, args, stream, directives, ctxt, vars)
+        return self._fast_rows(stream, directives, ctxt, vars)
+
+    def _iterable(self, ctxt, vars):
+        "returns the iterable counting the iterations into the stats"
+        iterable = _eval_expr(self.expr, ctxt, vars)
+        stats = getattr(ctxt.get('__relatorio_serializer'), 'stats', None)
+        if iterable is not None and stats is not None:
+            iterable = stats.counted('loop_iterations', iterable)
+        return iterable
+
+    def _rows(self, stream, directives, ctxt, vars):
+        "renders the iterations like ForDirective"
+        iterable = self._iterable(ctxt, vars)
+        if iterable is None:
+            return
+
+        assign = self.assign
+        scope = {}
+        stream = list(stream)
+        for item in iterable:
+            assign(scope, item)
+            ctxt.push(scope)
+            for event in _apply_directives(stream, directives, ctxt, vars):
+                yield event
+            ctxt.pop()
+
+    def _fast_rows(self, stream, directives, ctxt, vars):
+        iterable = self._iterable(ctxt, vars)
+        if iterable is None:
+            return
+
+        assign = self.assign
+        skeleton = self.skeleton
+        scope = {}
+        pos = stream[0][2]
+        for item in iterable:
+            assign(scope, item)
+            ctxt.push(scope)
+            row = skeleton.render(ctxt, vars)
+            if row is None:
+                for event in _apply_directives(stream, directives, ctxt, vars):
+                    yield event
+            else:
+                for event in self._row_events(row, pos):
+                    yield event
+            ctxt.pop()
+
+    def _function_rows(self, function, args, stream, directives, ctxt, vars):
+        iterable = self._iterable(ctxt, vars)
+        if iterable is None:
+            return
+
+        Markup = genshi.core.Markup
+        assign = self.assign
+        scope = {}
+        pos = stream[0][2]
+        for item in iterable:
+            row = function(item, *args)
+            if row is None:
+                assign(scope, item)
+                ctxt.push(scope)
+                for event in _apply_directives(stream, directives, ctxt, vars):
+                    yield event
+                ctxt.pop()
+            else:
+                for event in self._row_events(Markup(row), pos):
+                    yield event
+
+    def _row_events(self, row, pos):
+        head, tail = self.skeleton.head, self.skeleton.tail
+        if head:
+            yield genshi.core.TEXT, head, pos
+        yield genshi.core.TEXT, row, pos
+        yield ROW_END, None, pos
+        if tail:
+            yield genshi.core.TEXT, tail, pos
+
+
 class Template(MarkupTemplate):
+    directives = [
+        (name, RowForDirective if name == 'for' else directive)
+        for name, directive in MarkupTemplate.directives]
 
     def __init__(self, source, filepath=None, filename=None, loader=None,
                  encoding=None, lookup='strict', allow_exec=True):
@@ -247,15 +1169,21 @@ class Template(MarkupTemplate):
         }
         self.inner_docs = []
         self.has_col_loop = False
-        self._source = None
+        self.compile_clocks = None
+        self._archive = None
         self._files = set()
         super(Template, self).__init__(source, filepath, filename, loader,
                                        encoding, lookup, allow_exec)
+        self.cell_encoders = CellEncoders(self.namespaces)
+
+    # directory where compiled templates are stored, None disables the cache
+    cache_dir = os.environ.get('RELATORIO_CACHE_DIR') or None
 
     def _parse(self, source, encoding):
         """parses the odf file.
 
         It adds genshi directives and finds the inner docs.
+        The result is read from and stored into cache_dir if it is set.
         """
         if not self.filepath:
             if hasattr(source, 'read') and hasattr(source, 'mode'):
@@ -269,17 +1197,29 @@ class Template(MarkupTemplate):
                     source = BytesIO(source.read())
         else:
             source = self.filepath
-        self._source = source
         self.filepath = None  # Prevent zip content in traceback
-        zf = get_zip_file(source)
-        content = zf.read('content.xml')
-        styles = zf.read('styles.xml')
-        meta = zf.read('meta.xml')
-
-        template = super(Template, self)
-        content = template._parse(self.insert_directives(content), encoding)
-        styles = template._parse(self.insert_directives(styles), encoding)
-        meta = template._parse(self.insert_directives(meta), encoding)
+        start = clocks()
+        if not self.cache_dir:
+            parsed = self._compile(source, encoding)
+        else:
+            digest = template_digest(source)
+            parsed = self._load_compiled(digest, source)
+            if parsed is None:
+                parsed = self._compile(source, encoding)
+                self._store_compiled(digest, parsed)
+        self.compile_clocks = start, clocks()
+        return parsed
+
+    def _compile(self, source, encoding):
+        "adds the genshi directives to the parts of source and parses them"
+        self._archive = archive = SourceArchive(source)
+        content = archive.read('content.xml')
+        styles = archive.read('styles.xml')
+        meta = archive.read('meta.xml')
+
+        content = self._parse_part(content, encoding)
+        styles = self._parse_part(styles, encoding)
+        meta = self._parse_part(meta, encoding)
         content_files = [('content.xml', content)]
         styles_files = [('styles.xml', styles)]
         meta_files = [('meta.xml', meta)]
@@ -288,32 +1228,96 @@ class Template(MarkupTemplate):
             doc = self.inner_docs.pop()
             c_path, s_path, m_path = (
                 doc + '/content.xml', doc + '/styles.xml', doc + '/meta.xml')
-            content = zf.read(c_path)
-            styles = zf.read(s_path)
-            meta = zf.read(m_path)
-
-            c_parsed = template._parse(self.insert_directives(content),
-                                       encoding)
-            s_parsed = template._parse(self.insert_directives(styles),
-                                       encoding)
-            m_parsed = template._parse(self.insert_directives(meta),
-                                       encoding)
+            content = archive.read(c_path)
+            styles = archive.read(s_path)
+            meta = archive.read(m_path)
+
+            c_parsed = self._parse_part(content, encoding)
+            s_parsed = self._parse_part(styles, encoding)
+            m_parsed = self._parse_part(meta, encoding)
             content_files.append((c_path, c_parsed))
             styles_files.append((s_path, s_parsed))
             meta_files.append((m_path, m_parsed))
-        zf.close()
 
         parsed = []
         for fpath, fparsed in content_files + styles_files + meta_files:
             self._files.add(fpath)
             parsed.append((genshi.core.PI, ('relatorio', fpath), None))
             parsed += fparsed
+        archive.release(self._files)
 
         return parsed
 
+    def _cache_version(self):
+        lookup = getattr(self.lookup, '__name__', self.lookup)
+        return (CACHE_FORMAT, relatorio.__version__, genshi.__version__,
+            sys.version_info[:2], lookup)
+
+    def _cache_path(self, digest):
+        return os.path.join(self.cache_dir, '%s.pickle' % digest)
+
+    def _load_compiled(self, digest, source):
+        """returns the cached compiled stream or None if missing or stale.
+
+        The members of the archive are read again from source."""
+        try:
+            with open(self._cache_path(digest), 'rb') as fp:
+                compiled = pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except Exception as exception:
+            warnings.warn("Could not read cached template %s: %s"
+                % (digest, exception))
+            return None
+        if (compiled.get('digest') != digest
+                or compiled.get('version') != self._cache_version()):
+            return None
+        self.namespaces = compiled['namespaces']
+        self._files = compiled['files']
+        self.has_col_loop = compiled['has_col_loop']
+        self._archive = compiled['archive']
+        self._archive.attach(source)
+        return compiled['stream']
+
+    def _store_compiled(self, digest, parsed):
+        "writes atomically the compiled stream into the cache"
+        compiled = {
+            'digest': digest,
+            'version': self._cache_version(),
+            'namespaces': self.namespaces,
+            'files': self._files,
+            'has_col_loop': self.has_col_loop,
+            'archive': self._archive.detached(),
+            'stream': parsed,
+            }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        except OSError as exception:
+            warnings.warn("Could not cache template %s: %s"
+                % (digest, exception))
+            return
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(compiled, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._cache_path(digest))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _parse_part(self, content, encoding):
+        "parses the part content without serializing the annotated tree"
+        tree = self._insert_directives(content)
+        stream = Stream(etree_to_stream(tree.getroot(), self.filename))
+        return super(Template, self)._parse(stream, encoding)
+
     def insert_directives(self, content):
         """adds the genshi directives, handle the images and the innerdocs.
         """
+        return BytesIO(lxml.etree.tostring(self._insert_directives(content)))
+
+    def _insert_directives(self, content):
+        "returns the tree of content annotated with the genshi directives"
         tree = lxml.etree.parse(BytesIO(content))
         root = tree.getroot()
 
@@ -326,31 +1330,98 @@ class Template(MarkupTemplate):
         self.namespaces['py'] = GENSHI_URI
         self.namespaces['relatorio'] = RELATORIO_URI
 
-        self._remove_soft_page_break(tree)
-        self._invert_style(tree)
-        self._handle_meta(tree)
-        self._handle_relatorio_tags(tree)
-        self._handle_images(tree)
-        self._handle_innerdocs(tree)
-        self._escape_values(tree)
-        return BytesIO(lxml.etree.tostring(tree))
-
-    def _remove_soft_page_break(self, tree):
-        "remove soft-page-break tag and use-soft-page-break attribute"
-        xpath_expr = "//text:soft-page-break"
-        for node in tree.xpath(xpath_expr, namespaces=self.namespaces):
-            remove_node_keeping_tail(node)
+        targets = self._collect_targets(tree)
+        self._remove_soft_page_break(targets['soft_page_breaks'])
+        self._invert_style(targets['spans'])
+        self._handle_meta(tree, targets['meta'])
+        self._handle_relatorio_tags(targets['statements'])
+        self._handle_images(root, targets['images'])
+        self._handle_innerdocs(root, targets['inner_docs'])
+        if targets['escape']:
+            self._escape_values(tree)
+        return tree
+
+    def _collect_targets(self, tree):
+        """walks the tree once and returns the nodes to process by kind.
+
+        The soft-page-break attributes are removed on the way.
+        """
+        namespaces = self.namespaces
+        text_namespace = namespaces['text']
+        xlink_href = '{%s}href' % namespaces['xlink']
+        xlink_show = '{%s}show' % namespaces['xlink']
+        draw_name = '{%s}name' % namespaces['draw']
+        soft_page_break = '{%s}soft-page-break' % text_namespace
+        use_soft_page_breaks = '{%s}use-soft-page-breaks' % text_namespace
+        office_text = '{%s}text' % namespaces['office']
+        text_a = '{%s}a' % text_namespace
+        text_span = '{%s}span' % text_namespace
+        placeholder = '{%s}placeholder' % text_namespace
+        draw_frame = '{%s}frame' % namespaces['draw']
+        draw_object = '{%s}object' % namespaces['draw']
 
-        xpath_expr = "//office:text[@text:use-soft-page-breaks]"
-        text_namespace = self.namespaces['text']
-        for node in tree.xpath(xpath_expr, namespaces=self.namespaces):
-            node.attrib.pop('{%s}use-soft-page-breaks' % text_namespace)
+        root = tree.getroot()
+        if (root.tag == '{%s}document-meta' % namespaces['office']
+                and 'meta' in namespaces):
+            meta_user_defined = '{%s}user-defined' % namespaces['meta']
+            dc_prefix = '{%s}' % namespaces.get('dc', 'dc')
+        else:
+            meta_user_defined = dc_prefix = None
+
+        targets = {
+            'soft_page_breaks': [],
+            'spans': [],
+            'meta': [],
+            'statements': [],
+            'images': [],
+            'inner_docs': [],
+            'escape': [],
+            }
+        for node in root.iter():
+            tag = node.tag
+            text = node.text
+            if not isinstance(tag, str):
+                # comments and processing instructions
+                if text and PREFIX in text:
+                    targets['escape'].append(node)
+                continue
+            if ((text and PREFIX in text)
+                    or (node.tail and PREFIX in node.tail)
+                    or any(PREFIX in v for v in node.attrib.values())):
+                targets['escape'].append(node)
+
+            if tag == text_a:
+                if node.get(xlink_href, '').startswith('relatorio://'):
+                    targets['statements'].append(node)
+                    targets['spans'].extend(node.iterchildren(text_span))
+            elif tag == placeholder:
+                targets['statements'].append(node)
+            elif tag == soft_page_break:
+                targets['soft_page_breaks'].append(node)
+            elif tag == office_text:
+                node.attrib.pop(use_soft_page_breaks, None)
+            elif tag == draw_frame:
+                if node.get(draw_name, '').startswith('image:'):
+                    targets['images'].append(node)
+            elif tag == draw_object:
+                if (node.get(xlink_href, '').startswith('./')
+                        and node.get(xlink_show) == 'embed'):
+                    targets['inner_docs'].append(node)
+            elif (meta_user_defined
+                    and (tag == meta_user_defined
+                        or tag.startswith(dc_prefix))
+                    and text and text.startswith('relatorio://')):
+                targets['meta'].append(node)
+        return targets
+
+    def _remove_soft_page_break(self, nodes):
+        "remove soft-page-break tag"
+        for node in nodes:
+            remove_node_keeping_tail(node)
 
-    def _invert_style(self, tree):
+    def _invert_style(self, spans):
         "inverts the text:a and text:span"
-        xpath_expr = "//text:a[starts-with(@xlink:href, 'relatorio://')]" \
-                     "/text:span"
-        for span in tree.xpath(xpath_expr, namespaces=self.namespaces):
+        for span in spans:
             text_a = span.getparent()
             outer = text_a.getparent()
             text_a.text = span.text
@@ -359,22 +1430,20 @@ class Template(MarkupTemplate):
             outer.replace(text_a, span)
             span.append(text_a)
 
-    def _relatorio_statements(self, tree):
-        "finds the relatorio statements (text:a/text:placeholder)"
+    def _relatorio_statements(self, statements):
+        "parses the relatorio statements (text:a/text:placeholder)"
         # If this node href matches the relatorio URL it is kept.
         # If this node href matches a genshi directive it is kept for further
         # processing.
         xlink_href_attrib = '{%s}href' % self.namespaces['xlink']
         text_a = '{%s}a' % self.namespaces['text']
         placeholder = '{%s}placeholder' % self.namespaces['text']
-        s_xpath = "//text:a[starts-with(@xlink:href, 'relatorio://')]" \
-                  "| //text:placeholder"
 
         r_statements = []
         opened_tags = []
         # We map each opening tag with its closing tag
         closing_tags = {}
-        for statement in tree.xpath(s_xpath, namespaces=self.namespaces):
+        for statement in statements:
             if statement.tag == placeholder:
                 expr = statement.text[1:-1]
             elif statement.tag == text_a:
@@ -422,16 +1491,14 @@ class Template(MarkupTemplate):
         assert not opened_tags
         return r_statements, closing_tags
 
-    def _handle_meta(self, tree):
+    def _handle_meta(self, tree, nodes):
         """updates meta
         and adds py:content into meta:user-defined and dc:* nodes"""
         root = tree.getroot()
         if root.tag != '{%s}document-meta' % self.namespaces['office']:
             return
-        xpath_expr = ("//meta:user-defined[starts-with(., 'relatorio://')]"
-                      "|//dc:*[starts-with(., 'relatorio://')]")
         genshi_content = '{%s}content' % self.namespaces['py']
-        for node in tree.xpath(xpath_expr, namespaces=self.namespaces):
+        for node in nodes:
             node.attrib[genshi_content] = node.text[len('relatorio://'):]
 
         def set(name, value):
@@ -461,7 +1528,7 @@ class Template(MarkupTemplate):
         remove('creator', 'dc')
         remove('date', 'dc')
 
-    def _handle_relatorio_tags(self, tree):
+    def _handle_relatorio_tags(self, statements):
         """
         Will treat all relatorio tag (py:if/for/choose/when/otherwise)
         tags
@@ -483,7 +1550,7 @@ class Template(MarkupTemplate):
 
         py_replace = '{%s}replace' % GENSHI_URI
 
-        r_statements, closing_tags = self._relatorio_statements(tree)
+        r_statements, closing_tags = self._relatorio_statements(statements)
 
         for r_node, parsed in r_statements:
             expr, directive, attr, a_val = parsed
@@ -639,13 +1706,8 @@ class Template(MarkupTemplate):
         # find the position in the row of the cells holding the
         # <for> and </for> instructions
         # We use "*" so as to count both normal cells and covered/hidden cells
-        position_xpath_expr = 'count(preceding-sibling::*)'
-        opening_pos = \
-            int(outer_o_node.xpath(position_xpath_expr,
-                                   namespaces=self.namespaces))
-        closing_pos = \
-            int(outer_c_node.xpath(position_xpath_expr,
-                                   namespaces=self.namespaces))
+        opening_pos = int(PRECEDING_SIBLINGS_XPATH(outer_o_node))
+        closing_pos = int(PRECEDING_SIBLINGS_XPATH(outer_c_node))
 
         # check whether or not the opening tag spans several rows
         a_val = self._handle_row_spanned_column_loops(
@@ -765,7 +1827,7 @@ class Template(MarkupTemplate):
             with_node.append(node)
         return a_val
 
-    def _handle_images(self, tree):
+    def _handle_images(self, root, frames):
         "replaces all draw:frame named 'image: ...' by draw:image nodes"
         draw_namespace = self.namespaces['draw']
         draw_name = '{%s}name' % draw_namespace
@@ -775,19 +1837,21 @@ class Template(MarkupTemplate):
         svg_namespace = self.namespaces['svg']
         svg_width = '{%s}width' % svg_namespace
         svg_height = '{%s}height' % svg_namespace
-        xpath_expr = "//draw:frame[starts-with(@draw:name, 'image:')]"
-        for draw in tree.xpath(xpath_expr, namespaces=self.namespaces):
+        for draw in frames:
+            if not is_attached(draw, root):
+                continue
             cache_id = id(draw)
             d_name = draw.attrib[draw_name][6:].strip()
-            attr_expr = ("__relatorio_make_href(__relatorio_get_cache(%s))" %
-                         cache_id)
+            width = draw.attrib.pop(svg_width, '')
+            height = draw.attrib.pop(svg_height, '')
+            attr_expr = ("__relatorio_make_href("
+                         "__relatorio_get_cache(%s), '%s', '%s')" %
+                         (cache_id, width, height))
             image_node = EtreeElement(draw_image,
                                       attrib={py_attrs: attr_expr},
                                       nsmap={'draw': draw_namespace,
                                              'py': GENSHI_URI})
             draw.replace(draw[0], image_node)
-            width = draw.attrib.pop(svg_width, '')
-            height = draw.attrib.pop(svg_height, '')
             attr_expr = ("__relatorio_make_dimension("
                          "__relatorio_store_cache(%s, (%s)), '%s', '%s')" %
                          (cache_id, d_name, width, height))
@@ -798,13 +1862,12 @@ class Template(MarkupTemplate):
             # remove end-cell-address as the address specified could be wrong
             draw.attrib.pop(end_cell_address, '')
 
-    def _handle_innerdocs(self, tree):
-        "finds inner_docs and adds them to the processing stack."
+    def _handle_innerdocs(self, root, objects):
+        "adds inner_docs to the processing stack."
         href_attrib = '{%s}href' % self.namespaces['xlink']
-        xpath_expr = "//draw:object[starts-with(@xlink:href, './')" \
-                     "and @xlink:show='embed']"
-        for draw in tree.xpath(xpath_expr, namespaces=self.namespaces):
-            self.inner_docs.append(draw.attrib[href_attrib][2:])
+        for draw in objects:
+            if is_attached(draw, root):
+                self.inner_docs.append(draw.attrib[href_attrib][2:])
 
     def _escape_values(self, tree):
         "escapes element values"
@@ -816,59 +1879,80 @@ class Template(MarkupTemplate):
             if element.text:
                 element.text = element.text.replace(PREFIX, PREFIX * 2)
 
+    def memory_size(self):
+        """returns the approximate memory size of the template with its row
+        skeletons and the kept members of its archive"""
+        size = stream_size(self.stream)
+        if self._archive is not None:
+            size += self._archive.memory_size()
+        return size
+
+    def register_encoder(self, type_, encoder):
+        "registers the encoder of the cell values of type_"
+        self.cell_encoders.register(type_, encoder)
+
     def _guess_type(self, val):
-        office_namespace = self.namespaces['office']
-        types = {'boolean': '{%s}boolean-value' % office_namespace,
-                 'currency': '{%s}currency' % office_namespace,
-                 'date': '{%s}date-value' % office_namespace,
-                 'float': '{%s}value' % office_namespace,
-                 'percentage': '{%s}value' % office_namespace,
-                 'string': '{%s}string-value' % office_namespace,
-                 'time': '{%s}time-value' % office_namespace,
-                 'void': '{%s}value' % office_namespace,
-                 }
-        attrs = dict.fromkeys(types)
-        # Missing base type for currency and percentage
-        if isinstance(val, bool):
-            type_ = 'boolean'
-            val = str(val).lower()
-        elif isinstance(val, datetime.date):
-            type_ = 'date'
-            val = val.isoformat()
-        elif isinstance(val, (int, float, Decimal)):
-            type_ = 'float'
-        elif isinstance(val, str):
-            type_ = 'string'
-            val = escape_xml_invalid_chars(val)
-        elif isinstance(val, datetime.timedelta):
-            type_ = 'time'
-            val = 'P%sD%sS' % (val.days, val.seconds)
-        else:
-            type_ = 'void'
-            val = None
-        attrs[types[type_]] = val
-        attrs['{%s}value-type' % office_namespace] = type_
-        if 'calcext' in self.namespaces:
-            attrs['{%s}value-type' % self.namespaces['calcext']] = type_
-        return attrs
+        warnings.warn("_guess_type is deprecated, use cell_encoders instead",
+            DeprecationWarning, stacklevel=2)
+        return self.cell_encoders(val)
 
     def generate(self, *args,
             _relatorio_compresslevel=None,
             _relatorio_chunksize=64,
             _relatorio_zip64=False,
             _relatorio_compression_method=zipfile.ZIP_DEFLATED,
+            _relatorio_image_dpi=None,
+            _relatorio_compression=None,
+            _relatorio_compression_threads=None,
+            _relatorio_fast_rows=False,
+            _relatorio_codegen=False,
+            _relatorio_flat=False,
+            _relatorio_stats=None,
             **kwargs):
-        "creates the RelatorioStream."
-        serializer = OOSerializer(
-            self._source, self._files,
+        """creates the RelatorioStream.
+
+        _relatorio_compression is a CompressionPolicy or the name of one of
+        COMPRESSION_PROFILES, by default the members are compressed with
+        _relatorio_compression_method and _relatorio_compresslevel.
+        _relatorio_compression_threads is the number of threads deflating
+        the members in parallel.
+        _relatorio_fast_rows renders the loops over simple table rows from
+        pre-serialized rows.
+        _relatorio_codegen renders them with Python functions compiled from
+        their expressions.
+        _relatorio_flat renders a flat OpenDocument XML instead of an
+        archive.
+        _relatorio_stats is a RenderStats collecting the timings and the
+        counters of the rendering.
+        In the thread of an event loop, the asynchronous iterables of kwargs
+        are iterated with an AsyncIterableBridge closed by render_async."""
+        bridges = []
+        if _running_loop() is not None:
+            kwargs = bridge_async_iterables(kwargs, bridges)
+        if _relatorio_flat:
+            serializer_class = FlatOOSerializer
+        else:
+            serializer_class = OOSerializer
+        serializer = serializer_class(
+            self._archive, self._files,
             compresslevel=_relatorio_compresslevel,
             zip64=_relatorio_zip64,
             chunksize=_relatorio_chunksize,
-            compression_method=_relatorio_compression_method)
-        kwargs['__relatorio_make_href'] = ImageHref(serializer, kwargs)
+            compression_method=_relatorio_compression_method,
+            compression=_relatorio_compression,
+            compression_threads=_relatorio_compression_threads)
+        serializer.stats = _relatorio_stats
+        # the compilation is reported by the first rendering only
+        serializer.compile_clocks, self.compile_clocks = (
+            self.compile_clocks, None)
+        kwargs['__relatorio_serializer'] = serializer
+        kwargs['__relatorio_make_href'] = ImageHref(
+            serializer, kwargs, dpi=_relatorio_image_dpi)
         kwargs['__relatorio_make_dimension'] = ImageDimension(self.namespaces)
-        kwargs['__relatorio_guess_type'] = self._guess_type
+        kwargs['__relatorio_guess_type'] = self.cell_encoders
         kwargs['__relatorio_escape_invalid_chars'] = escape_xml_invalid_chars
+        kwargs['__relatorio_fast_rows'] = _relatorio_fast_rows
+        kwargs['__relatorio_codegen'] = _relatorio_codegen
 
         counter = ColumnCounter()
         kwargs['__relatorio_reset_col_count'] = counter.reset
@@ -884,41 +1968,184 @@ class Template(MarkupTemplate):
             # Note that we can't simply add a "number-columns-repeated"
             # attribute and then fill it with the correct number of columns
             # because that wouldn't work if more than one column is repeated.
-            transformation = DuplicateColumnHeaders(counter)
-            col_filter = Transformer('//repeat[namespace-uri()="%s"]'
-                                     % RELATORIO_URI)
-            col_filter = col_filter.apply(transformation)
-            # Must consume the stream to fill counter
-            stream = Stream(list(stream), self.serializer) | col_filter
-        return RelatorioStream(stream, serializer)
+            # The headers are buffered until the end of their table because
+            # the rows must be rendered to fill counter.
+            stream = stream | DuplicateColumnHeaders(
+                counter, '{%s}table' % self.namespaces['table'])
+        stream = RelatorioStream(stream, serializer)
+        stream.bridges = bridges
+        return stream
+
+    def generate_many(self, datas, **kwargs):
+        """creates a RelatorioStream for each data of datas.
+
+        The compiled template and its source archive are shared by all the
+        streams."""
+        for data in datas:
+            yield self.generate(**dict(kwargs, **data))
 
 
 class DuplicateColumnHeaders(object):
-    def __init__(self, counter):
+    """A stream filter which repeats the column headers wrapped in
+    relatorio:repeat as many times as the counter says.
+
+    The events from a relatorio:repeat until the end of its table are
+    buffered and written in a temporary file once there are more than
+    spool_size."""
+    spool_size = 10000
+
+    def __init__(self, counter, table_tag):
         self.counter = counter
+        self.table_tag = table_tag
+        self.repeat_tag = '{%s}repeat' % RELATORIO_URI
 
     def __call__(self, stream):
-        for mark, (kind, data, pos) in stream:
+        START, END = genshi.core.START, genshi.core.END
+        buffer = None
+        for event in stream:
+            kind, data, pos = event
+            if buffer is None:
+                if kind is START and data[0] == self.repeat_tag:
+                    buffer = SpooledEvents(self.spool_size)
+                    depth = 1
+                else:
+                    yield event
+                    continue
+            buffer.append(event)
+            if kind is START and data[0] == self.table_tag:
+                depth += 1
+            elif kind is END and data[0] == self.table_tag:
+                depth -= 1
+                if not depth:
+                    # the rows of the table are rendered
+                    for event in self.repeat(buffer):
+                        yield event
+                    buffer = None
+        if buffer is not None:
+            for event in self.repeat(buffer):
+                yield event
+
+    def repeat(self, events):
+        events = iter(events)
+        for kind, data, pos in events:
             # for each repeat tag found
-            if mark is ENTER:
+            if kind is genshi.core.START and data[0] == self.repeat_tag:
                 # get the number of columns for that table
-                attrs = data[1]
-                table = attrs.get('table')
-                col_count = self.counter.counters[table]
+                col_count = self.counter.counters[data[1].get('table')]
 
                 # collect events (column header tags) to repeat
-                events = []
-                for submark, event in stream:
-                    if submark is EXIT:
+                headers = []
+                for event in events:
+                    if (event[0] is genshi.core.END
+                            and event[1] == self.repeat_tag):
                         break
-                    events.append(event)
+                    headers.append(event)
 
                 # repeat them
                 for _ in range(col_count):
-                    for event in events:
-                        yield None, event
+                    for event in headers:
+                        yield event
+            else:
+                yield kind, data, pos
+
+
+class SpooledEvents(object):
+    "A list of events which is pickled into a temporary file when too long"
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._events = []
+        self._file = None
+
+    def append(self, event):
+        self._events.append(event)
+        if len(self._events) >= self.max_size:
+            if self._file is None:
+                self._file = tempfile.TemporaryFile()
+            pickle.dump(
+                self._events, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+            self._events = []
+
+    def __iter__(self):
+        "yields the events once and releases them"
+        if self._file is not None:
+            self._file.seek(0)
+            while True:
+                try:
+                    events = pickle.load(self._file)
+                except EOFError:
+                    break
+                for event in events:
+                    yield event
+            self._file.close()
+            self._file = None
+        events, self._events = self._events, []
+        for event in events:
+            yield event
+
+
+def template_digest(source):
+    "Returns the SHA-256 hexdigest of the template source"
+    digest = hashlib.sha256()
+    if hasattr(source, 'read'):
+        source.seek(0)
+        for chunk in iter(lambda: source.read(1 << 16), b''):
+            digest.update(chunk)
+        source.seek(0)
+    else:
+        with open(source, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(1 << 16), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def etree_to_stream(root, filename=None):
+    """Converts the lxml tree into the markup event stream that the Genshi
+    XMLParser would produce from its serialization."""
+    stream = []
+    append = stream.append
+    qnames = {}
+    START, END, TEXT = genshi.core.START, genshi.core.END, genshi.core.TEXT
+    START_NS, END_NS = genshi.core.START_NS, genshi.core.END_NS
+    Comment, PI = lxml.etree.Comment, lxml.etree.PI
+
+    def qname(name):
+        try:
+            return qnames[name]
+        except KeyError:
+            return qnames.setdefault(name, genshi.core.QName(name))
+
+    def convert(node, parent_nsmap):
+        pos = (filename, node.sourceline or -1, -1)
+        tag = node.tag
+        if tag is Comment:
+            append((genshi.core.COMMENT, node.text or '', pos))
+        elif tag is PI:
+            append((genshi.core.PI, (node.target, node.text or ''), pos))
+        elif isinstance(tag, str):
+            nsmap = node.nsmap
+            if nsmap == parent_nsmap:
+                prefixes = []
             else:
-                yield mark, (kind, data, pos)
+                prefixes = [p or '' for p, u in nsmap.items()
+                    if parent_nsmap.get(p) != u]
+                for prefix in prefixes:
+                    append((START_NS, (prefix, nsmap[prefix or None]), pos))
+            attrs = genshi.core.Attrs(
+                [(qname(n), v) for n, v in node.attrib.items()])
+            append((START, (qname(tag), attrs), pos))
+            if node.text:
+                append((TEXT, node.text, pos))
+            for child in node:
+                convert(child, nsmap)
+            append((END, qname(tag), pos))
+            for prefix in reversed(prefixes):
+                append((END_NS, prefix, pos))
+        if node.tail:
+            append((TEXT, node.tail, pos))
+
+    convert(root, {})
+    return stream
 
 
 def get_zip_file(source):
@@ -931,14 +2158,70 @@ def get_zip_file(source):
         return zipfile.ZipFile(fod2od(source))
 
 
+# signatures of the image types as pairs of offset and bytes
+IMAGE_SIGNATURES = [
+    ([(0, b'\x89PNG\r\n\x1a\n')], 'image/png'),
+    ([(0, b'\xff\xd8\xff')], 'image/jpeg'),
+    ([(0, b'GIF87a')], 'image/gif'),
+    ([(0, b'GIF89a')], 'image/gif'),
+    ([(0, b'RIFF'), (8, b'WEBP')], 'image/webp'),
+    ([(0, b'II*\x00')], 'image/tiff'),
+    ([(0, b'MM\x00*')], 'image/tiff'),
+    ([(0, b'BM')], 'image/bmp'),
+    ([(0, b'\xd7\xcd\xc6\x9a')], 'image/wmf'),
+    ([(0, b'\x01\x00\x00\x00'), (40, b' EMF')], 'image/emf'),
+    ([(0, b'%PDF-')], 'application/pdf'),
+    ]
+# the elements of flat documents which are written tag by tag
+FLAT_CONTAINERS = {
+    'office': ['text', 'spreadsheet', 'presentation', 'drawing', 'chart',
+        'image'],
+    'table': ['table', 'table-rows', 'table-row-group', 'table-header-rows'],
+    }
+# the in-memory size of the parts of converted flat documents
+FLAT_SPOOL_SIZE = 1024 * 1024
+NAMESPACE_DECLARATION = re.compile(rb' xmlns(?::[^=\s]+)?="[^"]*"')
+
+
+def sniff_mimetype(data):
+    "returns the mimetype of the image data from its first bytes"
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if all(data[offset:offset + len(value)] == value
+                for offset, value in signature):
+            return mimetype
+    head = data[:1024].lstrip()
+    if head.startswith(b'<svg') or (
+            head.startswith(b'<?xml') and b'<svg' in head):
+        return 'image/svg+xml'
+    try:
+        import magic
+    except ImportError:
+        return 'application/octet-stream'
+    if hasattr(magic, 'from_buffer'):
+        return magic.from_buffer(data, mime=True)
+    else:
+        # Not python-magic but file-magic
+        return magic.detect_from_content(data).mime_type
+
+
 def fod2od(source):
-    "Convert Flat OpenDocument to OpenDocument"
+    """Convert Flat OpenDocument to OpenDocument
+
+    The flat document is parsed incrementally: the elements below the
+    containers are written to their parts as soon as they are parsed and the
+    images are decoded straight into the archive. The comments and
+    processing instructions before the first child of the root are
+    dropped."""
     odt_io = BytesIO()
     odt_zip = zipfile.ZipFile(
         odt_io, mode='w', compression=zipfile.ZIP_DEFLATED)
-    fodt_tree = lxml.etree.parse(source)
-    fodt_root = fodt_tree.getroot()
-    office_ns = fodt_root.nsmap['office']
+    events = lxml.etree.iterparse(
+        source, events=('start', 'end', 'comment', 'pi'), huge_tree=True)
+    for event, fodt_root in events:
+        if event == 'start':
+            break
+    nsmap = fodt_root.nsmap
+    office_ns = nsmap['office']
     tag2files = {
         '{%s}meta' % office_ns: ['meta'],
         '{%s}settings' % office_ns: ['settings'],
@@ -949,62 +2232,377 @@ def fod2od(source):
         '{%s}master-styles' % office_ns: ['styles'],
         '{%s}body' % office_ns: ['content'],
         }
-    mimetype = fodt_root.attrib['{%s}mimetype' % office_ns]
+    containers = {'{%s}%s' % (nsmap[prefix], name)
+        for prefix, names in FLAT_CONTAINERS.items() if prefix in nsmap
+        for name in names}
+    image_tag = '{%s}image' % nsmap.get('draw')
+    binary_data_tag = '{%s}binary-data' % office_ns
+    href = '{%s}href' % nsmap.get('xlink')
+    declarations = set(NAMESPACE_DECLARATION.findall(
+            lxml.etree.tostring(lxml.etree.Element('root', nsmap=nsmap))))
+
+    stripped_tags = {}
+
+    def strip_declarations(data):
+        "removes from the first tag the namespaces declared by the root"
+        end = data.index(b'>')
+        tag = data[:end]
+        stripped = stripped_tags.get(tag)
+        if stripped is None:
+            stripped = NAMESPACE_DECLARATION.sub(
+                lambda match: (
+                    b'' if match.group() in declarations else match.group()),
+                tag)
+            if len(stripped_tags) < 1024:
+                stripped_tags[tag] = stripped
+        return stripped + data[end:]
+
+    def start_tag(element, strip=True):
+        shallow = lxml.etree.Element(
+            element.tag, element.attrib, nsmap=element.nsmap)
+        shallow.text = ' '
+        tag = lxml.etree.tostring(shallow, encoding='UTF-8')
+        if strip:
+            tag = strip_declarations(tag)
+        return tag[:tag.index(b'>') + 1]
+
+    def end_tag(element):
+        name = lxml.etree.QName(element).localname
+        if element.prefix:
+            name = '%s:%s' % (element.prefix, name)
+        return ('</%s>' % name).encode('utf-8')
+
+    def part_root(fname):
+        return lxml.etree.Element(
+            '{%s}document-%s' % (office_ns, fname), nsmap=nsmap)
+
+    def write(outputs, data):
+        for output in outputs:
+            output.write(data)
+
+    def write_pending(entry):
+        "writes the text following the last tag written in the container"
+        container, outputs, previous = entry
+        if previous is None:
+            return
+        if previous is container:
+            text = container.text
+        else:
+            text = previous.tail
+            container.remove(previous)
+        if text:
+            if not text.isspace():
+                text = genshi.core.escape(text, quotes=False)
+            write(outputs, text.encode('utf-8'))
+        entry[2] = None
+
     # mimetype should be written first to let detection through 'magic number'
+    mimetype = fodt_root.attrib['{%s}mimetype' % office_ns]
     odt_zip.writestr('mimetype', mimetype, zipfile.ZIP_STORED)
-    documents = {}
+    parts = {}
     images = []
-    for child in fodt_root:
-        for fname in tag2files[child.tag]:
-            document = documents.get(fname)
-            if document is None:
-                document = lxml.etree.Element(
-                    '{%s}document-%s' % (office_ns, fname),
-                    nsmap=fodt_root.nsmap)
-                documents[fname] = document
-            child = deepcopy(child)
-            images.extend(extract_images(
-                    child, fodt_root.nsmap, start=len(images)))
-            document.append(child)
-    manifest = Manifest(b'''<?xml version="1.0" encoding="UTF-8"?>
-        <manifest:manifest
-        xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"/>
-        ''')
-    manifest.add_file_entry('/', mimetype)
-    for fname, document in documents.items():
-        document_string = lxml.etree.tostring(document, encoding='UTF-8',
-                                              xml_declaration=True)
-        odt_zip.writestr('%s.xml' % fname, document_string)
-        manifest.add_file_entry('%s.xml' % fname, 'text/xml')
-    for fname, data, mime_type in images:
-        odt_zip.writestr(fname, data)
-        manifest.add_file_entry(fname, mime_type)
-    odt_zip.writestr(MANIFEST, str(manifest))
+    root = [fodt_root, [], None]
+    stack = []
+    depth = 0  # of the element written at once
+    try:
+        for event, element in events:
+            if event in {'comment', 'pi'}:
+                if depth:
+                    # written with its parent
+                    continue
+                entry = stack[-1] if stack else root
+                write_pending(entry)
+                write(entry[1], lxml.etree.tostring(
+                        element, encoding='UTF-8', with_tail=False))
+                entry[2] = element
+                continue
+            if event == 'start':
+                if depth:
+                    depth += 1
+                    continue
+                if stack:
+                    outputs = stack[-1][1]
+                    write_pending(stack[-1])
+                    if element.tag not in containers:
+                        depth = 1
+                        continue
+                else:
+                    write_pending(root)
+                    outputs = []
+                    for fname in tag2files[element.tag]:
+                        part = parts.get(fname)
+                        if part is None:
+                            part = parts[fname] = tempfile.\
+                                SpooledTemporaryFile(FLAT_SPOOL_SIZE)
+                            part.write(b"<?xml version='1.0' "
+                                b"encoding='UTF-8'?>\n")
+                            part.write(start_tag(
+                                    part_root(fname), strip=False))
+                        outputs.append(part)
+                write(outputs, start_tag(element))
+                stack.append([element, outputs, element])
+                continue
+
+            if element.tag == image_tag:
+                binary_data = element.find(binary_data_tag)
+                if binary_data is not None:
+                    data = base64.b64decode(binary_data.text or '')
+                    mime_type = sniff_mimetype(data)
+                    name = 'Pictures/image%s%s' % (len(images),
+                        mimetypes.guess_extension(mime_type) or '')
+                    odt_zip.writestr(name, data, zipfile.ZIP_STORED
+                        if is_compressed_media(mime_type)
+                        else zipfile.ZIP_DEFLATED)
+                    element.remove(binary_data)
+                    element.attrib[href] = name
+                    images.append((name, mime_type))
+            if depth:
+                depth -= 1
+                if not depth:
+                    write(stack[-1][1], strip_declarations(
+                            lxml.etree.tostring(element, encoding='UTF-8',
+                                with_tail=False)))
+                    stack[-1][2] = element
+                continue
+            if not stack:
+                write_pending(root)
+                break
+            entry = stack.pop()
+            write_pending(entry)
+            write(entry[1], end_tag(element))
+            # the tail of the top level children is written to their parts
+            parent = stack[-1] if stack else root
+            parent[1:] = entry[1], element
+
+        manifest = Manifest(b'''<?xml version="1.0" encoding="UTF-8"?>
+            <manifest:manifest
+            xmlns:manifest="urn:oasis:names:tc:opendocument:xmlns:manifest:1.0"/>
+            ''')
+        manifest.add_file_entry('/', mimetype)
+        for fname, part in parts.items():
+            part.write(end_tag(part_root(fname)))
+            size = part.tell()
+            part.seek(0)
+            with odt_zip.open('%s.xml' % fname, 'w',
+                    force_zip64=size >= zipfile.ZIP64_LIMIT) as member:
+                shutil.copyfileobj(part, member)
+            manifest.add_file_entry('%s.xml' % fname, 'text/xml')
+        for fname, mime_type in images:
+            manifest.add_file_entry(fname, mime_type)
+        odt_zip.writestr(MANIFEST, str(manifest))
+    finally:
+        for part in parts.values():
+            part.close()
     odt_zip.close()
     return odt_io
 
 
-def extract_images(child, namespaces, start=0):
-    "Extract draw:image with binary-data and replace by href"
-    import magic
-    images = []
-    for i, image in enumerate(
-            child.xpath('//draw:image', namespaces=namespaces), start):
-        binary_data, = image.xpath(
-            './office:binary-data', namespaces=namespaces)
-        data = base64.b64decode(binary_data.text)
-        if hasattr(magic, 'from_buffer'):
-            mime_type = magic.from_buffer(data, mime=True)
+class SourceArchive(object):
+    """The members of the template archive needed to render it.
+
+    The location of the compressed data of each member is computed once so
+    that rendering only copies them. Once released, only the compressed data
+    of the members not parsed by the template are kept so that rendering never
+    reads the source again. Flat documents are converted once."""
+
+    def __init__(self, source):
+        data = _read_source(source)
+        # the members can be read again from the source
+        self.reloadable = True
+        try:
+            zf = zipfile.ZipFile(BytesIO(data))
+        except zipfile.BadZipfile:
+            data = fod2od(BytesIO(data)).getvalue()
+            zf = zipfile.ZipFile(BytesIO(data))
+            self.reloadable = False
+        self._data = data
+        self._offsets = {}
+        # the compressed data and the content by name of the kept members
+        self._raw = {}
+        self._contents = {}
+        self._kept = None
+        with zf:
+            self.infolist = zf.infolist()
+            for info in self.infolist:
+                offset = raw_member_offset(zf.fp, info)
+                if offset is not None:
+                    self._offsets[info.filename] = offset
+            self.manifest = Manifest(zf.read(MANIFEST))
+
+    def release(self, parsed):
+        "forgets the archive data keeping only the members not in parsed"
+        if self._data is None:
+            return
+        self._kept = [i.filename for i in self.infolist
+            if i.filename not in parsed and i.filename != MANIFEST
+            and not i.filename.startswith(
+                ('ObjectReplacements', THUMBNAILS + '/'))]
+        self._keep(self._data)
+        self._data = None
+
+    def _keep(self, data):
+        "stores the kept members of the archive data"
+        with zipfile.ZipFile(BytesIO(data)) as zf:
+            for name in self._kept:
+                info = zf.getinfo(name)
+                offset = self._offsets.get(name)
+                if offset is not None and info.compress_type in {
+                        zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED}:
+                    self._raw[name] = data[
+                        offset:offset + info.compress_size]
+                else:
+                    self._contents[name] = zf.read(name)
+
+    def detached(self):
+        """returns a copy without the kept members if they can be read again
+        from the source"""
+        archive = copy.copy(self)
+        if self.reloadable:
+            archive._raw, archive._contents = {}, {}
+        return archive
+
+    def attach(self, source):
+        "reads again the kept members from the same source"
+        if self.reloadable:
+            self._keep(_read_source(source))
+
+    def memory_size(self):
+        "returns the size of the data kept in memory"
+        if self._data is not None:
+            return len(self._data)
+        return (sum(len(d) for d in self._raw.values())
+            + sum(len(c) for c in self._contents.values()))
+
+    def read(self, name):
+        "returns the content of the member"
+        if self._data is not None:
+            with zipfile.ZipFile(BytesIO(self._data)) as zf:
+                return zf.read(name)
+        elif name in self._contents:
+            return self._contents[name]
+        raw = self._raw[name]
+        for info in self.infolist:
+            if info.filename == name:
+                break
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(raw, -15)
+        return raw
+
+    def _raw_data(self, info):
+        "returns the compressed data of the member or None"
+        offset = self._offsets.get(info.filename)
+        if offset is None:
+            return None
+        elif self._data is not None:
+            return memoryview(self._data)[offset:offset + info.compress_size]
+        return self._raw.get(info.filename)
+
+    def copy_member(self, outzip, info):
+        """Copies the member described by info into outzip without
+        decompressing it when possible."""
+        data = None
+        if raw_write_supported(outzip):
+            data = self._raw_data(info)
+        if data is None:
+            # the shared info must not be modified by writestr
+            outzip.writestr(copy.copy(info), self.read(info.filename))
         else:
-            # Not python-magic but file-magic
-            mime_type = magic.detect_from_content(data).mime_type
-        name = 'Pictures/image%s%s' % (
-            i, mimetypes.guess_extension(mime_type))
-        image.remove(binary_data)
-        xlink_ns = namespaces['xlink']
-        image.attrib['{%s}href' % xlink_ns] = name
-        images.append((name, data, mime_type))
-    return images
+            write_raw_member(outzip, info, data)
+
+
+def _read_source(source):
+    "returns the content of the file or the path source"
+    if hasattr(source, 'read'):
+        source.seek(0)
+        return source.read()
+    with open(source, 'rb') as fp:
+        return fp.read()
+
+
+def raw_member_offset(fp, info):
+    """Returns the offset in fp of the compressed data of the member
+    described by info or None if it can not be copied as is."""
+    if (info.flag_bits & 0x1
+            or info.file_size > zipfile.ZIP64_LIMIT
+            or info.compress_size > zipfile.ZIP64_LIMIT):
+        # encrypted or zip64 members are recompressed
+        return None
+    fp.seek(info.header_offset)
+    header = fp.read(zipfile.sizeFileHeader)
+    if header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    return (info.header_offset + zipfile.sizeFileHeader
+        + name_length + extra_length)
+
+
+# the private attributes of ZipFile used by write_raw_member
+RAW_WRITE_ATTRIBUTES = ['_lock', '_writing', '_seekable', '_writecheck',
+    '_didModify', 'start_dir', 'filelist', 'NameToInfo', 'fp']
+_raw_write_checked = None
+
+
+def _check_raw_write():
+    "returns if a member written by write_raw_member is read back intact"
+    data = b'relatorio' * 100
+    source = BytesIO()
+    with zipfile.ZipFile(source, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('member', data)
+    output = BytesIO()
+    with zipfile.ZipFile(source) as zf, \
+            zipfile.ZipFile(output, 'w') as outzip:
+        info = zf.getinfo('member')
+        offset = raw_member_offset(zf.fp, info)
+        raw = source.getvalue()[offset:offset + info.compress_size]
+        write_raw_member(outzip, info, raw)
+        outzip.writestr('other', data)
+    with zipfile.ZipFile(output) as zf:
+        return (zf.testzip() is None and zf.read('member') == data
+            and zf.read('other') == data)
+
+
+def raw_write_supported(outzip):
+    """returns if write_raw_member can write into outzip.
+
+    It relies on private attributes of ZipFile so it is checked once by
+    writing and reading back a member and each outzip must have the
+    attributes."""
+    global _raw_write_checked
+    if _raw_write_checked is None:
+        try:
+            _raw_write_checked = _check_raw_write()
+        except Exception:
+            _raw_write_checked = False
+        if not _raw_write_checked:
+            warnings.warn("The members of the templates are recompressed "
+                "because zipfile does not support their raw copy")
+    return _raw_write_checked and all(
+        hasattr(outzip, a) for a in RAW_WRITE_ATTRIBUTES)
+
+
+def write_raw_member(outzip, info, data):
+    """Writes into outzip the member described by info with its already
+    compressed data.
+
+    The CRC and sizes of info are reused as is. It uses private attributes of
+    ZipFile so raw_write_supported must be checked first."""
+    zinfo = copy.copy(info)
+    # sizes are known so there is no need for a data descriptor
+    zinfo.flag_bits &= ~0x08
+    with outzip._lock:
+        if outzip._writing:
+            raise ValueError("Can't write to ZIP archive while an open "
+                "writing handle exists")
+        if outzip._seekable:
+            outzip.fp.seek(outzip.start_dir)
+        zinfo.header_offset = outzip.fp.tell()
+        outzip._writecheck(zinfo)
+        outzip._didModify = True
+        outzip.fp.write(zinfo.FileHeader())
+        outzip.fp.write(data)
+        outzip.filelist.append(zinfo)
+        outzip.NameToInfo[zinfo.filename] = zinfo
+        outzip.start_dir = outzip.fp.tell()
 
 
 class Manifest(object):
@@ -1013,6 +2611,29 @@ class Manifest(object):
         self.tree = lxml.etree.parse(BytesIO(content))
         self.root = self.tree.getroot()
         self.namespaces = self.root.nsmap
+        self._index()
+
+    def _index(self):
+        "indexes the file entries by their full-path"
+        manifest_namespace = self.namespaces['manifest']
+        full_path = '{%s}full-path' % manifest_namespace
+        self.entries = {
+            e.get(full_path): e for e in self.root.iterchildren(
+                '{%s}file-entry' % manifest_namespace)}
+
+    def __getstate__(self):
+        return {'content': lxml.etree.tostring(self.tree)}
+
+    def __setstate__(self, state):
+        self.__init__(state['content'])
+
+    def copy(self):
+        "returns an independent copy without parsing the content again"
+        manifest = copy.copy(self)
+        manifest.tree = deepcopy(self.tree)
+        manifest.root = manifest.tree.getroot()
+        manifest._index()
+        return manifest
 
     def __str__(self):
         val = lxml.etree.tostring(self.tree, encoding='UTF-8',
@@ -1031,21 +2652,102 @@ class Manifest(object):
                                   attrib=attribs,
                                   nsmap={'manifest': manifest_namespace})
         self.root.append(entry_node)
+        self.entries.setdefault(path, entry_node)
 
     def remove_file_entry(self, path):
-        manifest_namespace = self.namespaces['manifest']
-        entry = self.root.find('{%s}%s[@{%s}full-path="%s"]' %
-                               (manifest_namespace, 'file-entry',
-                                manifest_namespace, path))
+        entry = self.entries.pop(path, None)
         if entry is not None:
             self.root.remove(entry)
 
 
+class CompressionPolicy(object):
+    """Chooses the compression type and level of the members of a document.
+
+    rules is a list of (pattern, compress_type, compresslevel) of which the
+    first with the pattern matching the member path applies. Otherwise
+    the already compressed media are stored if store_media is set and the
+    other members use compress_type and compresslevel."""
+
+    def __init__(self, compress_type=zipfile.ZIP_DEFLATED, compresslevel=None,
+            store_media=True, rules=None):
+        self.compress_type = compress_type
+        self.compresslevel = compresslevel
+        self.store_media = store_media
+        self.rules = list(rules or [])
+
+    def __call__(self, path, mimetype=None):
+        "returns the compress_type and compresslevel of the member at path"
+        if path == 'mimetype':
+            return zipfile.ZIP_STORED, None
+        for pattern, compress_type, compresslevel in self.rules:
+            if fnmatch.fnmatchcase(path, pattern):
+                return compress_type, compresslevel
+        if self.store_media:
+            if not mimetype:
+                mimetype, _ = mimetypes.guess_type(path)
+            if is_compressed_media(mimetype):
+                return zipfile.ZIP_STORED, None
+        return self.compress_type, self.compresslevel
+
+
+COMPRESSED_MIMETYPES = {
+    'image/gif',
+    'image/jpeg',
+    'image/png',
+    'image/webp',
+    'application/gzip',
+    'application/zip',
+    }
+COMPRESSION_PROFILES = {
+    'fastest': CompressionPolicy(zipfile.ZIP_DEFLATED, 1),
+    'balanced': CompressionPolicy(zipfile.ZIP_DEFLATED, 6),
+    'smallest': CompressionPolicy(zipfile.ZIP_DEFLATED, 9),
+    }
+
+
+def is_compressed_media(mimetype):
+    "tells if the content of mimetype is already compressed"
+    if not mimetype:
+        return False
+    return (mimetype in COMPRESSED_MIMETYPES
+        or mimetype.startswith(('audio/', 'video/')))
+
+
+def get_compression(compression=None, compress_type=zipfile.ZIP_DEFLATED,
+        compresslevel=None):
+    "returns the CompressionPolicy from a profile name or the parameters"
+    if compression is None:
+        return CompressionPolicy(compress_type, compresslevel)
+    elif isinstance(compression, str):
+        try:
+            return COMPRESSION_PROFILES[compression]
+        except KeyError:
+            raise ValueError("Unknown compression profile: %s" % compression)
+    return compression
+
+
+def zip_info(filename, date_time, compress_type, compresslevel=None):
+    "returns a ZipInfo for a new file with the compression"
+    zinfo = zipfile.ZipInfo(filename, date_time)
+    zinfo.compress_type = compress_type
+    zinfo.external_attr = 0o600 << 16
+    if hasattr(zinfo, 'compress_level'):
+        # public since Python 3.13
+        zinfo.compress_level = compresslevel
+    elif sys.version_info >= (3, 7):
+        zinfo._compresslevel = compresslevel
+    return zinfo
+
+
 class _AbstractZipWriteSplitStream(object):
-    def __init__(self, zipfile, chunksize=64, zip64=False):
+    def __init__(self, zipfile, chunksize=64, zip64=False, files=None):
         self.zipfile = zipfile
         self.chunksize = chunksize
         self.zip64 = zip64
+        # ZipInfo by path of the files
+        self.files = files or {}
+        # RenderStats timing the members
+        self.stats = None
 
     def open(self, zinfo):
         raise NotImplementedError
@@ -1054,12 +2756,26 @@ class _AbstractZipWriteSplitStream(object):
         raise NotImplementedError
 
     def __call__(self, stream):
+        stats = self.stats
+        member = None
         for kind, data, pos in stream:
             if kind == genshi.core.PI and data[0] == 'relatorio':
-                self.open(data[1])
+                zinfo = self.files.get(data[1], data[1])
+                if stats is None:
+                    self.open(zinfo)
+                    continue
+                stats.call('deflate', self.open, zinfo)
+                if member:
+                    stats.add_member(*member)
+                member = data[1], clocks()
                 continue
             yield kind, data, pos
-        self.close()
+        if stats is None:
+            self.close()
+        else:
+            stats.call('deflate', self.close)
+            if member:
+                stats.add_member(*member)
 
     def write(self, data):
         raise NotImplementedError
@@ -1119,77 +2835,588 @@ else:
             self._fp.write(data)
 
 
+class _ChunkSink(object):
+    "A non seekable file object collecting the written data"
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        "returns and forgets the data written so far"
+        chunk = b''.join(self._chunks)
+        self._chunks.clear()
+        return chunk
+
+
+def deflate_block(block, zdict=b'', level=None, last=False):
+    """returns the raw deflate of block which ends on a byte boundary.
+
+    zdict is the end of the previous block so the compression ratio is kept
+    and last ends the deflate stream. Joined in order, the blocks form one
+    deflate stream."""
+    if level is None:
+        level = zlib.Z_DEFAULT_COMPRESSION
+    options = {'zdict': zdict} if zdict else {}
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, **options)
+    return compressor.compress(block) + compressor.flush(
+        zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+def _write_precompressed(outzip, zinfo, data, compressed):
+    """writes data with its compression computed in advance by a future as a
+    raw member, raw_write_supported must be checked first"""
+    zinfo = copy.copy(zinfo)
+    compressed = compressed.result()
+    zinfo.CRC = zlib.crc32(data)
+    zinfo.file_size = len(data)
+    zinfo.compress_size = len(compressed)
+    write_raw_member(outzip, zinfo, compressed)
+
+
+class _ParallelZipWriteSplitStream(_ZipWriteSplitStream):
+    """Deflates the members by blocks in the threads of executor.
+
+    Each block is compressed with the end of the previous one as dictionary
+    and ends with a sync flush like pigz, so the joined blocks are one
+    deflate stream. It is kept in memory and written as a raw member, if
+    zipfile does not support it the members are deflated by zipfile."""
+    block_size = 128 * 1024
+
+    def __init__(self, zipfile, chunksize=64, zip64=False, files=None,
+            executor=None, window=4, compression=None):
+        super(_ParallelZipWriteSplitStream, self).__init__(
+            zipfile, chunksize, zip64, files)
+        self.executor = executor
+        # maximum number of blocks being compressed
+        self.window = window
+        self.compression = get_compression(compression)
+        # the futures of the blocks or None if written by zipfile
+        self._pending = None
+        self._compressed = []
+        self._data = bytearray()
+        self._previous = b''
+        self._level = None
+        self._crc = 0
+        self._size = 0
+
+    def flush(self):
+        if not self._fp and self._pending is None:
+            if (isinstance(self._zinfo, zipfile.ZipInfo)
+                    and self._zinfo.compress_type == zipfile.ZIP_DEFLATED
+                    and raw_write_supported(self.zipfile)):
+                self._pending = collections.deque()
+                _, self._level = self.compression(
+                    self._zinfo.filename, 'text/xml')
+            else:
+                self._fp = self.zipfile.open(
+                    self._zinfo, mode='w', force_zip64=self.zip64)
+        data = b''.join(self._buffer)
+        self._buffer.clear()
+        if self._pending is None:
+            self._fp.write(data)
+            return
+        self._data += data
+        while len(self._data) >= self.block_size:
+            block = bytes(self._data[:self.block_size])
+            del self._data[:self.block_size]
+            self._submit(block)
+
+    def _submit(self, block, last=False):
+        self._pending.append(self.executor.submit(
+                deflate_block, block, self._previous[-32768:], self._level,
+                last))
+        self._previous = block
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        while len(self._pending) > self.window:
+            self._compressed.append(self._pending.popleft().result())
+
+    def close(self):
+        self.flush()
+        if self._pending is None:
+            self._fp.close()
+        else:
+            self._submit(bytes(self._data), last=True)
+            self._compressed.extend(f.result() for f in self._pending)
+            compressed = b''.join(self._compressed)
+            zinfo = copy.copy(self._zinfo)
+            zinfo.CRC = self._crc
+            zinfo.file_size = self._size
+            zinfo.compress_size = len(compressed)
+            write_raw_member(self.zipfile, zinfo, compressed)
+            self._pending = None
+            self._compressed.clear()
+            self._data.clear()
+            self._previous = b''
+            self._crc = self._size = 0
+        self._zinfo = None
+        self._fp = None
+
+
 class OOSerializer:
 
     def __init__(self, source, files, chunksize=64,
             compresslevel=None, zip64=False,
-            compression_method=zipfile.ZIP_DEFLATED):
-        self.inzip = get_zip_file(source)
-        self.manifest = Manifest(self.inzip.read(MANIFEST))
+            compression_method=zipfile.ZIP_DEFLATED, compression=None,
+            compression_threads=None):
+        if not isinstance(source, SourceArchive):
+            source = SourceArchive(source)
+        self.archive = source
+        self.manifest = source.manifest.copy()
         self.xml_serializer = genshi.output.XMLSerializer()
         self._files = files
         self.chunksize = chunksize
-        self.compresslevel = None
+        self.compresslevel = compresslevel
         self.zip64 = zip64
         self.compression_method = compression_method
+        self.compression = get_compression(
+            compression, compression_method, compresslevel)
+        self.compression_threads = compression_threads
         self.outzip = None
+        # the writer of the XML parts into outzip
+        self._writer = None
+        # RenderStats collecting the timings and the counters
+        self.stats = None
+        # the start and end clocks of the compilation of the template
+        self.compile_clocks = None
         self._deferred = []
+        self._paths = set()
+        self._now = None
 
     def __call__(self, stream, method=None, encoding='utf-8', out=None):
         if out is None:
             result = BytesIO()
         else:
             result = out
+        for _ in self._serialize(stream, encoding, result):
+            pass
+        if out is None:
+            return result
+
+    def iter_bytes(self, stream, encoding='utf-8'):
+        """yields the chunks of the document as soon as they are written.
+
+        The archive is written without seeking so the sizes of the members are
+        stored in data descriptors."""
+        sink = _ChunkSink()
+        for _ in self._serialize(stream, encoding, sink):
+            chunk = sink.pop()
+            if chunk:
+                yield chunk
+        chunk = sink.pop()
+        if chunk:
+            yield chunk
+
+    def _serialize(self, stream, encoding, result):
+        "writes the document into result and yields after each write"
+        if (self.stats is not None and self.compile_clocks
+                and 'compile' not in self.stats.phases):
+            self.stats.add_span('compile', *self.compile_clocks)
+        start = clocks()
+        try:
+            if not self.compression_threads:
+                for step in self._write(stream, encoding, result):
+                    yield step
+            else:
+                with ThreadPoolExecutor(self.compression_threads) as executor:
+                    for step in self._write(
+                            stream, encoding, result, executor):
+                        yield step
+        except BaseException:
+            self._abort()
+            if self.stats is not None:
+                self.stats.add_span('render', start, aborted=True)
+            raise
+        if self.stats is not None:
+            self.stats.add_span('render', start)
+
+    def _abort(self):
+        "closes the writing handle and the archive of an aborted rendering"
+        writer, self._writer = self._writer, None
+        for fileobj in [getattr(writer, '_fp', None), self.outzip]:
+            if fileobj is not None:
+                try:
+                    fileobj.close()
+                except Exception:
+                    pass
+
+    def _write(self, stream, encoding, result, executor=None):
         zip_options = {}
         if sys.version_info >= (3, 7):
-            zip_options['compresslevel'] = self.compresslevel
+            zip_options['compresslevel'] = self.compression.compresslevel
         self.outzip = zipfile.ZipFile(
-            result, mode='w', compression=self.compression_method,
+            result, mode='w', compression=self.compression.compress_type,
             **zip_options)
         files = {}
-        now = time.localtime()[:6]
+        stats = self.stats
+        self._now = now = time.localtime()[:6]
         manifest_info = None
-        for f_info in self.inzip.infolist():
+        for f_info in self.archive.infolist:
             if f_info.filename.startswith('ObjectReplacements'):
                 continue
             elif f_info.filename in self._files:
                 # create a new file descriptor, copying some attributes from
                 # the original file
-                new_info = zipfile.ZipInfo(f_info.filename, now)
-                for attr in ('compress_type', 'flag_bits', 'create_system'):
-                    setattr(new_info, attr, getattr(f_info, attr))
+                new_info = zip_info(f_info.filename, now,
+                    *self.compression(f_info.filename, 'text/xml'))
+                new_info.create_system = f_info.create_system
                 files[f_info.filename] = new_info
             elif f_info.filename == MANIFEST:
                 manifest_info = f_info
             elif f_info.filename.startswith(THUMBNAILS + '/'):
                 self.manifest.remove_file_entry(f_info.filename)
             else:
-                self.outzip.writestr(f_info, self.inzip.read(f_info.filename))
-
-        writer = _ZipWriteSplitStream(self.outzip, self.chunksize, self.zip64)
-        output_encode(
-            self.xml_serializer(writer(stream)), encoding=encoding, out=writer)
-
-        for args in self._deferred:
-            self.add_file(*args)
+                if stats is not None:
+                    start = clocks()
+                self.archive.copy_member(self.outzip, f_info)
+                if stats is not None:
+                    stats.add_member(f_info.filename, start, phase='copy')
+                yield
+
+        if executor:
+            writer = _ParallelZipWriteSplitStream(
+                self.outzip, self.chunksize, self.zip64, files,
+                executor=executor, window=2 * self.compression_threads,
+                compression=self.compression)
+        else:
+            writer = _ZipWriteSplitStream(
+                self.outzip, self.chunksize, self.zip64, files)
+        self._writer = writer
+        if stats is None:
+            for chunk in self.xml_serializer(writer(stream)):
+                writer.write(chunk.encode(encoding, 'xmlcharrefreplace'))
+                yield
+        else:
+            writer.stats = stats
+            start = clocks()
+            before = stats.totals('evaluate', 'deflate')
+            for chunk in self.xml_serializer(
+                    writer(stats.timed('evaluate', stream, 'events'))):
+                stats.call('deflate', writer.write,
+                    chunk.encode(encoding, 'xmlcharrefreplace'))
+                yield
+            # the serializer takes the time not spent in the template and in
+            # the writer
+            after = stats.totals('evaluate', 'deflate')
+            stats.add('serialize', *(e - s - (a - b) for e, s, a, b in zip(
+                        clocks(), start, after, before)))
+
+        if executor:
+            # compress the files concurrently
+            deferred = []
+            for path, content, mimetype in self._deferred:
+                compress_type, compresslevel = self.compression(
+                    path, mimetype)
+                future = None
+                if (compress_type == zipfile.ZIP_DEFLATED
+                        and raw_write_supported(self.outzip)):
+                    future = executor.submit(
+                        deflate_block, content, level=compresslevel,
+                        last=True)
+                deferred.append((path, content, mimetype, future))
+            for path, content, mimetype, future in deferred:
+                if stats is None:
+                    self._write_file(path, content, mimetype, future)
+                else:
+                    stats.call('deferred', self._write_file,
+                        path, content, mimetype, future)
+                yield
+        elif stats is not None:
+            for args in self._deferred:
+                stats.call('deferred', self._write_file, *args)
+                yield
+        else:
+            for args in self._deferred:
+                self._write_file(*args)
+                yield
+        self._deferred.clear()
         self.manifest.remove_file_entry(THUMBNAILS + '/')
         if manifest_info:
-            self.outzip.writestr(manifest_info, str(self.manifest))
-        self.inzip.close()
+            compress_type, compresslevel = self.compression(
+                MANIFEST, 'text/xml')
+            self.outzip.writestr(
+                copy.copy(manifest_info), str(self.manifest),
+                compress_type=compress_type, compresslevel=compresslevel)
         self.outzip.close()
-
-        if out is None:
-            return result
+        if stats is not None:
+            for info in self.outzip.infolist():
+                stats.set_sizes(
+                    info.filename, info.file_size, info.compress_size)
 
     def add_file(self, path, content, mimetype):
+        "adds the file to the document once"
+        if path in self._paths:
+            return
+        self._paths.add(path)
         if not self.outzip:
-            self._deferred.append((path, content, mimetype))
-        elif path not in self.outzip.namelist():
+            self._defer(path, content, mimetype)
+        else:
             try:
-                self.outzip.writestr(path, content)
-                self.manifest.add_file_entry(path, mimetype)
+                self._write_file(path, content, mimetype)
             except ValueError:
-                self._deferred.append((path, content, mimetype))
+                self._defer(path, content, mimetype)
+
+    def _defer(self, path, content, mimetype):
+        "keeps the file to write it once the XML parts are written"
+        self._deferred.append((path, content, mimetype))
+        if self.stats is not None:
+            self.stats.count('deferred_bytes', len(content))
+
+    def _write_file(self, path, content, mimetype, compressed=None):
+        "writes the file with its compression computed by the future"
+        if path not in self.outzip.NameToInfo:
+            if self.stats is not None:
+                start = clocks()
+            zinfo = zip_info(
+                path, self._now, *self.compression(path, mimetype))
+            if compressed is not None:
+                _write_precompressed(self.outzip, zinfo, content, compressed)
+            else:
+                self.outzip.writestr(zinfo, content)
+            self.manifest.add_file_entry(path, mimetype)
+            if self.stats is not None:
+                self.stats.add_member(
+                    path, start, phase='deflate', mimetype=mimetype)
+
+
+# the children of the root of flat documents in their order
+FLAT_CHILDREN = ['meta', 'settings', 'scripts', 'font-face-decls', 'styles',
+    'automatic-styles', 'master-styles', 'body']
+FLAT_SPLIT = genshi.core.StreamEventKind('RELATORIO_FLAT_SPLIT')
+XLINK_URI = 'http://www.w3.org/1999/xlink'
+
+
+class FlatOOSerializer(OOSerializer):
+    """Serializes the document into one flat OpenDocument XML stream.
+
+    The children of the roots of the parts are spooled by name and written in
+    the order of the flat document once the stream is consumed. The images
+    are inlined as office:binary-data and the embedded objects as
+    office:document."""
+    spool_size = 1024 * 1024
+
+    def __init__(self, source, files, **kwargs):
+        super(FlatOOSerializer, self).__init__(source, files, **kwargs)
+        self._added = {}
+        self._encoded = {}
+        self._members = {i.filename for i in self.archive.infolist}
+        self._spools = {}
+        self._output = None
+        self._namespaces = {}
+        self._roots = {}
+        self._office = None
+        self._encoding = None
+
+    def add_file(self, path, content, mimetype):
+        "adds the file to be inlined"
+        if path not in self._added:
+            self._added[path] = content
+            if self.stats is not None:
+                self.stats.count('deferred_bytes', len(content))
+
+    def _binary_data(self, href):
+        "returns the base64 of the file at href or None"
+        path = href[2:] if href.startswith('./') else href
+        if path not in self._encoded:
+            if path in self._added:
+                content = self._added[path]
+            elif path in self._members:
+                content = self.archive.read(path)
+            else:
+                return None
+            self._encoded[path] = base64.b64encode(content).decode('ascii')
+        return self._encoded[path]
+
+    def _write(self, stream, encoding, result, executor=None):
+        self._encoding = encoding
+        stats = self.stats
+        try:
+            if stats is not None:
+                start = clocks()
+                before = stats.totals('evaluate')
+                stream = stats.timed('evaluate', stream, 'events')
+            for chunk in self.xml_serializer(self._split(stream)):
+                if self._output is not None:
+                    self._output.write(
+                        chunk.encode(encoding, 'xmlcharrefreplace'))
+            if stats is not None:
+                after = stats.totals('evaluate')
+                stats.add('serialize', *(e - s - (a - b)
+                        for e, s, a, b in zip(clocks(), start, after, before)))
+                start = clocks()
+            size = 0
+            result.write(('<?xml version="1.0" encoding="%s"?>\n' % encoding
+                    ).encode(encoding))
+            for data in self._document('', encoding):
+                result.write(data)
+                size += len(data)
+                yield
+            if stats is not None:
+                stats.add_span('copy', start)
+                stats.count('bytes_in', size)
+                stats.count('bytes_out', size)
+        finally:
+            for segments in self._spools.values():
+                for segment in segments:
+                    if not isinstance(segment, str):
+                        segment.close()
+            self._spools.clear()
+
+    def _spool(self, key, document=None):
+        "starts a new segment of the spool of key"
+        segments = self._spools.setdefault(key, [])
+        if document is not None:
+            segments.append(document)
+        self._output = tempfile.SpooledTemporaryFile(self.spool_size)
+        segments.append(self._output)
+
+    def _split(self, stream):
+        """routes the output of the events to the spools of the children of
+        the roots.
+
+        The FLAT_SPLIT events flush the events held by the filters of the
+        serializer before the output is changed."""
+        START, END = genshi.core.START, genshi.core.END
+        split = (FLAT_SPLIT, None, (None, -1, -1))
+        document = key = None
+        depth = 0
+        font_faces = collections.defaultdict(set)
+        for event in stream:
+            kind, data, pos = event
+            if kind is genshi.core.PI and data[0] == 'relatorio':
+                document, _, part = data[1].rpartition('/')
+                depth = 0
+                continue
+            elif kind is genshi.core.START_NS:
+                self._namespaces.setdefault(data[0], data[1])
+            elif kind is START:
+                depth += 1
+                tag, attrs = data
+                if depth == 1:
+                    if part == 'content.xml':
+                        self._roots[document] = attrs
+                    self._office = tag.namespace
+                elif depth == 2:
+                    yield split
+                    self._output = None
+                    yield event
+                    yield split
+                    key = (document, tag.localname)
+                    self._spool(key)
+                    continue
+                elif depth == 3 and key[1] == 'font-face-decls':
+                    name = attrs.get('{%s}name' % tag.namespace)
+                    if name in font_faces[document]:
+                        yield split
+                        self._output = None
+                    font_faces[document].add(name)
+                href = attrs.get('{%s}href' % XLINK_URI)
+                if href and tag.localname in {'image', 'object'}:
+                    attrs = genshi.core.Attrs([(n, v) for n, v in attrs
+                            if n.namespace != XLINK_URI])
+                    if tag.localname == 'object':
+                        inner = href[2:] if href.startswith('./') else href
+                        if inner + '/content.xml' in self._files:
+                            yield START, (tag, attrs), pos
+                            yield split
+                            self._spool(key, inner)
+                            continue
+                    else:
+                        content = self._binary_data(href)
+                        if content is not None:
+                            binary_data = genshi.core.QName(
+                                '{%s}binary-data' % self._office)
+                            yield START, (tag, attrs), pos
+                            yield (START,
+                                (binary_data, genshi.core.Attrs()), pos)
+                            # the data is written without the filters
+                            yield split
+                            if self._output is not None:
+                                self._output.write(
+                                    content.encode(self._encoding))
+                            yield END, binary_data, pos
+                            continue
+            elif kind is END:
+                depth -= 1
+                if depth == 1:
+                    yield split
+                    self._output = None
+                elif depth == 2 and self._output is None:
+                    # the end of a font face already declared
+                    yield event
+                    yield split
+                    self._spool(key)
+                    continue
+            yield event
+
+    def _document(self, document, encoding):
+        "yields the data of the flat document"
+        def tag(name, attrs=(), end=False):
+            return ('<%s%s:%s%s>' % ('/' if end else '', office, name,
+                    ''.join(' %s="%s"' % (n, escape(v)) for n, v in attrs))
+                ).encode(encoding, 'xmlcharrefreplace')
+
+        escape = genshi.core.escape
+        namespaces = self._namespaces
+        office = next((p for p, u in namespaces.items() if u == self._office),
+            None)
+        attrs = []
+        if not document:
+            if office is None:
+                office = 'office'
+                namespaces = dict(namespaces, office=self._office)
+            attrs.extend(('xmlns:%s' % p if p else 'xmlns', u)
+                for p, u in namespaces.items())
+            mimetype = self.archive.read('mimetype').decode('ascii')
+        else:
+            entry = self.manifest.entries.get(document + '/')
+            mimetype = entry.get(
+                '{%s}media-type' % self.manifest.namespaces['manifest'])
+        version = self._roots.get(document, {}).get(
+            '{%s}version' % self._office)
+        if version:
+            attrs.append(('%s:version' % office, version))
+        if mimetype:
+            attrs.append(('%s:mimetype' % office, mimetype))
+        yield tag('document', attrs)
+        for name in FLAT_CHILDREN:
+            if name == 'settings':
+                path = (document + '/' if document else '') + 'settings.xml'
+                if path not in self._members:
+                    continue
+                settings = lxml.etree.fromstring(self.archive.read(path))
+                yield tag(name)
+                for child in settings.iterchildren('{%s}settings' %
+                        self._office):
+                    for item in child:
+                        yield lxml.etree.tostring(item, encoding=encoding,
+                            xml_declaration=False, with_tail=False)
+                yield tag(name, end=True)
+                continue
+            segments = self._spools.get((document, name))
+            if segments is None:
+                continue
+            yield tag(name)
+            for segment in segments:
+                if isinstance(segment, str):
+                    for data in self._document(segment, encoding):
+                        yield data
+                    continue
+                segment.seek(0)
+                while True:
+                    data = segment.read(64 * 1024)
+                    if not data:
+                        break
+                    yield data
+            yield tag(name, end=True)
+        yield tag('document', end=True)
 
 
 MIMETemplateLoader.add_factory('oo.org', Template)
@@ -1,11 +1,22 @@
 # This file is part of relatorio.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import asyncio
+import io
 import os
+import pickle
+import sys
+import tempfile
+import threading
 import unittest
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+from genshi.template import NewTextTemplate, TemplateNotFound
 
 from relatorio.reporting import (
-    DefaultFactory, MIMETemplateLoader, Report, ReportRepository, _absolute,
-    _guess_type)
+    AsyncIterableBridge, AsyncSinkWriter, DefaultFactory, MIMETemplateLoader,
+    RenderResult, Report, ReportRepository, TemplateCache, _absolute,
+    _guess_type, bridge_async_iterables, template_size)
 
 
 class StubObject(object):
@@ -15,6 +26,22 @@ class StubObject(object):
             setattr(self, key, val)
 
 
+class AsyncSink(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    async def write(self, data):
+        await asyncio.sleep(0)
+        self.chunks.append(data)
+
+
+async def arange(stop):
+    for i in range(stop):
+        await asyncio.sleep(0)
+        yield i
+
+
 class TestRepository(unittest.TestCase):
 
     def test_register(self):
@@ -41,6 +68,52 @@ class TestRepository(unittest.TestCase):
         self.assertEqual(name, 'default')
         self.assertEqual(report, report2)
 
+    def test_warm(self):
+        "Testing the templates are compiled into the loader cache"
+        reporting = ReportRepository()
+        reporting.loader = MIMETemplateLoader()
+        our_dir = os.path.dirname(__file__)
+        for name in ['test.tmpl', 'include.tmpl']:
+            reporting.add_report(StubObject, 'text/plain',
+                os.path.join(our_dir, 'templates', name), report_name=name)
+        results = reporting.warm(workers=2)
+
+        self.assertEqual(sorted(os.path.basename(r.path) for r in results),
+            ['include.tmpl', 'test.tmpl'])
+        self.assertTrue(all(r.seconds >= 0 for r in results))
+        self.assertTrue(all(r.error is None for r in results))
+        report, _, _ = reporting.by_id(StubObject, 'test.tmpl')
+        misses = reporting.loader.cache_info().misses
+        self.assertEqual(
+            report(o=StubObject(name='Foo')).render(), 'Hello Foo.\n')
+        self.assertEqual(reporting.loader.cache_info().misses, misses)
+
+    def test_warm_errors(self):
+        "Testing the errors of the templates are returned by warm"
+        reporting = ReportRepository()
+        reporting.loader = MIMETemplateLoader(max_cache_size=1)
+        our_dir = os.path.dirname(__file__)
+        for name in ['test.tmpl', 'missing.tmpl']:
+            reporting.add_report(StubObject, 'text/plain',
+                os.path.join(our_dir, 'templates', name), report_name=name)
+        other = MIMETemplateLoader()
+        reporting.by_id(StubObject, 'test.tmpl')[0].tmpl_loader = other
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            results = reporting.warm()
+        self.assertEqual(caught, [])
+
+        test, missing = results
+        self.assertIsNone(test.error)
+        self.assertEqual(other.cache_info().currsize, 1)
+        self.assertIsNone(missing.seconds)
+        self.assertIsInstance(missing.error, TemplateNotFound)
+
+        reporting.by_id(StubObject, 'test.tmpl')[0].tmpl_loader = (
+            reporting.loader)
+        with self.assertWarns(UserWarning):
+            reporting.warm()
+
     def test_mimeguesser(self):
         self.assertEqual(_guess_type('application/pdf'), 'pdf')
         self.assertEqual(_guess_type('text/plain'), 'text')
@@ -97,6 +170,304 @@ class TestReport(unittest.TestCase):
             "Hi Foo,\nIt's One o'clock to 5 !\n")
         self.assertRaises(TypeError, report, a)
 
+    def test_render_many(self):
+        "Testing the rendering of many data in this process"
+        datas = [{'o': StubObject(name='Foo')}, {}]
+        results = self.report.render_many(datas, workers=1)
+
+        self.assertEqual(results[0], RenderResult(0, 'Hello Foo.\n', None))
+        self.assertEqual(results[1].index, 1)
+        self.assertIsNone(results[1].result)
+        self.assertIsInstance(results[1].error, Exception)
+
+    def test_render_many_workers(self):
+        "Testing the rendering of many data in worker processes"
+        datas = [{'o': StubObject(name=str(i))} for i in range(5)]
+        datas.insert(2, {})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            def out_factory(index, data):
+                if index % 2:
+                    return io.BytesIO()
+                return os.path.join(tmpdir, '%s.txt' % index)
+            results = self.report.render_many(
+                datas, out_factory=out_factory, workers=2)
+
+            self.assertEqual([r.index for r in results], list(range(6)))
+            self.assertIsNotNone(results[2].error)
+            for index, name in [(0, '0'), (4, '3')]:
+                with open(results[index].result, 'rb') as fp:
+                    self.assertEqual(fp.read(), b'Hello %s.\n' % name.encode())
+            for index, name in [(1, '1'), (3, '2'), (5, '4')]:
+                self.assertEqual(results[index].result.getvalue(),
+                    b'Hello %s.\n' % name.encode())
+
+    def test_render_async(self):
+        "Testing the asynchronous rendering"
+        sink = AsyncSink()
+        asyncio.run(self.report.render_async(sink, o=StubObject(name='Foo')))
+        self.assertEqual(b''.join(sink.chunks), b'Hello Foo.\n')
+
+    def test_render_async_cancel(self):
+        "Testing the cancelled rendering releases its executor thread"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'items.tmpl')
+            with open(path, 'w') as fp:
+                fp.write('{% for i in items %}${i}{% end %}')
+            report = Report(path, 'text/plain', DefaultFactory(), self.loader)
+
+            async def blocked():
+                yield 1
+                await asyncio.Event().wait()
+
+            def running():
+                return [t for t in threading.enumerate()
+                    if t.name.startswith('relatorio-cancel')]
+
+            async def cancel():
+                executor = ThreadPoolExecutor(
+                    thread_name_prefix='relatorio-cancel')
+                asyncio.get_running_loop().set_default_executor(executor)
+                task = asyncio.ensure_future(
+                    report.render_async(AsyncSink(), items=blocked()))
+                await asyncio.sleep(0.2)
+                self.assertTrue(running())
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                executor.shutdown(wait=False)
+                for _ in range(100):
+                    if not running():
+                        break
+                    await asyncio.sleep(0.05)
+                return running()
+            self.assertEqual(asyncio.run(cancel()), [])
+
+    def test_async_iterable(self):
+        "Testing the iteration over an asynchronous iterable"
+        template = NewTextTemplate('{% for i in items %}${i},{% end %}')
+
+        async def render():
+            items = AsyncIterableBridge(arange(100), prefetch=4)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, lambda: template.generate(items=items).render())
+        self.assertEqual(
+            asyncio.run(render()), ''.join('%s,' % i for i in range(100)))
+
+    def test_async_iterable_error(self):
+        "Testing the errors of an asynchronous iterable are raised"
+        async def failing():
+            yield 1
+            raise ValueError('failing')
+
+        async def consume():
+            items = AsyncIterableBridge(failing())
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, list, items)
+        with self.assertRaises(ValueError):
+            asyncio.run(consume())
+
+    def test_async_iterable_once(self):
+        "Testing an asynchronous iterable can not be iterated twice"
+        async def consume():
+            items = AsyncIterableBridge(arange(3))
+            loop = asyncio.get_running_loop()
+            first = await loop.run_in_executor(None, list, items)
+            with self.assertRaises(RuntimeError):
+                await loop.run_in_executor(None, list, items)
+            return first
+        self.assertEqual(asyncio.run(consume()), [0, 1, 2])
+
+    def test_bridge_nested(self):
+        "Testing the asynchronous iterables nested in the data are bridged"
+        template = NewTextTemplate(
+            '{% for l in o.lines %}${l}{% end %}'
+            '{% for i in d["values"] %}${i}{% end %}'
+            '{% for i in t[1] %}${i}{% end %}')
+
+        async def render():
+            o = StubObject(name='Foo', lines=arange(2))
+            data = {'o': o, 'd': {'values': arange(3)}, 't': (1, arange(4))}
+            bridges = []
+            bridged = bridge_async_iterables(data, bridges)
+            self.assertEqual(len(bridges), 3)
+            self.assertIsNot(bridged['o'], o)
+            self.assertEqual(bridged['o'].name, 'Foo')
+            self.assertNotIsInstance(o.lines, AsyncIterableBridge)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, lambda: template.generate(**bridged).render())
+        self.assertEqual(asyncio.run(render()), '010120123')
+
+    def test_sink_writer_buffer(self):
+        "Testing the writes to the asynchronous sink are buffered"
+        sink = AsyncSink()
+
+        async def write():
+            writer = AsyncSinkWriter(sink, asyncio.get_running_loop(), 10)
+
+            def writes():
+                for i in range(25):
+                    writer.write(b'x')
+                writer.flush()
+            await asyncio.get_running_loop().run_in_executor(None, writes)
+        asyncio.run(write())
+        self.assertEqual([len(c) for c in sink.chunks], [10, 10, 5])
+
+    def test_pickle_loader(self):
+        "Testing the loader is pickled without its templates"
+        self.report(o=StubObject(name='Foo'))
+        loader = pickle.loads(pickle.dumps(self.loader))
+        self.assertEqual(len(loader._cache), 0)
+        report = Report(self.report.fpath, 'text/plain', loader=loader)
+        self.assertEqual(
+            report(o=StubObject(name='Foo')).render(), 'Hello Foo.\n')
+
+
+class TestLoaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def template(self, name, text):
+        path = os.path.join(self.directory.name, name)
+        with open(path, 'w') as fp:
+            fp.write(text)
+        return path
+
+    def change(self, path, text):
+        mtime = os.path.getmtime(path)
+        with open(path, 'w') as fp:
+            fp.write(text)
+        os.utime(path, (mtime + 1, mtime + 1))
+
+    def render(self, loader, path):
+        return loader.load(path, 'text/plain').generate().render()
+
+    def test_cache_info(self):
+        "Testing the counters of the cache"
+        loader = MIMETemplateLoader(max_cache_size=1)
+        foo = self.template('foo.tmpl', 'Foo')
+        bar = self.template('bar.tmpl', 'Bar')
+        loader.load(foo, 'text/plain')
+        loader.load(foo, 'text/plain')
+        loader.load(bar, 'text/plain')
+        info = loader.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.evictions, 1)
+        self.assertEqual(info.currsize, 1)
+        self.assertGreater(info.bytes, 0)
+        self.assertIsNone(info.maxbytes)
+
+    def test_max_bytes(self):
+        "Testing the cache is bounded by the size of the templates"
+        foo = self.template('foo.tmpl', 'Foo ${1}')
+        bar = self.template('bar.tmpl', 'Bar ${2}')
+        big = self.template('big.tmpl', 'Big ${3}' * 100)
+        loader = MIMETemplateLoader()
+        size = template_size(loader.load(foo, 'text/plain'))
+        loader = MIMETemplateLoader(max_cache_bytes=size * 3 // 2)
+        loader.load(foo, 'text/plain')
+        loader.load(bar, 'text/plain')
+        info = loader.cache_info()
+        self.assertEqual(info.currsize, 1)
+        self.assertEqual(info.evictions, 1)
+        self.assertLessEqual(info.bytes, size * 3 // 2)
+        self.assertEqual(self.render(loader, big), 'Big 3' * 100)
+        info = loader.cache_info()
+        self.assertEqual(info.currsize, 1)
+        self.assertEqual(info.rejected, 1)
+
+    def test_reject_larger(self):
+        "Testing a template larger than max_bytes does not evict the others"
+        evicted = []
+        cache = TemplateCache(10, max_bytes=100, on_evict=evicted.append)
+        for i in range(5):
+            cache[i] = StubObject(memory_size=lambda: 10)
+        cache['big'] = StubObject(memory_size=lambda: 500)
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(cache.bytes, 50)
+        self.assertNotIn('big', cache)
+        self.assertEqual((cache.evictions, cache.rejected), (0, 1))
+        self.assertEqual(evicted, [])
+
+    def test_preload_concurrent(self):
+        "Testing the templates are compiled concurrently by preload"
+        barrier = threading.Barrier(2, timeout=5)
+
+        class WaitingTemplate(NewTextTemplate):
+            def __init__(self, *args, **kwargs):
+                barrier.wait()
+                super(WaitingTemplate, self).__init__(*args, **kwargs)
+
+        paths = [self.template('foo.tmpl', 'Foo'),
+            self.template('bar.tmpl', 'Bar')]
+        loader = MIMETemplateLoader()
+        with ThreadPoolExecutor(2) as executor:
+            seconds = list(executor.map(
+                    lambda p: loader.preload(p, cls=WaitingTemplate), paths))
+        self.assertTrue(all(s > 0 for s in seconds))
+        self.assertEqual(loader.cache_info().currsize, 2)
+        self.assertEqual(loader.preload(paths[0], cls=WaitingTemplate), 0)
+        self.assertEqual(self.render(loader, paths[1]), 'Bar')
+
+    def test_revalidate_ttl(self):
+        "Testing the templates are checked once per ttl"
+        path = self.template('foo.tmpl', 'Foo')
+        loader = MIMETemplateLoader(auto_reload=True, revalidate_ttl=3600)
+        self.assertEqual(self.render(loader, path), 'Foo')
+        self.change(path, 'Bar')
+        self.assertEqual(self.render(loader, path), 'Foo')
+
+        loader = MIMETemplateLoader(auto_reload=True)
+        self.assertEqual(self.render(loader, path), 'Bar')
+        self.change(path, 'Baz')
+        self.assertEqual(self.render(loader, path), 'Baz')
+        self.assertEqual(loader.cache_info().misses, 2)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "requires Linux")
+    def test_inotify(self):
+        "Testing the templates are reloaded after a change"
+        path = self.template('foo.tmpl', 'Foo')
+        loader = MIMETemplateLoader(
+            auto_reload=True, revalidate_ttl=3600, inotify=True)
+        self.assertEqual(self.render(loader, path), 'Foo')
+        changed = loader._uptodate.watcher.watch(path)
+        self.assertEqual(self.render(loader, path), 'Foo')
+        self.change(path, 'Bar')
+        self.assertTrue(changed.wait(5))
+        self.assertEqual(self.render(loader, path), 'Bar')
+        self.assertEqual(loader.cache_info().misses, 2)
+        loader.close()
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "requires Linux")
+    def test_inotify_shared(self):
+        "Testing the loaders share the inotify watcher until closed"
+        loader = MIMETemplateLoader(auto_reload=True, inotify=True)
+        unpickled = pickle.loads(pickle.dumps(loader))
+        watcher = loader._uptodate.watcher
+        self.assertIs(unpickled._uptodate.watcher, watcher)
+        unpickled.close()
+        self.assertTrue(watcher.active)
+        loader.close()
+        self.assertFalse(watcher.active)
+        self.assertFalse(watcher._thread.is_alive())
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "requires Linux")
+    def test_inotify_evict(self):
+        "Testing the evicted templates are not watched"
+        foo = self.template('foo.tmpl', 'Foo')
+        bar = self.template('bar.tmpl', 'Bar')
+        loader = MIMETemplateLoader(
+            auto_reload=True, max_cache_size=1, inotify=True)
+        self.addCleanup(loader.close)
+        self.render(loader, foo)
+        self.render(loader, bar)
+        self.assertEqual(list(loader._uptodate), [bar])
+        self.assertEqual(list(loader._uptodate.watcher._events), [bar])
+
 
 class TestReportInclude(unittest.TestCase):
 
@@ -1,19 +1,53 @@
 # -*- encoding: utf-8 -*-
 # This file is part of relatorio.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import asyncio
+import base64
+import datetime
+import json
+import multiprocessing
 import os
+import pickle
+import tempfile
+import tracemalloc
 import unittest
 import zipfile
+from decimal import Decimal
+from fractions import Fraction
 from io import BytesIO, StringIO
+from itertools import chain
+from unittest.mock import Mock, patch
 
 import lxml.etree
-from genshi.core import PI
+from genshi.core import PI, TEXT, Stream
 from genshi.filters import Translator
-from genshi.template.eval import UndefinedError
-
+from genshi.input import XMLParser
+from genshi.template.base import SUB
+from genshi.template.eval import Expression, StrictLookup, UndefinedError
+
+try:
+    import PIL.Image
+except ImportError:
+    PIL = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+from relatorio.reporting import Report
+from relatorio.stats import (
+    MemoryBudgetExceeded, MemoryStats, RenderStats, clocks)
 from relatorio.templates.opendocument import (
-    GENSHI_EXPR, GENSHI_URI, RELATORIO_URI, Template, escape_xml_invalid_chars,
-    fod2od, remove_node_keeping_tail)
+    GENSHI_EXPR, GENSHI_URI, RELATORIO_URI, CellEncoders, ColumnarRows,
+    ColumnCounter, CompressionPolicy, DuplicateColumnHeaders, ImageHref,
+    RowForDirective, Template, _downsample_image, _ParallelZipWriteSplitStream,
+    _RowExpressionTransformer, downsample_image, encode_number,
+    escape_xml_invalid_chars, etree_to_stream, fod2od, length_to_pixels,
+    raw_write_supported, remove_node_keeping_tail, sniff_mimetype)
 
 OO_TABLE_NS = "urn:oasis:names:tc:opendocument:xmlns:table:1.0"
 
@@ -36,6 +70,15 @@ def stream_to_string(stream):
     return stream
 
 
+def row_directives(stream):
+    for kind, data, _ in stream:
+        if kind is SUB:
+            for directive in data[0]:
+                if isinstance(directive, RowForDirective):
+                    yield directive
+            yield from row_directives(data[1])
+
+
 class TestOOTemplating(unittest.TestCase):
 
     def setUp(self):
@@ -206,6 +249,21 @@ class TestOOTemplating(unittest.TestCase):
             child.get('{http://genshi.edgewall.org/}attrs'),
             "{'{urn:xlink}href': 'foo'}")
 
+    def test_soft_page_break_and_escape(self):
+        "Testing soft page breaks are removed and prefixes are escaped"
+        xml = b'''<xml xmlns:text="urn:text" xmlns:office="urn:office">
+                    <office:text text:use-soft-page-breaks="true">
+                        <text:p>10 $<text:soft-page-break/>tail $</text:p>
+                    </office:text>
+                 </xml>'''
+        interpolated = self.oot.insert_directives(xml)
+        root_interpolated = lxml.etree.parse(interpolated).getroot()
+        office_text = root_interpolated[0]
+        self.assertFalse(office_text.attrib)
+        paragraph = office_text[0]
+        self.assertEqual(len(paragraph), 0)
+        self.assertEqual(paragraph.text, '10 $$tail $$')
+
     def test_column_looping(self):
         xml = b'''
 <table:table
@@ -431,6 +489,276 @@ class TestOOTemplating(unittest.TestCase):
                 'meta.xml', 'settings.xml', 'META-INF/manifest.xml'},
             set(rendered_zip.namelist()))
 
+    def test_render_raw_copy(self):
+        "Testing untouched members are copied without recompression"
+        rendered = self.oot.generate(**self.data).render()
+        with zipfile.ZipFile(rendered) as rendered_zip, \
+                zipfile.ZipFile(self._source) as source_zip:
+            self.assertIsNone(rendered_zip.testzip())
+            for name in ['settings.xml', 'manifest.rdf']:
+                info = rendered_zip.getinfo(name)
+                source_info = source_zip.getinfo(name)
+                self.assertEqual(info.CRC, source_info.CRC)
+                self.assertEqual(info.compress_size, source_info.compress_size)
+                self.assertEqual(
+                    rendered_zip.read(name), source_zip.read(name))
+
+    def test_render_raw_copy_unsupported(self):
+        "Testing the members are recompressed without raw copy support"
+        with patch('relatorio.templates.opendocument._raw_write_checked',
+                False):
+            rendered = self.oot.generate(**self.data).render()
+        with zipfile.ZipFile(rendered) as rendered_zip, \
+                zipfile.ZipFile(self._source) as source_zip:
+            self.assertIsNone(rendered_zip.testzip())
+            for name in ['settings.xml', 'manifest.rdf']:
+                self.assertEqual(
+                    rendered_zip.read(name), source_zip.read(name))
+
+    def test_raw_write_supported(self):
+        "Testing the raw copy is supported by the zipfile module"
+        with zipfile.ZipFile(BytesIO(), 'w') as outzip:
+            self.assertTrue(raw_write_supported(outzip))
+
+    def test_render_async(self):
+        "Testing the asynchronous rendering into a stream"
+        class Sink:
+            def __init__(self):
+                self.content = BytesIO()
+                self.drained = 0
+
+            def write(self, data):
+                self.content.write(data)
+
+            async def drain(self):
+                self.drained += 1
+
+        sink = Sink()
+        asyncio.run(self.oot.generate(**self.data).render_async(sink))
+        self.assertGreater(sink.drained, 0)
+        with zipfile.ZipFile(sink.content) as result_zip:
+            self.assertIsNone(result_zip.testzip())
+
+    def test_render_async_iterable(self):
+        "Testing the asynchronous iterables of the asynchronous rendering"
+        async def hobbies():
+            for hobby in self.data['hobbies']:
+                await asyncio.sleep(0)
+                yield hobby
+
+        class Sink:
+            def __init__(self):
+                self.content = BytesIO()
+
+            async def write(self, data):
+                self.content.write(data)
+
+        async def render():
+            sink = Sink()
+            stream = self.oot.generate(**dict(self.data, hobbies=hobbies()))
+            self.assertEqual(len(stream.bridges), 1)
+            await stream.render_async(sink)
+            return sink.content
+        result = asyncio.run(render())
+        expected = self.oot.generate(**self.data).render()
+        with zipfile.ZipFile(result) as result_zip, \
+                zipfile.ZipFile(expected) as expected_zip:
+            self.assertEqual(result_zip.read('content.xml'),
+                expected_zip.read('content.xml'))
+
+    def test_iter_bytes(self):
+        "Testing the rendering by chunks"
+        chunks = list(self.oot.generate(**self.data).iter_bytes())
+        self.assertGreater(len(chunks), 1)
+        result = self.oot.generate(**self.data).render()
+        with zipfile.ZipFile(BytesIO(b''.join(chunks))) as chunks_zip, \
+                zipfile.ZipFile(result) as result_zip:
+            self.assertIsNone(chunks_zip.testzip())
+            self.assertEqual(chunks_zip.namelist(), result_zip.namelist())
+            self.assertTrue(chunks_zip.getinfo('content.xml').flag_bits & 0x08)
+            self.assertEqual(
+                chunks_zip.read('styles.xml'), result_zip.read('styles.xml'))
+
+    def test_generate_many(self):
+        "Testing the generation of many streams from one template"
+        streams = list(self.oot.generate_many([self.data, self.data]))
+        self.assertEqual(len(streams), 2)
+        self.assertIsNot(streams[0].serializer, streams[1].serializer)
+        for stream in streams:
+            with zipfile.ZipFile(stream.render()) as result_zip:
+                self.assertIsNone(result_zip.testzip())
+
+    def test_render_fast_rows(self):
+        "Testing the rendering of the pre-serialized rows"
+        result = self.oot.generate(**self.data).render()
+        fast_result = self.oot.generate(
+            _relatorio_fast_rows=True, **self.data).render()
+        with zipfile.ZipFile(result) as result_zip, \
+                zipfile.ZipFile(fast_result) as fast_zip:
+            self.assertEqual(
+                fast_zip.read('content.xml'), result_zip.read('content.xml'))
+        self.assertTrue(any(
+                d.skeleton for d in row_directives(self.oot.stream)))
+        self.assertTrue(all(
+                d.memory_size([]) > 0 for d in row_directives(self.oot.stream)
+                if d.skeleton))
+
+    def test_render_codegen(self):
+        "Testing the rendering of the rows by compiled functions"
+        result = self.oot.generate(**self.data).render()
+        codegen_result = self.oot.generate(
+            _relatorio_codegen=True, **self.data).render()
+        with zipfile.ZipFile(result) as result_zip, \
+                zipfile.ZipFile(codegen_result) as codegen_zip:
+            self.assertEqual(
+                codegen_zip.read('content.xml'),
+                result_zip.read('content.xml'))
+        self.assertTrue(any(
+                d.function for d in row_directives(self.oot.stream)))
+
+    def test_render_flat(self):
+        "Testing the rendering into a flat document"
+        office = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+        xlink = 'http://www.w3.org/1999/xlink'
+        result = self.oot.generate(**self.data).render()
+        flat = self.oot.generate(_relatorio_flat=True, **self.data)\
+            .render().getvalue()
+        self.assertEqual(b''.join(self.oot.generate(
+                    _relatorio_flat=True, **self.data).iter_bytes()), flat)
+
+        root = lxml.etree.fromstring(flat)
+        self.assertEqual(root.tag, '{%s}document' % office)
+        self.assertEqual(root.get('{%s}mimetype' % office),
+            'application/vnd.oasis.opendocument.text')
+        self.assertEqual([lxml.etree.QName(c).localname for c in root], [
+                'meta', 'settings', 'scripts', 'font-face-decls', 'styles',
+                'automatic-styles', 'master-styles', 'body'])
+        images = []
+        with zipfile.ZipFile(result) as result_zip:
+            content = lxml.etree.fromstring(result_zip.read('content.xml'))
+            styles = lxml.etree.fromstring(result_zip.read('styles.xml'))
+            for image in chain(content.iter('{*}image'),
+                    styles.iter('{*}image')):
+                images.append(result_zip.read(
+                        image.attrib.pop('{%s}href' % xlink)))
+                for name in list(image.attrib):
+                    if name.startswith('{%s}' % xlink):
+                        del image.attrib[name]
+        binaries = []
+        for binary_data in root.iter('{%s}binary-data' % office):
+            binaries.append(base64.b64decode(binary_data.text or ''))
+            binary_data.getparent().remove(binary_data)
+        self.assertEqual(sorted(binaries), sorted(images))
+
+        def items(element):
+            return [(e.tag, sorted(e.attrib.items()), e.text, e.tail)
+                for e in element.iter()]
+        self.assertEqual(items(root.find('{%s}body' % office)),
+            items(content.find('{%s}body' % office)))
+
+    def test_render_stats(self):
+        "Testing the timings and the counters of the rendering"
+        stats = RenderStats()
+        result = self.oot.generate(**self.data).render(stats=stats)
+        self.assertEqual(
+            set(stats.phases), {'compile', 'evaluate', 'images', 'serialize',
+                'deflate', 'copy', 'deferred', 'render'})
+        self.assertEqual(stats.phases['images']['calls'],
+            stats.counters['images'])
+        self.assertGreater(stats.counters['images'], 0)
+        self.assertGreater(stats.counters['events'], 0)
+        self.assertGreater(stats.counters['loop_iterations'], 0)
+        with zipfile.ZipFile(result) as result_zip:
+            infolist = result_zip.infolist()
+        self.assertEqual(set(stats.members), {i.filename for i in infolist})
+        for info in infolist:
+            member = stats.members[info.filename]
+            self.assertEqual(member['size'], info.file_size)
+            self.assertEqual(member['compress_size'], info.compress_size)
+        self.assertEqual(stats.counters['bytes_in'],
+            sum(i.file_size for i in infolist))
+        self.assertGreater(stats.compression_ratio, 1)
+        render = stats.phases['render']
+        self.assertGreaterEqual(render['wall'], sum(
+                stats.phases[p]['wall']
+                for p in ['evaluate', 'serialize', 'deflate', 'copy']) * .99)
+
+        trace = StringIO()
+        stats.write_chrome_trace(trace)
+        events = json.loads(trace.getvalue())['traceEvents']
+        self.assertIn('render', {e['name'] for e in events})
+        self.assertIn('content.xml',
+            {e['name'] for e in events if e['cat'] == 'member'})
+
+        # the compilation is reported once
+        stats = RenderStats()
+        self.oot.generate(_relatorio_stats=stats, **self.data).render()
+        self.assertNotIn('compile', stats.phases)
+        self.assertIn('evaluate', stats.phases)
+
+    def test_render_memory(self):
+        "Testing the memory report of the rendering"
+        with MemoryStats() as stats:
+            result = self.oot.generate(_relatorio_stats=stats, **self.data)\
+                .render()
+        with zipfile.ZipFile(result) as result_zip:
+            images = sum(i.file_size for i in result_zip.infolist()
+                if i.filename.startswith('Pictures/'))
+        report = stats.memory_report()
+        self.assertTrue({'evaluate', 'serialize', 'deflate', 'images'}
+            <= set(report['phases']))
+        self.assertEqual(report['peak'],
+            max(p['peak'] for p in report['phases'].values()))
+        self.assertGreater(report['peak'], 0)
+        self.assertEqual(report['deferred_bytes'], images)
+        self.assertTrue(report['top'])
+        self.assertIn('memory', stats.as_dict())
+
+    def test_render_memory_lazy(self):
+        "Testing the tracing started by the rendering is stopped with it"
+        stats = MemoryStats(budget=1024)
+        for _ in range(2):
+            with self.assertRaises(MemoryBudgetExceeded):
+                self.oot.generate(_relatorio_stats=stats, **self.data)\
+                    .render()
+            self.assertFalse(tracemalloc.is_tracing())
+        stats = MemoryStats()
+        stats.call('render', lambda: None)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIn('render', stats.memory)
+
+    def test_render_memory_budget(self):
+        "Testing the rendering is aborted over the memory budget"
+        with MemoryStats(budget=1024) as stats:
+            with self.assertRaises(MemoryBudgetExceeded) as cm:
+                self.oot.generate(_relatorio_stats=stats, **self.data)\
+                    .render()
+        self.assertGreater(cm.exception.size, 1024)
+        self.assertEqual(cm.exception.budget, 1024)
+        self.assertIn('memory budget of 1024 bytes', str(cm.exception))
+
+    def test_memory_budget_hooks(self):
+        "Testing the memory budget is checked after each member"
+        with MemoryStats() as stats:
+            stats.budget = 1
+            data = [bytearray(1024) for _ in range(10)]
+            with self.assertRaises(MemoryBudgetExceeded) as cm:
+                stats.add_member('content.xml', clocks())
+        self.assertEqual(cm.exception.phase, 'serialize')
+        del data
+
+    def test_memory_budget_error(self):
+        "Testing the memory budget does not mask the errors"
+        with MemoryStats() as stats:
+            with self.assertRaises(ValueError):
+                with stats.phase('evaluate'):
+                    stats.budget = 1
+                    data = [bytearray(1024) for _ in range(10)]
+                    raise ValueError
+            stats.add_span('render', clocks(), aborted=True)
+        self.assertGreater(stats.memory['evaluate']['peak'], 1)
+        del data
+
     def test_filters(self):
         "Testing the filters with the Translator filter"
         stream = self.oot.generate(**self.data)
@@ -472,6 +800,108 @@ class TestOOTemplating(unittest.TestCase):
             images[3].get('{%s}height' % self.oot.namespaces['svg']),
             '2.2cm')
 
+    def test_images_same_bitstream(self):
+        "Testing the same bitstream is read and added once"
+        serializer = Mock(stats=None)
+        image_href = ImageHref(serializer, {})
+        bitstream = b'image'
+        hrefs = [image_href((bitstream, 'image/png')) for _ in range(3)]
+        self.assertEqual(hrefs[0], hrefs[2])
+        serializer.add_file.assert_called_once()
+
+    @unittest.skipUnless(PIL, "Pillow is required")
+    def test_images_dpi(self):
+        "Testing the images are downsampled to the frame size"
+        stream = self.oot.generate(_relatorio_image_dpi=72, **self.data)
+        with zipfile.ZipFile(stream.render()) as result_zip:
+            sizes = [
+                PIL.Image.open(BytesIO(result_zip.read(n))).size
+                for n in result_zip.namelist() if n.endswith('.png')]
+        # 2cm x 2.2cm at 72 dpi
+        self.assertIn((57, 62), sizes)
+
+    def test_compression(self):
+        "Testing the compression policy of the members"
+        def compress_types(**kwargs):
+            stream = self.oot.generate(**self.data, **kwargs)
+            with zipfile.ZipFile(stream.render()) as result_zip:
+                return {os.path.splitext(i.filename)[1]: i.compress_type
+                    for i in result_zip.infolist()
+                    if i.filename.startswith('Pictures/')
+                    or i.filename == 'content.xml'}
+
+        self.assertEqual(compress_types(), {
+                '.xml': zipfile.ZIP_DEFLATED,
+                '.jpg': zipfile.ZIP_STORED,
+                '.png': zipfile.ZIP_STORED,
+                '': zipfile.ZIP_DEFLATED,
+                })
+        policy = CompressionPolicy(
+            store_media=False, rules=[('*.xml', zipfile.ZIP_STORED, None)])
+        types = compress_types(_relatorio_compression=policy)
+        self.assertEqual(types['.xml'], zipfile.ZIP_STORED)
+        self.assertEqual(types['.jpg'], zipfile.ZIP_DEFLATED)
+
+    def test_compression_level(self):
+        "Testing the compression level is used"
+        sizes = []
+        for level in [0, 9]:
+            stream = self.oot.generate(
+                _relatorio_compresslevel=level, **self.data)
+            with zipfile.ZipFile(stream.render()) as result_zip:
+                sizes.append(result_zip.getinfo('content.xml').compress_size)
+        self.assertGreater(sizes[0], sizes[1])
+
+    def test_compression_threads(self):
+        "Testing the members deflated by blocks in threads"
+        def contents(result):
+            with zipfile.ZipFile(result) as result_zip:
+                self.assertIsNone(result_zip.testzip())
+                return {n: result_zip.read(n) for n in result_zip.namelist()
+                    if n != 'meta.xml'}
+
+        policy = CompressionPolicy(store_media=False)
+        expected = contents(self.oot.generate(
+                _relatorio_compression=policy, **self.data).render())
+        with patch.object(_ParallelZipWriteSplitStream, 'block_size', 512):
+            result = self.oot.generate(
+                _relatorio_compression=policy,
+                _relatorio_compression_threads=2, **self.data).render()
+        self.assertEqual(contents(result), expected)
+        with patch('relatorio.templates.opendocument._raw_write_checked',
+                False), \
+                patch.object(_ParallelZipWriteSplitStream, 'block_size', 512):
+            result = self.oot.generate(
+                _relatorio_compression=policy,
+                _relatorio_compression_threads=2, **self.data).render()
+        self.assertEqual(contents(result), expected)
+
+    def test_guess_type(self):
+        "Testing the deprecated guess of the cell types"
+        with self.assertWarns(DeprecationWarning):
+            attrs = self.oot._guess_type(True)
+        self.assertEqual(attrs, self.oot.cell_encoders(True))
+
+    def test_compression_profile(self):
+        "Testing the compression profiles"
+        stream = self.oot.generate(_relatorio_compression='fastest',
+            **self.data)
+        with zipfile.ZipFile(stream.render()) as result_zip:
+            self.assertIsNone(result_zip.testzip())
+        with self.assertRaises(ValueError):
+            self.oot.generate(_relatorio_compression='unknown', **self.data)
+
+    def test_manifest_entries(self):
+        "Testing the manifest entries index"
+        manifest = self.oot._archive.manifest.copy()
+        manifest.add_file_entry('Pictures/image.png', 'image/png')
+        self.assertIn('Pictures/image.png', manifest.entries)
+        manifest.remove_file_entry('Pictures/image.png')
+        manifest.remove_file_entry('content.xml')
+        self.assertNotIn('Pictures/image.png', str(manifest))
+        self.assertNotIn('content.xml', str(manifest))
+        self.assertIn('content.xml', str(self.oot._archive.manifest))
+
     def test_regexp(self):
         "Testing the regexp used to find relatorio tags"
         # a valid expression
@@ -506,6 +936,446 @@ class TestOOTemplating(unittest.TestCase):
             oot = Template(source)
             oot.generate(**self.data)
 
+    def test_render_fod_converted_once(self):
+        "Testing fod is converted only once for many renderings"
+        thisdir = os.path.dirname(__file__)
+        filepath = os.path.join(thisdir, 'test.fodt')
+        with patch('relatorio.templates.opendocument.fod2od',
+                side_effect=fod2od) as converter:
+            with open(filepath, mode='rb') as source:
+                oot = Template(source)
+            for _ in range(2):
+                result = oot.generate(**self.data).render()
+                with zipfile.ZipFile(result) as result_zip:
+                    self.assertIsNone(result_zip.testzip())
+        converter.assert_called_once()
+
+    def test_render_manifest_not_shared(self):
+        "Testing files added by a rendering are not kept in the manifest"
+        manifest = str(self.oot._archive.manifest)
+        self.oot.generate(**self.data).render()
+        self.assertEqual(str(self.oot._archive.manifest), manifest)
+
+
+class TestCompiledCache(unittest.TestCase):
+
+    def setUp(self):
+        self.filepath = os.path.join(os.path.dirname(__file__), 'test.odt')
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+        patcher = patch.object(Template, 'cache_dir', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def load(self):
+        with open(self.filepath, mode='rb') as source:
+            return Template(source)
+
+    def test_store_and_load(self):
+        "Testing the compiled template is loaded from the cache"
+        compiled = self.load()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        with patch.object(Template, '_compile') as compile_:
+            cached = self.load()
+            compile_.assert_not_called()
+        self.assertEqual(cached.namespaces, compiled.namespaces)
+        self.assertEqual(cached._files, compiled._files)
+        self.assertEqual(cached.has_col_loop, compiled.has_col_loop)
+        self.assertEqual(len(cached.stream), len(compiled.stream))
+        self.assertEqual(
+            cached.stream[0], (PI, ('relatorio', 'content.xml'), None))
+
+    def test_stale_version(self):
+        "Testing a cached template from another version is recompiled"
+        self.load()
+        path, = [os.path.join(self.cache_dir, n)
+            for n in os.listdir(self.cache_dir)]
+        with open(path, 'rb') as fp:
+            compiled = pickle.load(fp)
+        compiled['version'] = ('stale',)
+        with open(path, 'wb') as fp:
+            pickle.dump(compiled, fp)
+
+        with patch.object(
+                Template, '_compile', side_effect=Template._compile,
+                autospec=True) as compile_:
+            self.load()
+            compile_.assert_called_once()
+        with open(path, 'rb') as fp:
+            self.assertNotEqual(pickle.load(fp)['version'], ('stale',))
+
+    def test_archive_members_not_stored(self):
+        "Testing the members of the archive are read again from the source"
+        compiled = self.load()
+        path, = [os.path.join(self.cache_dir, n)
+            for n in os.listdir(self.cache_dir)]
+        with open(path, 'rb') as fp:
+            archive = pickle.load(fp)['archive']
+        self.assertEqual(archive.memory_size(), 0)
+
+        cached = self.load()
+        self.assertEqual(
+            cached._archive.memory_size(), compiled._archive.memory_size())
+        with zipfile.ZipFile(self.filepath) as source_zip:
+            self.assertEqual(cached._archive.read('settings.xml'),
+                source_zip.read('settings.xml'))
+
+    def test_render_many_spawn(self):
+        "Testing the workers started by spawn load the compiled template"
+        report = Report(self.filepath,
+            'application/vnd.oasis.opendocument.text')
+        report.tmpl_loader.load(report.fpath, report.mimetype)
+        path, = [os.path.join(self.cache_dir, n)
+            for n in os.listdir(self.cache_dir)]
+        with open(path, 'rb') as fp:
+            compiled = pickle.load(fp)
+        compiled['stream'] = [(TEXT, 'Cached,', pos)
+            if kind is TEXT and data == 'Bonjour,' else (kind, data, pos)
+            for kind, data, pos in compiled['stream']]
+        with open(path, 'wb') as fp:
+            pickle.dump(compiled, fp)
+
+        thisdir = os.path.dirname(__file__)
+        with open(os.path.join(thisdir, 'egg.jpg'), 'rb') as fp:
+            image = fp.read()
+        data = {'first_name': 'Trente', 'last_name': 'Møller',
+            'ville': 'Liège', 'friends': [], 'hobbies': [], 'animals': [],
+            'images': [(image, 'image/jpeg', None, None, 'Egg')],
+            'oeuf': image, 'footer': '', 'salutation': '', 'title': ''}
+        result, = report.render_many([data], workers=2,
+            mp_context=multiprocessing.get_context('spawn'))
+        self.assertIsNone(result.error)
+        with zipfile.ZipFile(result.result) as result_zip:
+            content = result_zip.read('content.xml').decode('utf-8')
+        self.assertIn('Cached,', content)
+        self.assertNotIn('Bonjour,', content)
+
+
+class TestSourceArchive(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.filepath = os.path.join(tmpdir.name, 'test.odt')
+        # the parts of test.odt without directives
+        office = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+        meta = 'urn:oasis:names:tc:opendocument:xmlns:meta:1.0'
+        dc = 'http://purl.org/dc/elements/1.1/'
+        with zipfile.ZipFile(os.path.join(
+                    os.path.dirname(__file__), 'test.odt')) as source_zip, \
+                zipfile.ZipFile(self.filepath, 'w') as template_zip:
+            for info in source_zip.infolist():
+                name = info.filename
+                data = source_zip.read(name)
+                if name in {'content.xml', 'styles.xml', 'meta.xml'}:
+                    data = ('<office:document-%s xmlns:office="%s" '
+                        'xmlns:meta="%s" xmlns:dc="%s"><office:%s/>'
+                        '</office:document-%s>' % (name[:-4], office, meta,
+                            dc, name[:-4], name[:-4])).encode('utf-8')
+                template_zip.writestr(info, data)
+
+    def test_path(self):
+        "Testing the path is not read again once compiled"
+        template = Template(source=None, filepath=self.filepath)
+        self.assertLess(template._archive.memory_size(),
+            os.path.getsize(self.filepath))
+        with zipfile.ZipFile(self.filepath) as source_zip:
+            settings = source_zip.read('settings.xml')
+
+        with open(self.filepath, 'ab') as fp:
+            fp.write(b'changed')
+        with zipfile.ZipFile(template.generate().render()) as result_zip:
+            self.assertIsNone(result_zip.testzip())
+            self.assertEqual(result_zip.read('settings.xml'), settings)
+
+        os.remove(self.filepath)
+        with zipfile.ZipFile(template.generate().render()) as result_zip:
+            self.assertEqual(result_zip.read('settings.xml'), settings)
+
+    def test_file(self):
+        "Testing only the members not parsed are kept"
+        with open(self.filepath, 'rb') as fp:
+            template = Template(fp)
+        archive = template._archive
+        self.assertLess(archive.memory_size(), os.path.getsize(self.filepath))
+        self.assertNotIn('content.xml', archive._raw)
+        self.assertIn('settings.xml', archive._raw)
+        with zipfile.ZipFile(self.filepath) as source_zip:
+            self.assertEqual(archive.read('settings.xml'),
+                source_zip.read('settings.xml'))
+
+
+class TestDownsampleImage(unittest.TestCase):
+
+    def test_length_to_pixels(self):
+        "Testing the conversion of lengths into pixels"
+        self.assertEqual(length_to_pixels('2.54cm', 300), 300)
+        self.assertEqual(length_to_pixels('1in', 96), 96)
+        self.assertEqual(length_to_pixels('72pt', 150), 150)
+        self.assertIsNone(length_to_pixels('', 96))
+        self.assertIsNone(length_to_pixels('10%', 96))
+
+    @unittest.skipUnless(PIL, "Pillow is required")
+    def test_downsample(self):
+        "Testing the image is resized keeping its ratio"
+        content = BytesIO()
+        PIL.Image.effect_noise((400, 200), 64).save(content, 'PNG')
+        content = content.getvalue()
+        downsampled = downsample_image(content, 100, 100)
+        image = PIL.Image.open(BytesIO(downsampled))
+        self.assertEqual((image.format, image.size), ('PNG', (100, 50)))
+        self.assertIs(downsample_image(content, 800, None), content)
+
+    @unittest.skipUnless(PIL, "Pillow is required")
+    def test_not_image(self):
+        "Testing unknown content is kept"
+        self.assertEqual(downsample_image(b'<svg/>', 10, 10), b'<svg/>')
+
+    @unittest.skipUnless(PIL, "Pillow is required")
+    def test_not_writable(self):
+        "Testing the image is kept if Pillow can not write its format"
+        content = BytesIO()
+        PIL.Image.effect_noise((400, 200), 64).save(content, 'PNG')
+        content = content.getvalue()
+        with patch.object(PIL.Image.Image, 'save', side_effect=KeyError('X')):
+            with self.assertWarns(UserWarning):
+                self.assertIs(_downsample_image(content, 10, 10), content)
+
+    def test_without_pillow(self):
+        "Testing the image is kept without Pillow"
+        with patch.dict('sys.modules', {'PIL': None}), \
+                patch('relatorio.templates.opendocument._pil_missing_warned',
+                    False):
+            with self.assertWarns(UserWarning):
+                self.assertEqual(_downsample_image(b'x', 10, 10), b'x')
+
+
+class TestRowExpressionTransformer(unittest.TestCase):
+
+    def evaluate(self, source, **data):
+        transformer = _RowExpressionTransformer()
+        code = transformer.code(Expression(source))
+        namespace = dict(data,
+            _lookup_attr=StrictLookup.lookup_attr,
+            _lookup_item=StrictLookup.lookup_item)
+        return eval(code, namespace), transformer.names
+
+    def test_lookup(self):
+        "Testing the attributes and items are looked up like genshi"
+        self.assertEqual(
+            self.evaluate('o.name', o={'name': 'foo'}), ('foo', {'o'}))
+        self.assertEqual(
+            self.evaluate('o["real"]', o=1), (1, {'o'}))
+        with self.assertRaises(UndefinedError):
+            self.evaluate('o.missing', o={})
+
+    def test_constant_subscript(self):
+        "Testing the constant subscripts are kept"
+        self.assertEqual(self.evaluate('line[1]', line='ab'), ('b', {'line'}))
+        self.assertNotIn(
+            '_lookup_item',
+            _RowExpressionTransformer().code(Expression('line[1]')))
+
+    def test_local_names(self):
+        "Testing the names bound by the expression are not arguments"
+        self.assertEqual(
+            self.evaluate('(lambda x: x + y)(1)', y=2), (3, {'y'}))
+        self.assertEqual(
+            self.evaluate('[i for i in items]', items=[1]), ([1], {'items'}))
+
+
+class TestCellEncoders(unittest.TestCase):
+    office = 'urn:office'
+
+    def setUp(self):
+        self.encoders = CellEncoders({'office': self.office})
+
+    def cell(self, value):
+        attrs = self.encoders(value)
+        return {k.split('}')[1]: v for k, v in attrs.items() if v is not None}
+
+    def test_defaults(self):
+        "Testing the default encoders"
+        self.assertEqual(self.cell(True),
+            {'boolean-value': 'true', 'value-type': 'boolean'})
+        self.assertEqual(
+            self.cell(datetime.datetime(2020, 1, 2, 3, 4)),
+            {'date-value': '2020-01-02T03:04:00', 'value-type': 'date'})
+        self.assertEqual(
+            self.cell(Decimal('1.5')), {'value': Decimal('1.5'),
+                'value-type': 'float'})
+        self.assertEqual(self.cell('a\x00b'),
+            {'string-value': 'a b', 'value-type': 'string'})
+        self.assertEqual(
+            self.cell(datetime.time(12, 30, 5, 500000)),
+            {'time-value': 'PT12H30M05.5S', 'value-type': 'time'})
+        self.assertEqual(self.cell(None), {'value-type': 'void'})
+
+    def test_clear_attributes(self):
+        "Testing the attributes of the other types are cleared"
+        attrs = self.encoders(1)
+        self.assertIn('{%s}string-value' % self.office, attrs)
+        self.assertIsNone(attrs['{%s}string-value' % self.office])
+
+    def test_keep_currency(self):
+        "Testing the currency of the template cell is kept"
+        office = 'urn:oasis:names:tc:opendocument:xmlns:office:1.0'
+        flat = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<office:document xmlns:office="%s" xmlns:table="%s" '
+            'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'xmlns:meta="urn:oasis:names:tc:opendocument:xmlns:meta:1.0" '
+            'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+            'office:mimetype="application/vnd.oasis.opendocument.spreadsheet"'
+            '><office:meta/><office:automatic-styles/>'
+            '<office:body><office:spreadsheet>'
+            '<table:table table:name="Sheet"><table:table-row>'
+            '<table:table-cell office:value-type="currency" '
+            'office:currency="EUR" office:value="0"><text:p>'
+            '<text:a xlink:href="relatorio://price">price</text:a>'
+            '</text:p></table:table-cell></table:table-row></table:table>'
+            '</office:spreadsheet></office:body></office:document>'
+            % (office, OO_TABLE_NS)).encode('utf-8')
+        result = Template(BytesIO(flat)).generate(price=Decimal('2.50'))\
+            .render()
+        with zipfile.ZipFile(result) as result_zip:
+            root = lxml.etree.fromstring(result_zip.read('content.xml'))
+        cell, = root.iter('{%s}table-cell' % OO_TABLE_NS)
+        self.assertEqual(cell.get('{%s}currency' % office), 'EUR')
+        self.assertEqual(cell.get('{%s}value' % office), '2.50')
+
+    def test_abstract_base_class(self):
+        "Testing the types registered as abstract base classes"
+        self.assertEqual(
+            self.cell(Fraction(1, 4)), {'value': 0.25, 'value-type': 'float'})
+
+    def test_calcext(self):
+        "Testing the calcext value type"
+        encoders = CellEncoders({'office': self.office, 'calcext': 'urn:ext'})
+        self.assertEqual(encoders(1.5)['{urn:ext}value-type'], 'float')
+
+    def test_register(self):
+        "Testing the registration of a currency encoder"
+        class Money(Decimal):
+            pass
+        self.assertEqual(self.encoders.lookup(Money), encode_number)
+        self.encoders.register(Money, lambda v: ('currency', v, 'EUR'))
+        self.assertEqual(
+            self.cell(Money('2.50')), {'value': Money('2.50'),
+                'currency': 'EUR', 'value-type': 'currency'})
+        self.assertEqual(
+            self.cell(Decimal('2')), {'value': Decimal('2'),
+                'value-type': 'float'})
+
+    @unittest.skipUnless(numpy, "NumPy is required")
+    def test_numpy(self):
+        "Testing the NumPy scalars"
+        self.assertEqual(self.cell(numpy.bool_(True)),
+            {'boolean-value': 'true', 'value-type': 'boolean'})
+        self.assertEqual(self.cell(numpy.float64(1.5)),
+            {'value': 1.5, 'value-type': 'float'})
+        self.assertEqual(self.cell(numpy.int64(2)),
+            {'value': 2, 'value-type': 'float'})
+
+
+class TestColumnarRows(unittest.TestCase):
+
+    def test_columns(self):
+        "Testing the rows of columns which are not arrays"
+        rows = ColumnarRows([['a', 'b'], [1, None]])
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(list(rows), [('a', 1), ('b', None)])
+
+    def test_names(self):
+        "Testing the rows are named tuples"
+        row, = ColumnarRows([['a'], [1]], ['name', 'amount'])
+        self.assertEqual((row.name, row[1]), ('a', 1))
+
+    def test_length(self):
+        "Testing the columns must have the same length"
+        with self.assertRaises(ValueError):
+            ColumnarRows([['a', 'b'], [1]])
+
+    @unittest.skipUnless(numpy, "NumPy is required")
+    def test_arrays(self):
+        "Testing the formatting of the arrays"
+        rows = ColumnarRows([
+                numpy.array([1.5, numpy.nan]),
+                numpy.array([1, 2]),
+                numpy.array([True, False]),
+                numpy.array(['2020-01-02', 'NaT'], dtype='datetime64[D]'),
+                numpy.array(['a\x01', 'b']),
+                ])
+        encoders = CellEncoders({'office': 'urn:office'})
+        first, second = rows
+        self.assertEqual(first, ('1.5', '1', 'True', '2020-01-02', 'a '))
+        self.assertEqual(
+            [encoders(v)['{urn:office}value-type'] for v in first],
+            ['float', 'float', 'boolean', 'date', 'string'])
+        self.assertEqual(
+            encoders(first[2])['{urn:office}boolean-value'], 'true')
+        self.assertEqual(second[0], None)
+        self.assertEqual(second[3], None)
+
+    @unittest.skipUnless(pandas, "pandas is required")
+    def test_from_dataframe(self):
+        "Testing the rows of a dataframe"
+        dataframe = pandas.DataFrame({'name': ['a'], 'amount': [2.5]})
+        row, = ColumnarRows.from_dataframe(dataframe)
+        self.assertEqual((row.name, row.amount), ('a', '2.5'))
+        self.assertEqual(row.amount.value_type, 'float')
+
+
+class TestDuplicateColumnHeaders(unittest.TestCase):
+
+    def setUp(self):
+        self.xml = (
+            '<t:doc xmlns:t="urn:table" xmlns:r="%s">'
+            '<t:table><r:repeat table="T"><t:column/></r:repeat>'
+            '<t:row>'
+            '<t:table><r:repeat table="U"><t:column/></r:repeat></t:table>'
+            '</t:row></t:table><t:p/></t:doc>' % RELATORIO_URI)
+        self.counter = ColumnCounter()
+        self.counter.counters = {'T': 3, 'U': 2}
+
+    def render(self):
+        stream = Stream(list(XMLParser(StringIO(self.xml))))
+        return stream.filter(DuplicateColumnHeaders(
+                self.counter, '{urn:table}table')).render()
+
+    def test_repeat(self):
+        "Testing the column headers are repeated"
+        self.assertEqual(self.render(),
+            '<t:doc xmlns:t="urn:table" xmlns:r="relatorio">'
+            '<t:table><t:column/><t:column/><t:column/>'
+            '<t:row><t:table><t:column/><t:column/></t:table>'
+            '</t:row></t:table><t:p/></t:doc>')
+
+    def test_spooled(self):
+        "Testing the buffered events written into a temporary file"
+        expected = self.render()
+        with patch.object(DuplicateColumnHeaders, 'spool_size', 2):
+            self.assertEqual(self.render(), expected)
+
+
+class TestEtreeToStream(unittest.TestCase):
+
+    def test_same_as_parser(self):
+        "Testing the stream is the same as parsing the serialization"
+        xml = b'''<root xmlns="urn:default" xmlns:a="urn:a">text
+                    <a:child a:attr="1" attr="2">child text</a:child>
+                    <!-- comment -->tail
+                    <?target data?>
+                    <b:child xmlns:b="urn:b"><empty/></b:child>
+                </root>'''
+        root = lxml.etree.parse(BytesIO(xml)).getroot()
+        expected = [(k, d) for k, d, _ in XMLParser(BytesIO(xml))]
+
+        self.assertEqual(
+            [(k, d) for k, d, _ in etree_to_stream(root)], expected)
+
 
 class TestRemoveNodeKeepingTail(unittest.TestCase):
 
@@ -598,3 +1468,85 @@ class TestEscapeXMLInvalidChars(unittest.TestCase):
         "Test replacement"
         self.assertEqual(
             escape_xml_invalid_chars("foo \x00 bar", "?"), "foo ? bar")
+
+
+class TestFod2Od(unittest.TestCase):
+
+    def flat(self, body):
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<office:document '
+            'xmlns:office="urn:oasis:names:tc:opendocument:xmlns:office:1.0" '
+            'xmlns:table="%s" '
+            'xmlns:text="urn:oasis:names:tc:opendocument:xmlns:text:1.0" '
+            'xmlns:draw="urn:oasis:names:tc:opendocument:xmlns:drawing:1.0" '
+            'xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'office:mimetype="application/vnd.oasis.opendocument.spreadsheet"'
+            '>\n <office:automatic-styles/>\n'
+            ' <office:body><office:spreadsheet>%s</office:spreadsheet>'
+            '</office:body>\n</office:document>' % (OO_TABLE_NS, body)
+            ).encode('utf-8')
+
+    def test_streaming(self):
+        "Testing the flat document is converted part by part"
+        thisdir = os.path.dirname(__file__)
+        with open(os.path.join(thisdir, 'two.png'), 'rb') as fp:
+            image = fp.read()
+        rows = ''.join('<table:table-row><table:table-cell>'
+            '<text:p>%s &amp; &lt;%s&gt;</text:p></table:table-cell>'
+            '</table:table-row>\n' % (i, i) for i in range(100))
+        body = ('<table:table table:name="Sheet">%s</table:table>'
+            '<text:p><draw:frame><draw:image><office:binary-data>%s'
+            '</office:binary-data></draw:image></draw:frame></text:p>' % (
+                rows, base64.b64encode(image).decode()))
+        with zipfile.ZipFile(fod2od(BytesIO(self.flat(body)))) as od:
+            self.assertEqual(od.namelist(), [
+                    'mimetype', 'Pictures/image0.png', 'content.xml',
+                    'styles.xml', 'META-INF/manifest.xml'])
+            self.assertEqual(od.read('Pictures/image0.png'), image)
+            self.assertEqual(od.getinfo('Pictures/image0.png').compress_type,
+                zipfile.ZIP_STORED)
+            content = od.read('content.xml')
+            manifest = od.read('META-INF/manifest.xml')
+        root = lxml.etree.fromstring(content)
+        self.assertEqual(root.tag,
+            '{urn:oasis:names:tc:opendocument:xmlns:office:1.0}'
+            'document-content')
+        self.assertEqual(content.count(b'xmlns:table='), 1)
+        self.assertEqual(len(root.findall('.//{%s}table-row' % OO_TABLE_NS)),
+            100)
+        self.assertIn(b'<text:p>99 &amp; &lt;99&gt;</text:p>', content)
+        self.assertIn(b'xlink:href="Pictures/image0.png"', content)
+        self.assertNotIn(b'binary-data', content)
+        self.assertIn(b'manifest:full-path="Pictures/image0.png"', manifest)
+        self.assertIn(b'manifest:media-type="image/png"', manifest)
+
+    def test_comments(self):
+        "Testing the comments are kept in the parts"
+        body = ('<!-- before --><table:table table:name="Sheet">'
+            '<!-- rows --><table:table-row><!-- cell --><table:table-cell/>'
+            '</table:table-row><?relatorio pi?></table:table>'
+            '<!-- after --> <text:p/>')
+        source = self.flat(body).replace(
+            b'<office:document ', b'<!-- prolog --><office:document ')
+        with zipfile.ZipFile(fod2od(BytesIO(source))) as od:
+            content = od.read('content.xml')
+        lxml.etree.fromstring(content)
+        self.assertIn(b'<office:spreadsheet><!-- before --><table:table '
+            b'table:name="Sheet"><!-- rows --><table:table-row><!-- cell -->'
+            b'<table:table-cell/></table:table-row><?relatorio pi?>'
+            b'</table:table><!-- after --> <text:p/>', content)
+        self.assertNotIn(b'prolog', content)
+
+    def test_sniff_mimetype(self):
+        "Testing the image types are sniffed from their signature"
+        thisdir = os.path.dirname(__file__)
+        for name, mimetype in [
+                ('one.jpg', 'image/jpeg'), ('two.png', 'image/png')]:
+            with open(os.path.join(thisdir, name), 'rb') as fp:
+                self.assertEqual(sniff_mimetype(fp.read()), mimetype)
+        self.assertEqual(sniff_mimetype(b'GIF89a\x01\x00'), 'image/gif')
+        self.assertEqual(
+            sniff_mimetype(b'RIFF\x00\x00\x00\x00WEBPVP8 '), 'image/webp')
+        self.assertEqual(sniff_mimetype(
+                b'<?xml version="1.0"?>\n<svg xmlns="http://www.w3.org/2000/'
+                b'svg"/>'), 'image/svg+xml')
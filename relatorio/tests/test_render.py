@@ -0,0 +1,124 @@
+# This file is part of relatorio.  The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from contextlib import redirect_stderr
+
+from relatorio.render import (
+    batch, main, memory_report, parse_size, read_records)
+from relatorio.stats import MemoryBudgetExceeded
+
+
+class TestRender(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.tmpdir = tmpdir.name
+        # the mimetype is guessed from the extension
+        self.template = os.path.join(self.tmpdir, 'test.txt')
+        shutil.copy(os.path.join(
+                os.path.dirname(__file__), 'templates', 'test.tmpl'),
+            self.template)
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, name), 'rb') as fp:
+            return fp.read()
+
+    def test_main(self):
+        "Testing the rendering into a file"
+        main(self.template, {'o': {'name': 'Foo'}},
+            os.path.join(self.tmpdir, 'out.txt'))
+        self.assertEqual(self.read('out.txt'), b'Hello Foo.\n')
+
+    def test_main_error(self):
+        "Testing a failed rendering does not leave the output"
+        output = os.path.join(self.tmpdir, 'out.txt')
+        with self.assertRaises(Exception):
+            main(self.template, {}, output)
+        self.assertEqual(os.listdir(self.tmpdir), ['test.txt'])
+
+        with open(output, 'wb') as fp:
+            fp.write(b'previous')
+        with self.assertRaises(Exception):
+            main(self.template, {}, output)
+        self.assertEqual(self.read('out.txt'), b'previous')
+
+    def test_read_records(self):
+        "Testing the reading of JSON lines"
+        lines = io.StringIO('{"id": 1}\n\n{"id": 2}\n')
+        self.assertEqual(list(read_records(lines)), [{'id': 1}, {'id': 2}])
+
+    def test_read_records_invalid(self):
+        "Testing an invalid JSON line is yielded as an error"
+        lines = io.StringIO('{"id": 1}\n{"id": \n{"id": 2}\n')
+        first, error, last = read_records(lines)
+        self.assertEqual((first, last), ({'id': 1}, {'id': 2}))
+        self.assertIsInstance(error, ValueError)
+        self.assertIn('line 2', str(error))
+
+    def test_batch(self):
+        "Testing the rendering of a batch"
+        records = read_records(io.StringIO(
+                '{"o": {"name": "foo"}}\n{"o": {"name": "bar"}}\n{}\n'))
+        output = os.path.join(self.tmpdir, '{index}-{o[name]}.txt')
+        results = batch(self.template, records, output, jobs=1)
+
+        self.assertEqual([r.error for r in results[:2]], [None, None])
+        self.assertIsNotNone(results[2].error)
+        self.assertEqual(self.read('0-foo.txt'), b'Hello foo.\n')
+        self.assertEqual(self.read('1-bar.txt'), b'Hello bar.\n')
+
+    def test_batch_errors(self):
+        "Testing the failed records do not stop the batch nor leave outputs"
+        with open(os.path.join(self.tmpdir, '1.txt'), 'wb') as fp:
+            fp.write(b'previous')
+        records = read_records(io.StringIO(
+                '{"o": {"name": "foo"}}\n{}\n{"o": \n'
+                '{"o": {"name": "bar"}}\n'))
+        output = os.path.join(self.tmpdir, '{index}.txt')
+        results = batch(self.template, records, output, jobs=1)
+
+        self.assertEqual([r.error is None for r in results],
+            [True, False, False, True])
+        self.assertIsInstance(results[2].error, ValueError)
+        self.assertEqual(self.read('0.txt'), b'Hello foo.\n')
+        self.assertEqual(self.read('1.txt'), b'previous')
+        self.assertEqual(self.read('3.txt'), b'Hello bar.\n')
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+            ['0.txt', '1.txt', '3.txt', 'test.txt'])
+
+    def test_batch_output(self):
+        "Testing the batch output must contain a replacement field"
+        for output in ['-', os.path.join(self.tmpdir, 'out.txt')]:
+            with self.assertRaises(ValueError):
+                batch(self.template, [{}], output, jobs=1)
+
+    def test_parse_size(self):
+        "Testing the parsing of sizes"
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1.5M'), 1536 * 1024)
+        self.assertEqual(parse_size('1G'), 1024 ** 3)
+
+    def test_memory_report(self):
+        "Testing the memory report of the rendering"
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            memory_report(self.template, {'o': {'name': 'Foo'}},
+                os.path.join(self.tmpdir, 'out.txt'))
+        self.assertEqual(self.read('out.txt'), b'Hello Foo.\n')
+        report = json.loads(stderr.getvalue())
+        self.assertTrue({'compile', 'render'} <= set(report['phases']))
+        self.assertGreater(report['peak'], 0)
+
+    def test_memory_budget(self):
+        "Testing the rendering is aborted over the memory budget"
+        with redirect_stderr(io.StringIO()):
+            with self.assertRaises(MemoryBudgetExceeded):
+                memory_report(self.template, {'o': {'name': 'Foo'}},
+                    os.path.join(self.tmpdir, 'out.txt'), budget=1)